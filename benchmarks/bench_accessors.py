@@ -0,0 +1,177 @@
+"""
+Micro-benchmark for field lookups through the public `Serializer` API:
+`get_value`, `get_meta_value` and `serialize` as originally implemented
+(per-call path splitting and method lookups) versus the compiled accessors
+and serialize plans they now use.
+
+    python -m benchmarks.bench_accessors [--number N]
+"""
+import argparse
+import collections.abc
+import timeit
+
+from elasticsearch_dsl import Document, Float, Integer, Keyword, Text
+
+from esdocs.exceptions import InvalidFieldLookup, MissingSerializer
+from esdocs.serializer import Serializer
+
+
+class Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class AccessorDocument(Document):
+    id = Integer()
+    title = Text()
+    city = Keyword()
+    country = Keyword()
+    score = Float()
+
+    class Index:
+        name = 'bench-accessors'
+
+
+class CompiledSerializer(Serializer):
+    document = AccessorDocument
+    map_id = 'id'
+    map_fields = {
+        'city': 'address.city',
+        'country': 'address.region.country',
+        'score': 'stats.score',
+    }
+
+
+class LegacySerializer(CompiledSerializer):
+    # copies of the original, uncompiled implementations
+
+    @classmethod
+    def get_value(cls, obj, name, source=None):
+        parts = (cls.map_fields.get(name) or name).split('.')
+        v = obj
+        for n, part in enumerate(parts, start=1):
+            try:
+                v = getattr(v, part)
+            except AttributeError:
+                if not isinstance(v, collections.abc.Mapping):
+                    raise
+                v = v.get(part)
+
+            if v is None and n != len(parts):
+                raise InvalidFieldLookup
+
+        return v
+
+    @classmethod
+    def serialize(cls, obj, source=None, context=None):
+        if not hasattr(cls, 'doc_fields'):
+            cls.doc_fields = cls.document._doc_type.mapping.properties.properties.to_dict()
+
+        if source is None:
+            source = obj
+
+        data = {}
+        for name, field in cls.doc_fields.items():
+            empty = False
+            try:
+                v = getattr(cls, 'serialize_{}'.format(name))(obj, source)
+            except AttributeError:
+                try:
+                    v = getattr(cls, 'get_{}_value'.format(name))(obj, source)
+                except AttributeError:
+                    try:
+                        v = cls.get_value(obj, name, source)
+                    except InvalidFieldLookup:
+                        v = field.empty()
+                        empty = True
+
+                    if callable(v):
+                        v = v()
+
+                for f in cls.compatibility_hooks: v = f(v)
+                v = cls.normalize_value(v)
+                v = cls.adjust_value(name, v)
+
+                if not empty and v is not None:
+                    try:
+                        subdoc = getattr(field, '_doc_class')
+                    except AttributeError:
+                        pass
+                    else:
+                        try:
+                            serializer = cls.registry[subdoc]
+                        except KeyError:
+                            raise MissingSerializer("Every Document and inner Document must have a registered Serializer.")
+                        else:
+                            if hasattr(v, '__iter__'):
+                                v = [serializer.serialize(_v, source) for _v in v]
+                            else:
+                                v = serializer.serialize(v, source)
+
+            data[name] = v
+
+        return data
+
+    @classmethod
+    def get_meta_value(cls, obj, name):
+        try:
+            func = getattr(cls, 'get_meta_{}_value'.format(name))
+        except AttributeError:
+            meta_lookup_value = getattr(cls, 'map_{}'.format(name), None)
+            if meta_lookup_value:
+                v = cls.get_value(obj, meta_lookup_value)
+                if callable(v):
+                    v = v()
+                return v
+        else:
+            return func(obj)
+
+
+def make_doc(n):
+    return Obj(
+        id=n,
+        title='document {}'.format(n),
+        address=Obj(city='Vancouver', region=Obj(country='CA')),
+        stats={'score': n * 1.5},
+    )
+
+
+def run(number):
+    docs = [make_doc(n) for n in range(1000)]
+    names = ['id', 'title', 'city', 'country', 'score']
+
+    def benchmarks(serializer):
+        def get_value():
+            for d in docs:
+                for name in names:
+                    serializer.get_value(d, name)
+
+        def get_meta_value():
+            for d in docs:
+                serializer.get_meta_value(d, 'id')
+
+        def serialize():
+            for d in docs:
+                serializer.serialize(d)
+
+        return (('get_value', get_value), ('get_meta_value', get_meta_value), ('serialize', serialize))
+
+    # the same documents either way
+    assert [LegacySerializer.serialize(d) for d in docs] == [CompiledSerializer.serialize(d) for d in docs]
+
+    results = {}
+    for label, serializer in (('legacy', LegacySerializer), ('compiled', CompiledSerializer)):
+        for name, func in benchmarks(serializer):
+            elapsed = min(timeit.repeat(func, number=number, repeat=3))
+            results[(label, name)] = elapsed / (number * len(docs)) * 1e6
+            print('{:>10} {:<15}: {:.3f} us/document'.format(label, name, results[(label, name)]))
+
+    for name, func in benchmarks(CompiledSerializer):
+        print('{:>10} {:<15}: {:.2f}x'.format('speedup', name, results[('legacy', name)] / results[('compiled', name)]))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=50)
+    run(parser.parse_args().number)
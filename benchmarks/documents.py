@@ -0,0 +1,168 @@
+"""
+Synthetic Document/Serializer pairs for benchmarking, served from an
+in-memory data source:
+
+ - flat: a handful of scalar fields
+ - nested: `Nested`/`Object` inner docs with their own serializers
+ - wide: 100 fields
+"""
+import datetime
+import decimal
+import math
+
+from elasticsearch_dsl import (
+    Boolean, Date, Document, Float, InnerDoc, Integer, Keyword, Nested, Object, Text
+)
+
+from esdocs.serializer import Serializer
+
+BASE_DATE = datetime.datetime(2020, 1, 1)
+
+
+class Row:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class MemorySerializer(Serializer):
+    """ Serves `size` generated rows, with key-range and offset chunking. """
+    size = 10000
+    map_id = 'id'
+    _rows = None
+
+    @classmethod
+    def make_row(cls, n):
+        raise NotImplementedError
+
+    @classmethod
+    def rows(cls):
+        if cls.__dict__.get('_rows') is None:
+            cls._rows = [cls.make_row(n) for n in range(1, cls.size + 1)]
+        return cls._rows
+
+    @classmethod
+    def fetch_data_length(cls, **kwargs):
+        return len(cls.rows())
+
+    @classmethod
+    def fetch_data_partitions(cls, count, **kwargs):
+        # ids are 1..size, so this mirrors DjangoSerializer's integer key split
+        size = len(cls.rows())
+        if not size:
+            return []
+        count = max(1, min(count, size))
+        edges = [None] + [(size * n) // count for n in range(1, count)] + [None]
+        return list(zip(edges[:-1], edges[1:]))
+
+    @classmethod
+    def fetch_data(cls, **kwargs):
+        rows = cls.rows()
+        if 'parallel_range' in kwargs:
+            lo, hi = kwargs['parallel_range']
+            return iter(rows[lo or 0:hi])
+        if 'parallel_chunk_num' in kwargs:
+            start = kwargs['parallel_chunk_num'] * kwargs['parallel_chunk_size']
+            return iter(rows[start:start + kwargs['parallel_chunk_size']])
+        return iter(rows)
+
+
+class FlatDocument(Document):
+    title = Text()
+    slug = Keyword()
+    count = Integer()
+    price = Float()
+    created = Date()
+    active = Boolean()
+    tags = Keyword()
+    body = Text()
+
+    class Index:
+        name = 'bench-flat'
+
+
+class FlatSerializer(MemorySerializer):
+    document = FlatDocument
+
+    @classmethod
+    def make_row(cls, n):
+        return Row(
+            id=n,
+            title='  Document number {}  '.format(n),
+            slug='document-{}'.format(n),
+            count=n % 1000,
+            price=decimal.Decimal('{}.99'.format(n % 500)),
+            created=BASE_DATE + datetime.timedelta(minutes=n),
+            active=bool(n % 2),
+            tags=['tag{}'.format(n % 7), 'tag{}'.format(n % 11)],
+            body='lorem ipsum dolor sit amet ' * 8,
+        )
+
+
+class AuthorDocument(InnerDoc):
+    name = Keyword()
+    email = Keyword()
+
+
+class CommentDocument(InnerDoc):
+    author = Keyword()
+    text = Text()
+    score = Float()
+    posted = Date()
+
+
+class NestedDocument(Document):
+    title = Text()
+    author = Object(AuthorDocument)
+    comments = Nested(CommentDocument)
+
+    class Index:
+        name = 'bench-nested'
+
+
+class AuthorSerializer(Serializer):
+    document = AuthorDocument
+
+
+class CommentSerializer(Serializer):
+    document = CommentDocument
+
+
+class NestedSerializer(MemorySerializer):
+    document = NestedDocument
+
+    @classmethod
+    def make_row(cls, n):
+        return Row(
+            id=n,
+            title='Post {}'.format(n),
+            author=Row(name='author{}'.format(n % 50), email='author{}@example.com'.format(n % 50)),
+            comments=[
+                Row(author='commenter{}'.format(c), text='comment {} on {}'.format(c, n),
+                    score=math.sqrt(c + n), posted=BASE_DATE + datetime.timedelta(hours=c))
+                for c in range(5)
+            ],
+        )
+
+
+WIDE_FIELD_COUNT = 100
+
+WideDocument = type('WideDocument', (Document, ), dict(
+    [('f{}'.format(i), Keyword() if i % 2 else Integer()) for i in range(WIDE_FIELD_COUNT)] +
+    [('Index', type('Index', (), {'name': 'bench-wide'}))]
+))
+
+
+class WideSerializer(MemorySerializer):
+    document = WideDocument
+
+    @classmethod
+    def make_row(cls, n):
+        values = {'f{}'.format(i): ('v{}-{}'.format(i, n) if i % 2 else i * n) for i in range(WIDE_FIELD_COUNT)}
+        return Row(id=n, **values)
+
+
+SHAPES = {
+    'flat': FlatSerializer,
+    'nested': NestedSerializer,
+    'wide': WideSerializer,
+}
@@ -0,0 +1,129 @@
+"""
+A local HTTP stand-in for Elasticsearch that accepts `_bulk` requests and
+answers index-admin calls (create, settings, aliases, forcemerge, ...) with
+canned acknowledgements, so esdocs throughput can be measured without a
+cluster.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+INFO = {
+    'name': 'esdocs-bench',
+    'cluster_name': 'esdocs-bench',
+    'version': {'number': '7.17.0', 'build_flavor': 'default'},
+    'tagline': 'You Know, for Search',
+}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeElasticsearchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately; don't hold the body back
+    # waiting for the client to acknowledge the headers
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _respond(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _bulk(self, body):
+        items = []
+        lines = iter(body.splitlines())
+        for line in lines:
+            if not line.strip():
+                continue
+            op_type, meta = json.loads(line).popitem()
+            if op_type != 'delete':
+                next(lines, None)
+            items.append({op_type: {'_id': str(meta.get('_id')), 'status': 200 if op_type == 'delete' else 201}})
+
+        # (requests are handled in threads of their own)
+        with self.server.stats_lock:
+            self.server.stats['bulk_requests'] += 1
+            self.server.stats['bulk_items'] += len(items)
+        return {'took': 1, 'errors': False, 'items': items}
+
+    def do_HEAD(self):
+        # eg. `indices.exists`; nothing exists until it's created
+        self._respond(404, {})
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/':
+            return self._respond(200, INFO)
+        if path.endswith('/_settings'):
+            return self._respond(200, {})
+        if '/_alias' in path:
+            return self._respond(200, {})
+        self._respond(200, {})
+
+    def do_POST(self):
+        body = self._read_body()
+        path = self.path.split('?', 1)[0]
+        if path.endswith('/_bulk'):
+            return self._respond(200, self._bulk(body))
+        if path.endswith('/_forcemerge'):
+            return self._respond(200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}})
+        self._respond(200, {'acknowledged': True})
+
+    def do_PUT(self):
+        self._read_body()
+        self._respond(200, {'acknowledged': True})
+
+    def do_DELETE(self):
+        self._respond(200, {'acknowledged': True})
+
+
+class FakeElasticsearch:
+    # how often the server thread checks for `stop`; the default of 0.5s
+    # would hold up every test's teardown
+    poll_interval = 0.05
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), FakeElasticsearchHandler)
+        self.server.stats = {'bulk_requests': 0, 'bulk_items': 0}
+        self.server.stats_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def stats(self):
+        return self.server.stats
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': self.poll_interval}, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
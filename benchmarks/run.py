@@ -0,0 +1,161 @@
+"""
+Offline throughput benchmarks: docs/sec and peak RSS for serializing, bulk
+streaming and both indexing policies, against an in-memory data source and
+a local fake Elasticsearch (see `fake_es.py`).
+
+    python -m benchmarks.run                    # run everything
+    python -m benchmarks.run --shapes flat --stages serialize,streaming
+    python -m benchmarks.run --save-baseline    # record benchmarks/baseline.json
+    python -m benchmarks.run --compare          # fail on regressions vs the baseline
+
+Each case runs in its own subprocess so peak RSS is per case (for the
+parallel policy, that of the parent process only); the parallel case is run
+with ESDOCS_GEVENT=1.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+STAGES = ['serialize', 'bulk_stream', 'streaming', 'parallel']
+SHAPES = ['flat', 'nested', 'wide']
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return usage / (1024 * 1024) if sys.platform == 'darwin' else usage / 1024
+
+
+def run_case(stage, shape, size, url, procs):
+    from elasticsearch_dsl import connections
+
+    from .documents import SHAPES as serializers
+
+    connections.configure(default={'hosts': [url]})
+    serializer = serializers[shape]
+    serializer.size = size
+    serializer.rows()
+    client = connections.get_connection()
+    index = serializer.document._index._name
+
+    started = time.time()
+    if stage == 'serialize':
+        for row in serializer.rows():
+            serializer.serialize(row)
+    elif stage == 'bulk_stream':
+        for _ in serializer._bulk_stream(encoder=serializer.get_bulk_encoder()):
+            pass
+    elif stage == 'streaming':
+        from esdocs.policies import StreamingPolicy
+        StreamingPolicy().bulk_operation(serializer, index=index, client=client)
+    elif stage == 'parallel':
+        from esdocs.controller import Controller
+        from esdocs.policies import ParallelStreamingPolicy
+        policy = ParallelStreamingPolicy(Controller().parallel_prep)
+        policy.bulk_operation(serializer, index=index, client=client, multi=procs)
+        policy.close()
+    else:
+        raise ValueError("Unknown stage '{}'".format(stage))
+    elapsed = time.time() - started
+
+    return {
+        'stage': stage,
+        'shape': shape,
+        'docs': size,
+        'seconds': round(elapsed, 4),
+        'docs_per_sec': round(size / elapsed, 1) if elapsed else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def spawn_case(stage, shape, size, url, procs):
+    env = dict(os.environ)
+    if stage == 'parallel':
+        env['ESDOCS_GEVENT'] = '1'
+    cmd = [sys.executable, '-m', 'benchmarks.run', '--case', stage, shape,
+           '--size', str(size), '--url', url, '--procs', str(procs)]
+    output = subprocess.check_output(cmd, env=env, cwd=os.path.dirname(os.path.dirname(BASELINE_PATH)))
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if not previous or not previous.get('docs_per_sec') or not result.get('docs_per_sec'):
+            continue
+        change = result['docs_per_sec'] / previous['docs_per_sec'] - 1
+        flag = ''
+        if change < -tolerance:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        print('{:<22} {:>12.1f} -> {:>12.1f} docs/sec ({:+.1%}){}'.format(
+            key, previous['docs_per_sec'], result['docs_per_sec'], change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--shapes', default=','.join(SHAPES))
+    parser.add_argument('--size', type=int, default=20000, help="Documents per case")
+    parser.add_argument('--procs', type=int, default=2, help="Worker processes for the parallel stage")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed docs/sec drop vs the baseline before failing (fraction)")
+    # internal: run a single case in this process and print its result
+    parser.add_argument('--case', nargs=2, metavar=('STAGE', 'SHAPE'), help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        if args.case[0] == 'parallel':
+            # must happen before anything imports gevent/gipc-dependent code
+            import esdocs
+            esdocs.patch_gevent()
+        print(json.dumps(run_case(args.case[0], args.case[1], args.size, args.url, args.procs)))
+        return 0
+
+    from .fake_es import FakeElasticsearch
+
+    results = {}
+    with FakeElasticsearch() as es:
+        print('{:<22} {:>12} {:>12} {:>10}'.format('case', 'docs/sec', 'seconds', 'peak MB'))
+        for shape in args.shapes.split(','):
+            for stage in args.stages.split(','):
+                result = spawn_case(stage, shape, args.size, es.url, args.procs)
+                key = '{}/{}'.format(shape, stage)
+                results[key] = result
+                print('{:<22} {:>12.1f} {:>12.3f} {:>10.1f}'.format(
+                    key, result['docs_per_sec'] or 0, result['seconds'], result['peak_rss_mb']))
+        print('fake Elasticsearch received {bulk_items} items in {bulk_requests} bulk requests'.format(**es.stats))
+
+    status = 0
+    if args.compare:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print("No baseline at '{}'; run with --save-baseline first.".format(args.baseline))
+            baseline = {}
+        if compare(results, baseline.get('results', {}), args.tolerance):
+            status = 1
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'size': args.size, 'python': sys.version.split()[0], 'results': results},
+                      f, indent=2, sort_keys=True)
+        print("Saved baseline to '{}'.".format(args.baseline))
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,25 @@
 import os
+import sys
 use_gevent = str(os.getenv('ESDOCS_GEVENT', 0)).lower() not in ['0', '', 'false', 'f', 'no', 'n']
 
-if use_gevent:
+
+def _gevent_patched():
+    # without gevent imported, nothing can have been patched
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('socket') and monkey.is_module_patched('os')
+
+
+gevent_enabled = _gevent_patched()
+psycogreen_enabled = False
+
+
+def patch_gevent():
+    # monkey-patches the process for gevent/gipc multi-process indexing (and
+    # psycopg, if psycogreen is installed); best done before anything else
+    # is imported. The `esdocs` command does so for `--multi` when
+    # ESDOCS_GEVENT is set
+    global gevent_enabled, psycogreen_enabled
+
     try:
         from gevent import monkey
         monkey.patch_all()
@@ -11,17 +29,13 @@ if use_gevent:
     try:
         import psycogreen.gevent
         psycogreen.gevent.patch_psycopg()
+        psycogreen_enabled = True
     except ImportError:
-        pass
+        psycogreen_enabled = False
+
+    gevent_enabled = _gevent_patched()
+    return gevent_enabled
 
-try:
-    import gevent.monkey
-    if gevent.monkey.is_module_patched('socket') and gevent.monkey.is_module_patched('os'):
-        gevent_enabled = True
-    else:
-        gevent_enabled = False
-except:
-    gevent_enabled = False
 
 import logging
 
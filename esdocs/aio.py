@@ -0,0 +1,318 @@
+"""
+Indexing on an asyncio event loop with an `AsyncElasticsearch` client
+(`esdocs rebuild --async`, requires elasticsearch[async]). Nothing else in
+esdocs imports this module, so the rest of the package doesn't depend on
+asyncio.
+
+The functions here are the async counterparts of the serializer's
+`index_add`, `index_delete`, `bulk_operation` etc., taking the serializer
+as their first argument.
+"""
+import asyncio
+import inspect
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import TransportError
+
+from .bulk import ChunkBuilder, backoff_delay, split_bulk_response
+from .encoding import ClientEncoder
+from .policies import BaseIndexingPolicy, StreamingPolicy
+from .progress import ProgressReporter
+from .stats import stats
+
+logger = logging.getLogger(__name__)
+
+
+async def gather_or_cancel(aws):
+    # like `asyncio.gather`, but if one fails the others are cancelled
+    # rather than left running
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+# `obj` is serialized on the loop, so anything it lazily loads (eg. Django
+# relations) should already be loaded. `client` defaults to the serializer's
+# `async_client`
+
+async def index_add_or_delete(serializer, obj, client=None):
+    if not await index_add(serializer, obj, client):
+        await index_delete(serializer, obj, client)
+
+
+async def index_add(serializer, obj, client=None):
+    if serializer.should_index(obj, client):
+        data = serializer.serialize(obj)
+        _id, params = serializer._index_params(obj)
+        await (client or serializer.async_client).index(
+            serializer.document._default_index(), data, id=_id, params=params)
+        return True
+    return False
+
+
+async def index_delete(serializer, obj, client=None):
+    _id, params = serializer._index_params(obj)
+    await (client or serializer.async_client).delete(
+        serializer.document._default_index(), id=_id, params=params, ignore=[404])
+
+
+async def bulk_stream(serializer, op_type=None, encoder=None, **options):
+    # yields the serializer's actions (dicts, or `EncodedAction`s given an
+    # `encoder`). An async generator `fetch_data` is iterated on the event
+    # loop; a synchronous one is fetched, prepared and serialized a batch at
+    # a time in a thread of its own (eg. Django's ORM can't be used on the
+    # loop), which is closed with `close_fetch_thread` when done
+    op_type = op_type if op_type else 'index'
+    fetch = serializer.fetch_changed_data if options.get('since') is not None else serializer.fetch_data
+
+    if inspect.isasyncgenfunction(fetch):
+        batch = []
+        async for obj in fetch(**options):
+            batch.append(obj)
+            if len(batch) >= serializer.serialize_batch_size:
+                for action in serializer._batch_actions(batch, op_type, encoder):
+                    yield action
+                batch = []
+        if batch:
+            for action in serializer._batch_actions(batch, op_type, encoder):
+                yield action
+        return
+
+    stream = serializer._bulk_stream(op_type, encoder=encoder, **options)
+
+    def close():
+        stream.close()
+        serializer.close_fetch_thread()
+
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            actions = await loop.run_in_executor(
+                executor, list, itertools.islice(stream, serializer.serialize_batch_size))
+            if not actions:
+                break
+            for action in actions:
+                yield action
+    finally:
+        # (not awaited; the generator may be being closed)
+        executor.submit(close).result()
+        executor.shutdown()
+
+
+async def _filter_digests(digests, index, actions, skip=True):
+    async for action in actions:
+        for action in digests.filter(index, [action], skip=skip):
+            yield action
+
+
+async def bulk_operation(serializer, index=None, client=None, progress=None, concurrency=None, **options):
+    # the counterpart of `Serializer.bulk_operation`: the same encoder,
+    # adaptive bulk sizing and digest cache
+    index = index or serializer.document._default_index()
+    encoder = serializer.get_bulk_encoder()
+    actions = bulk_stream(serializer, encoder=encoder, **options)
+    dead_letter = serializer.get_dead_letter(**options)
+
+    digests = serializer.get_digest_store(**options)
+    if digests is None:
+        return await bulk_send(
+            serializer, actions, index=index, client=client, encoder=encoder, concurrency=concurrency,
+            progress=progress, dead_letter=dead_letter)
+
+    digest_index = options.get('digest_index') or index
+    actions = _filter_digests(digests, digest_index, actions, skip=not options.get('digest_refresh'))
+    try:
+        result = await bulk_send(
+            serializer, actions, index=index, client=client, encoder=encoder, concurrency=concurrency,
+            progress=progress, dead_letter=dead_letter, digests=digests, digest_index=digest_index)
+    finally:
+        digests.commit()
+
+    hits, misses = digests.reset_counts()
+    logger.info("   '{}': {} unchanged documents skipped, {} sent".format(serializer.document.__name__, hits, misses))
+    return result
+
+
+async def send_chunk(client, chunk, index, sizer, label=None, max_retries=5, initial_backoff=1, max_backoff=60):
+    # the counterpart of `esdocs.bulk.send_chunk`; returns the `(ok, item)`
+    # results rather than yielding them
+    results = []
+    attempt = 0
+    while chunk:
+        body = b''.join(lines for lines, raw in chunk)
+        started = time.time()
+        try:
+            response = await client.bulk(body, index=index)
+        except TransportError as e:
+            if e.status_code != 429 or attempt >= max_retries:
+                raise
+            sizer.record(len(chunk), time.time() - started, rejected=len(chunk))
+            await asyncio.sleep(backoff_delay(attempt, initial_backoff, max_backoff))
+            attempt += 1
+            continue
+        elapsed = time.time() - started
+        if stats.enabled:
+            stats.add(label, 'bulk_request', elapsed, len(chunk))
+
+        chunk_results, retry = split_bulk_response(chunk, response, attempt < max_retries)
+        results.extend(chunk_results)
+        sizer.record(len(chunk), elapsed, rejected=len(retry))
+
+        chunk = retry
+        if chunk:
+            await asyncio.sleep(backoff_delay(attempt, initial_backoff, max_backoff))
+            attempt += 1
+    return results
+
+
+async def bulk_send(serializer, actions, index=None, client=None, encoder=None, concurrency=None, progress=None,
+                    dead_letter=None, digests=None, digest_index=None):
+    # sends the (async or sync) iterable of actions in chunks sized by the
+    # serializer's `AdaptiveBulkSizer`, with `concurrency` (by default
+    # `data_bulk_concurrency`, at least 2) bulk requests in flight at once;
+    # returns the number of successful and failed actions, as
+    # `Serializer.bulk_send` does
+    index = index or serializer.document._default_index()
+    client = client or serializer.async_client
+    encoder = encoder or serializer.get_bulk_encoder() or ClientEncoder(client.transport.serializer)
+    sizer = serializer.get_bulk_sizer()
+    label = serializer.__name__
+    concurrency = concurrency or max(2, serializer.data_bulk_concurrency)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    counts = [0, 0]
+    reported = [0, 0]
+
+    async def produce():
+        builder = ChunkBuilder(sizer, encoder, label)
+        if hasattr(actions, '__aiter__'):
+            async for action in actions:
+                chunk = builder.add(action)
+                if chunk:
+                    await queue.put(chunk)
+        else:
+            for action in actions:
+                chunk = builder.add(action)
+                if chunk:
+                    await queue.put(chunk)
+        chunk = builder.flush()
+        if chunk:
+            await queue.put(chunk)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def consume():
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                return
+            results = await send_chunk(
+                client, chunk, index, sizer, label, max_retries=serializer.data_bulk_max_retries)
+            for ok, result in results:
+                ok = serializer._bulk_result(ok, result, index, digests, digest_index, dead_letter)
+                counts[0 if ok else 1] += 1
+            if progress is not None and sum(counts) - sum(reported) >= serializer.progress_every:
+                progress(counts[0] - reported[0], counts[1] - reported[1])
+                reported[:] = counts
+
+    await gather_or_cancel([produce()] + [consume() for _ in range(concurrency)])
+
+    if progress is not None:
+        progress(counts[0] - reported[0], counts[1] - reported[1])
+    return counts[0], counts[1]
+
+
+class AsyncStreamingPolicy(BaseIndexingPolicy):
+    """
+    Indexes on an asyncio event loop with several bulk requests in flight at
+    once (see `bulk_send`), over an async generator `fetch_data` or a
+    synchronous one run in a thread. Use `abulk_operation` from async code;
+    `bulk_operation` runs it on an event loop of its own.
+
+    `client` is the `AsyncElasticsearch` client to use; if not given, one is
+    created (and closed) per bulk operation with the settings of the
+    `using` elasticsearch-dsl connection.
+    """
+    concurrency = None
+
+    def __init__(self, client=None, concurrency=None):
+        self.client = client
+        self.concurrency = concurrency or self.concurrency
+
+    @staticmethod
+    def create_client(using=None):
+        from elasticsearch import AsyncElasticsearch
+        from elasticsearch_dsl import connections
+
+        kwargs = connections.connections._kwargs.get(using or 'default')
+        if kwargs is None:
+            # added with `add_connection`; take its hosts at least
+            kwargs = {'hosts': connections.get_connection(using or 'default').transport.hosts}
+        return AsyncElasticsearch(**kwargs)
+
+    def bulk_operation(self, serializer, index, client, **options):
+        # `client` (a synchronous one) isn't used
+        async def run():
+            async_client = self.client or self.create_client(options.get('using'))
+            try:
+                return await self.abulk_operation(serializer, index, async_client, **options)
+            finally:
+                if async_client is not self.client:
+                    await async_client.close()
+
+        return asyncio.run(run())
+
+    async def abulk_operation(self, serializer, index, client=None, **options):
+        client = client or self.client
+        loop = asyncio.get_event_loop()
+
+        checkpoint = options.pop('checkpoint', None)
+        if checkpoint is not None and checkpoint.is_done(serializer):
+            logger.info("   '{}' already indexed; skipping.".format(serializer.document.__name__))
+            return 0, 0
+
+        # these may query the data source, which (eg. Django's ORM) may not
+        # be usable on the event loop
+        reporter = await loop.run_in_executor(None, ProgressReporter.from_options, serializer, index, options)
+        progress = reporter.update if reporter is not None else None
+
+        plan = None
+        if checkpoint is not None:
+            plan = await loop.run_in_executor(
+                None, self.chunk_plan, serializer, StreamingPolicy.checkpoint_chunks, 0, options, checkpoint)
+
+        if plan is None:
+            result = await bulk_operation(
+                serializer, index=index, client=client, progress=progress, concurrency=self.concurrency, **options)
+        else:
+            # chunks are small; rather than several bulk requests per chunk,
+            # several chunks are indexed at once, with one each
+            semaphore = asyncio.Semaphore(self.concurrency or max(2, serializer.data_bulk_concurrency))
+
+            async def index_chunk(chunk_options):
+                async with semaphore:
+                    counts = await bulk_operation(
+                        serializer, index=index, client=client, progress=progress, concurrency=1, **chunk_options)
+                checkpoint.complete_chunks(serializer, [chunk_options['parallel_chunk_num']])
+                return counts
+
+            completed = checkpoint.completed_chunks(serializer)
+            results = await gather_or_cancel([
+                index_chunk(chunk_options)
+                for _, _, chunk_options in self.chunk_params(serializer, index, plan, options, skip=completed)
+            ])
+            result = sum(ok for ok, failed in results), sum(failed for ok, failed in results)
+
+        if checkpoint is not None:
+            checkpoint.mark_done(serializer)
+        if reporter is not None:
+            reporter.finish()
+        return result
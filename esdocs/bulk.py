@@ -0,0 +1,222 @@
+import logging
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import TransportError
+from elasticsearch.helpers import expand_action
+
+from .encoding import ClientEncoder, EncodedAction
+from .stats import stats
+
+logger = logging.getLogger(__name__)
+
+REJECTED_ERROR_TYPE = 'es_rejected_execution_exception'
+
+
+def _is_rejected(item):
+    error = item.get('error')
+    return item.get('status') == 429 or (isinstance(error, dict) and error.get('type') == REJECTED_ERROR_TYPE)
+
+
+class AdaptiveBulkSizer:
+    """
+    Decides how many documents go into the next bulk request. Batches are
+    capped by document count and by encoded size; the count grows while bulk
+    requests come back well under `target_latency` seconds and shrinks when
+    they are slow or when Elasticsearch rejects items (429).
+    """
+    grow_factor = 1.25
+    shrink_factor = 0.75
+    reject_factor = 0.5
+
+    def __init__(self, initial=500, min_docs=10, max_docs=None, max_bytes=10 * 1024 * 1024,
+                 target_latency=2.0, adaptive=True):
+        self.docs = initial
+        self.min_docs = min(min_docs, initial)
+        self.max_docs = max_docs or initial * 10
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.adaptive = adaptive
+
+    def record(self, docs, elapsed, rejected=0):
+        if not self.adaptive:
+            return
+
+        size = self.docs
+        if rejected:
+            size = size * self.reject_factor
+        elif elapsed > self.target_latency * 1.5:
+            size = size * self.shrink_factor
+        elif elapsed < self.target_latency * 0.5 and docs >= self.docs:
+            # only grow when the batch was actually full; a short tail batch
+            # says nothing about how big batches could be
+            size = size * self.grow_factor
+
+        size = int(max(self.min_docs, min(self.max_docs, size)))
+        if size != self.docs:
+            logger.debug("Bulk size {} -> {} documents ({} in {:.2f}s, {} rejected)".format(
+                self.docs, size, docs, elapsed, rejected))
+        self.docs = size
+
+
+def encode_action(raw, encoder):
+    # returns the NDJSON line(s) for one bulk action
+    if isinstance(raw, EncodedAction):
+        return raw.data
+
+    action, data = expand_action(raw)
+    lines = encoder.dumps(action) + b'\n'
+    if data is not None:
+        lines += encoder.dumps(data) + b'\n'
+    return lines
+
+
+class ChunkBuilder:
+    """
+    Collects (encoded lines, raw action) tuples into chunks sized by the
+    sizer's current document count and byte cap; `add` returns the chunk to
+    send once the next action doesn't fit, and `flush` the last one.
+    """
+    def __init__(self, sizer, encoder, label=None):
+        self.sizer = sizer
+        self.encoder = encoder
+        self.label = label
+        self.chunk = []
+        self.chunk_bytes = 0
+
+    def add(self, raw):
+        if stats.enabled and not isinstance(raw, EncodedAction):
+            started = time.perf_counter()
+            lines = encode_action(raw, self.encoder)
+            stats.add(self.label, 'encode', time.perf_counter() - started)
+        else:
+            lines = encode_action(raw, self.encoder)
+        size = len(lines)
+
+        full = None
+        if self.chunk and (len(self.chunk) >= self.sizer.docs or self.chunk_bytes + size > self.sizer.max_bytes):
+            full = self.flush()
+
+        self.chunk.append((lines, raw))
+        self.chunk_bytes += size
+        return full
+
+    def flush(self):
+        chunk, self.chunk, self.chunk_bytes = self.chunk, [], 0
+        return chunk or None
+
+
+def _chunk_actions(actions, sizer, encoder, label=None):
+    # yields lists of (encoded lines, raw action) tuples; see `ChunkBuilder`
+    builder = ChunkBuilder(sizer, encoder, label)
+    for raw in actions:
+        chunk = builder.add(raw)
+        if chunk:
+            yield chunk
+
+    chunk = builder.flush()
+    if chunk:
+        yield chunk
+
+
+def backoff_delay(attempt, initial_backoff, max_backoff):
+    # exponential backoff with jitter, so parallel workers don't retry in lockstep
+    delay = min(max_backoff, initial_backoff * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.5)
+
+
+def _backoff(attempt, initial_backoff, max_backoff):
+    time.sleep(backoff_delay(attempt, initial_backoff, max_backoff))
+
+
+def split_bulk_response(chunk, response, retry_rejected=True):
+    # returns `(ok, item)` for each action of `chunk` answered in the bulk
+    # `response`, and the chunk entries rejected (429) to retry, if allowed
+    results = []
+    retry = []
+    for (lines, raw), item in zip(chunk, response['items']):
+        op_type, info = item.popitem()
+        if retry_rejected and _is_rejected(info):
+            retry.append((lines, raw))
+            continue
+        results.append((200 <= info.get('status', 500) < 300, {op_type: info}))
+    return results, retry
+
+
+def send_chunk(client, chunk, index, sizer, label=None, max_retries=5, initial_backoff=1, max_backoff=60):
+    """
+    Sends one bulk request for `chunk`, retrying rejected items (or the whole
+    request on HTTP 429) with jittered exponential backoff. Yields `(ok, item)`
+    per action, like `elasticsearch.helpers.streaming_bulk`.
+    """
+    attempt = 0
+    while chunk:
+        body = b''.join(lines for lines, raw in chunk)
+        started = time.time()
+        try:
+            response = client.bulk(body, index=index)
+        except TransportError as e:
+            if e.status_code != 429 or attempt >= max_retries:
+                raise
+            sizer.record(len(chunk), time.time() - started, rejected=len(chunk))
+            _backoff(attempt, initial_backoff, max_backoff)
+            attempt += 1
+            continue
+        elapsed = time.time() - started
+        if stats.enabled:
+            stats.add(label, 'bulk_request', elapsed, len(chunk))
+
+        results, retry = split_bulk_response(chunk, response, attempt < max_retries)
+        for result in results:
+            yield result
+
+        sizer.record(len(chunk), elapsed, rejected=len(retry))
+
+        chunk = retry
+        if chunk:
+            _backoff(attempt, initial_backoff, max_backoff)
+            attempt += 1
+
+
+def adaptive_streaming_bulk(client, actions, index=None, sizer=None, encoder=None, label=None, **kwargs):
+    """
+    Drop-in for `streaming_bulk(..., raise_on_error=False, yield_ok=True)`
+    whose batches are sized by an `AdaptiveBulkSizer`. Actions are dicts or
+    `EncodedAction`s; dicts are encoded with `encoder` (by default the
+    client's own serializer).
+    """
+    sizer = sizer or AdaptiveBulkSizer()
+    encoder = encoder or ClientEncoder(client.transport.serializer)
+    for chunk in _chunk_actions(actions, sizer, encoder, label):
+        for result in send_chunk(client, chunk, index, sizer, label, **kwargs):
+            yield result
+
+
+def pipelined_streaming_bulk(client, actions, index=None, sizer=None, encoder=None, label=None, concurrency=2,
+                             depth=None, **kwargs):
+    """
+    Like `adaptive_streaming_bulk`, but sends up to `concurrency` bulk requests
+    at once from a thread pool (green threads when gevent has patched the
+    process) while the calling thread keeps serializing up to `depth` chunks
+    ahead. Results are yielded in the order the actions were given.
+    """
+    sizer = sizer or AdaptiveBulkSizer()
+    encoder = encoder or ClientEncoder(client.transport.serializer)
+    depth = max(depth or concurrency * 2, concurrency)
+
+    def send(chunk):
+        return list(send_chunk(client, chunk, index, sizer, label, **kwargs))
+
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for chunk in _chunk_actions(actions, sizer, encoder, label):
+            if len(in_flight) >= depth:
+                for result in in_flight.popleft().result():
+                    yield result
+            in_flight.append(executor.submit(send, chunk))
+
+        while in_flight:
+            for result in in_flight.popleft().result():
+                yield result
@@ -0,0 +1,39 @@
+import logging
+
+import django
+from django.db import connections
+
+from ...controller import Controller
+from .signals import post_index_created, post_index_rebuilt
+
+logger = logging.getLogger(__name__)
+
+
+class DjangoController(Controller):
+    def on_index_created(self, name, alias, index, alias_set):
+        post_index_created.send(None, name=name, alias=alias, index=index, alias_set=alias_set)
+
+    def on_index_rebuilt(self, name, alias, index, alias_set):
+        post_index_rebuilt.send(None, name=name, alias=alias, index=index, alias_set=alias_set)
+
+    def parallel_prep(self):
+        # this method is only used when doing parallel bulk indexing
+        # (see policies.py)
+        from ... import gevent_enabled, psycogreen_enabled
+
+        # Django connections need to be closed when a new process is
+        # forked (will be auto re-opened)
+        connections.close_all()
+
+        postgresql = any(connections[alias].vendor == 'postgresql' for alias in connections)
+        if gevent_enabled and not psycogreen_enabled and postgresql:
+            logger.warning("psycogreen is not installed; PostgreSQL queries (and cursor streaming) will block "
+                           "the other green threads of each worker (pip install psycogreen).")
+
+        super().parallel_prep()
+
+    @classmethod
+    def worker_setup(cls):
+        # process pool workers start without Django; setting it up also
+        # registers the serializers and compatibility hooks (see apps.py)
+        django.setup()
@@ -0,0 +1,90 @@
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class IndexingQueue(threading.local):
+    """
+    Buffers signal-driven index updates per database transaction and sends
+    them with one bulk request per serializer once the transaction commits.
+
+    Repeated saves of the same object are collapsed into a single entry; at
+    flush time rows are re-read from the database in bulk, so whatever state
+    was committed is what gets indexed (or deleted, if `should_index()` says
+    so). The `_id`/routing are captured when the signal fires, for deletes
+    (the row is gone by then) and for saved rows that `get_queryset()` doesn't
+    return; those are indexed from the saved instance (or deleted), as
+    `index_add_or_delete()` would.
+    """
+    def __init__(self):
+        # db alias -> (batch, flush callback registered with `on_commit`)
+        self.batches = {}
+
+    def add(self, serializer, instance, op, using=None):
+        using = using or DEFAULT_DB_ALIAS
+        connection = transaction.get_connection(using)
+
+        entry = (op, instance, serializer.bulk_action(instance, 'delete'))
+        key = (serializer, instance.pk)
+        if not connection.in_atomic_block:
+            # autocommit; the change is already committed
+            self.flush(OrderedDict([(key, entry)]))
+            return
+
+        batch = self._get_batch(using, connection)
+        batch.pop(key, None)
+        batch[key] = entry
+
+    def _get_batch(self, using, connection):
+        batch, callback = self.batches.get(using, (None, None))
+
+        # Django drops the callback when the transaction is rolled back; if so
+        # (or there's no batch yet), start afresh
+        if batch is not None and any(entry[1] is callback for entry in connection.run_on_commit):
+            return batch
+
+        batch = OrderedDict()
+
+        def callback():
+            if self.batches.get(using, (None, None))[0] is batch:
+                del self.batches[using]
+            self.flush(batch)
+
+        self.batches[using] = (batch, callback)
+        transaction.on_commit(callback, using=using)
+        return batch
+
+    def flush(self, batch):
+        by_serializer = defaultdict(OrderedDict)
+        for (serializer, pk), entry in batch.items():
+            by_serializer[serializer][pk] = entry
+
+        for serializer, entries in by_serializer.items():
+            existing = {
+                obj.pk: obj for obj in serializer.get_queryset().filter(pk__in=list(entries.keys()))
+            }
+
+            actions = []
+            for pk, (op, instance, delete_action) in entries.items():
+                obj = existing.get(pk)
+                if obj is not None:
+                    actions.append(serializer.bulk_action(obj))
+                elif op == 'delete':
+                    actions.append(delete_action)
+                elif serializer.should_index(instance):
+                    # saved, but filtered out of `get_queryset()`
+                    actions.append(serializer.bulk_action(instance))
+                else:
+                    actions.append(delete_action)
+
+            if actions:
+                logger.debug("Flushing {} queued '{}' index updates".format(
+                    len(actions), serializer.document.__name__))
+                serializer.bulk_send(actions)
+
+
+indexing_queue = IndexingQueue()
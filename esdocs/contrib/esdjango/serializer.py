@@ -1,11 +1,233 @@
+import itertools
+import logging
+
+import django
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db import connections
+from django.db.models import ForeignObjectRel, Max, Min, Prefetch, prefetch_related_objects
+from django.utils import timezone
+
 from ...serializer import Serializer
+from .indexing import indexing_queue
+
+logger = logging.getLogger(__name__)
+
+
+def _get_relation(model, name):
+    # the relation (forward or reverse) reached through attribute `name` of
+    # `model` instances, if any
+    opts = model._meta
+    try:
+        field = opts.get_field(name)
+    except FieldDoesNotExist:
+        field = None
+    if isinstance(field, ForeignObjectRel) and field.get_accessor_name() != name:
+        # a reverse relation's query name isn't an attribute (eg. 'comment'
+        # rather than 'comment_set')
+        field = None
+    if field is None:
+        field = next((rel for rel in opts.related_objects if rel.get_accessor_name() == name), None)
+    if field is None or not field.is_relation:
+        return None
+    return field
+
+
+def derive_prefetch_related(serializer, model, prefix=''):
+    """
+    Returns the relation lookups (relative to `model`) along the paths that
+    `serializer`'s Document fields are mapped to; inner doc fields are
+    followed into their own serializers. Fields with `serialize_<field>` or
+    `get_<field>_value` methods are opaque and skipped.
+    """
+    lookups = []
+    for name, field in serializer.document._doc_type.mapping.properties.properties.to_dict().items():
+        if hasattr(serializer, 'serialize_{}'.format(name)) or hasattr(serializer, 'get_{}_value'.format(name)):
+            continue
+
+        related_model = model
+        path = []
+        for part in (serializer.map_fields.get(name) or name).split('.'):
+            if part == 'all' and path:
+                # eg. 'comments.all'; the related manager's queryset
+                continue
+            relation = _get_relation(related_model, part)
+            if relation is None:
+                break
+            path.append(part)
+            lookups.append(prefix + '__'.join(path))
+            related_model = relation.related_model
+            if related_model is None:
+                # eg. a GenericForeignKey; can't look any further
+                break
+        else:
+            inner = serializer.registry.get(getattr(field, '_doc_class', None))
+            if path and related_model is not None and inner is not None:
+                lookups.extend(derive_prefetch_related(inner, related_model, prefix + '__'.join(path) + '__'))
+
+    return lookups
+
+
+class _ValuesUnsupported(Exception):
+    pass
+
+
+def _resolve_values_path(model, parts):
+    # follows a `map_fields` path through concrete fields and forward to-one
+    # relations; returns the path, the relations along it and, if the path
+    # ends on a relation, its model
+    path = []
+    relations = []
+    for n, part in enumerate(parts, start=1):
+        last = n == len(parts)
+        opts = model._meta
+        if part == 'pk' and last:
+            path.append(part)
+            return path, relations, None
+
+        try:
+            field = opts.get_field(part)
+        except FieldDoesNotExist:
+            # eg. 'author_id'
+            field = next((f for f in opts.concrete_fields if f.attname == part), None)
+            if field is None:
+                raise _ValuesUnsupported("'{}' is not a model field".format('.'.join(parts)))
+            path.append(part)
+            if not last:
+                raise _ValuesUnsupported("can't look into '{}'".format('.'.join(parts)))
+            return path, relations, None
+
+        if not getattr(field, 'concrete', False) or field.many_to_many or field.one_to_many:
+            raise _ValuesUnsupported("'{}' is not a column or to-one relation".format('.'.join(parts)))
+
+        path.append(part)
+        if field.is_relation:
+            if field.related_model is None:
+                raise _ValuesUnsupported("'{}' is a generic relation".format('.'.join(parts)))
+            relations.append(tuple(path))
+            model = field.related_model
+        elif not last:
+            raise _ValuesUnsupported("can't look into '{}'".format('.'.join(parts)))
+        else:
+            return path, relations, None
+
+    return path, relations, model
+
+
+def derive_values_fields(serializer, model, prefix=(), meta=False):
+    """
+    Returns the `values()` columns (relative to `model`) that `serializer`
+    reads, following inner docs mapped to to-one relations, and the
+    relations along the way. Raises `_ValuesUnsupported` if anything needs
+    a model instance: `serialize_<field>`/`get_<field>_value`/
+    `get_meta_<name>_value` methods, custom `get_value`/`should_index`/
+    `prepare_batch`, properties or to-many relations.
+    """
+    if serializer.get_value.__func__ is not Serializer.get_value.__func__:
+        raise _ValuesUnsupported("'{}' has a custom get_value()".format(serializer.__name__))
+
+    columns = []
+    relations = []
+    for name, field in serializer.document._doc_type.mapping.properties.properties.to_dict().items():
+        for method in ('serialize_{}'.format(name), 'get_{}_value'.format(name)):
+            if hasattr(serializer, method):
+                raise _ValuesUnsupported("'{}' has a {}() method".format(serializer.__name__, method))
+
+        path, path_relations, related_model = _resolve_values_path(
+            model, (serializer.map_fields.get(name) or name).split('.'))
+        relations.extend(prefix + relation for relation in path_relations)
+
+        if related_model is None:
+            columns.append('__'.join(prefix + tuple(path)))
+            continue
+
+        inner = serializer.registry.get(getattr(field, '_doc_class', None))
+        if inner is None:
+            raise _ValuesUnsupported("'{}' maps to a relation rather than a column".format(name))
+        inner_columns, inner_relations = derive_values_fields(inner, related_model, prefix + tuple(path))
+        columns.extend(inner_columns)
+        relations.extend(inner_relations)
+
+    if meta:
+        if serializer.should_index.__func__ is not Serializer.should_index.__func__:
+            raise _ValuesUnsupported("'{}' has a custom should_index()".format(serializer.__name__))
+        # `prepare_batch` is handed the fetched objects, which would be dicts
+        if serializer.prepare_batch.__func__ is not Serializer.prepare_batch.__func__:
+            raise _ValuesUnsupported("'{}' has a custom prepare_batch()".format(serializer.__name__))
+        for name in ('id', 'routing'):
+            if hasattr(serializer, 'get_meta_{}_value'.format(name)):
+                raise _ValuesUnsupported("'{}' has a get_meta_{}_value() method".format(serializer.__name__, name))
+            lookup = getattr(serializer, 'map_{}'.format(name), None)
+            if lookup:
+                path, path_relations, related_model = _resolve_values_path(model, lookup.split('.'))
+                if related_model is not None:
+                    path.append('pk')
+                columns.append('__'.join(path))
+                relations.extend(path_relations)
+
+    # the primary key of every relation tells a null relation from one whose
+    # columns are all null
+    columns.extend('__'.join(relation + ('pk', )) for relation in relations)
+    return list(dict.fromkeys(columns)), list(dict.fromkeys(relations))
+
+
+def _values_row_builder(columns, relations):
+    # turns flat `values()` rows ({'author__name': ...}) into nested dicts
+    # ({'author': {'name': ...}}), with null relations as `None`
+    nested = [(column, column.split('__')) for column in columns if '__' in column]
+    if not nested:
+        return None
+    relations = sorted(relations, key=len)
+
+    def build(row):
+        for column, parts in nested:
+            value = row.pop(column)
+            d = row
+            for part in parts[:-1]:
+                d = d.setdefault(part, {})
+            d[parts[-1]] = value
+
+        for relation in relations:
+            d = row
+            for part in relation[:-1]:
+                d = d.get(part)
+                if d is None:
+                    break
+            else:
+                if d[relation[-1]]['pk'] is None:
+                    d[relation[-1]] = None
+        return row
+
+    return build
 
 
 class DjangoSerializer(Serializer):
     model = None
     queryset_ordering = 'pk'
     queryset_select_related = []
+    # lookups (or `Prefetch` objects) passed to `prefetch_related()`
+    queryset_prefetch_related = []
+    # also prefetch the relations that the Document's fields (and their
+    # inner docs) are mapped to, so that every page of rows resolves them
+    # in a fixed number of queries rather than one per row
+    queryset_auto_prefetch = True
     queryset_chunk_size = 500
+    # 'keyset', 'offset', 'cursor' or None; None uses keyset pagination
+    # whenever `queryset_ordering` is a unique, non-null column and offsets
+    # otherwise. 'cursor' streams each fetch (or parallel chunk) through a
+    # single query, using a server-side cursor on PostgreSQL
+    queryset_pagination = None
+    # name of a timestamp field (eg. 'updated_at') bumped on every change;
+    # required for delta indexing via `fetch_changed_data`
+    queryset_updated_field = None
+    # when True, `save_handler`/`delete_handler` queue updates and send them
+    # in bulk once the surrounding transaction commits (so not at all inside
+    # a Django `TestCase`, whose transactions are never committed)
+    signal_batching = False
+    # 'model' or 'values'; 'values' fetches only the columns the Document is
+    # mapped to, as (nested) dicts rather than model instances. Serializers
+    # that need instances (see `derive_values_fields`) keep fetching models
+    fetch_mode = 'model'
 
     @classmethod
     def get_queryset(cls, for_count=False, coerce=False):
@@ -14,7 +236,47 @@ class DjangoSerializer(Serializer):
         qs = cls.model.objects.all()
         if for_count:
             return qs
-        return qs.select_related(*cls.queryset_select_related)
+        return qs.select_related(*cls.queryset_select_related).prefetch_related(*cls.get_prefetch_related())
+
+    @classmethod
+    def get_prefetch_related(cls):
+        lookups = list(cls.queryset_prefetch_related)
+        if not cls.queryset_auto_prefetch:
+            return lookups
+
+        # skip what is already joined in or explicitly prefetched
+        seen = set(cls.queryset_select_related)
+        seen.update(lookup.prefetch_to if isinstance(lookup, Prefetch) else lookup for lookup in lookups)
+        for lookup in derive_prefetch_related(cls, cls.model):
+            if lookup not in seen:
+                seen.add(lookup)
+                lookups.append(lookup)
+        return lookups
+
+    @classmethod
+    def get_values_plan(cls):
+        # the `values()` columns and row builder for `fetch_mode = 'values'`,
+        # or None to fetch model instances
+        if cls.fetch_mode != 'values':
+            return None
+
+        plan = cls.__dict__.get('_values_plan')
+        if plan is None:
+            try:
+                columns, relations = derive_values_fields(cls, cls.model, meta=True)
+            except _ValuesUnsupported as e:
+                logger.warning("'{}' can't use fetch_mode 'values' ({}); fetching model instances instead.".format(
+                    cls.__name__, e))
+                plan = False
+            else:
+                plan = (columns, _values_row_builder(columns, relations))
+            cls._values_plan = plan
+        return plan or None
+
+    @classmethod
+    def close_fetch_thread(cls):
+        # Django's database connections are per thread
+        connections.close_all()
 
     @classmethod
     def fetch_data_length(cls, **kwargs):
@@ -24,6 +286,75 @@ class DjangoSerializer(Serializer):
 
         return queryset.count()
 
+    @classmethod
+    def get_keyset_field(cls, queryset):
+        # keyset pagination needs a single, non-null, unique (and therefore
+        # indexed) concrete column to order by; returns the ordering name, the
+        # attribute holding its value on each row and whether it is descending
+        ordering = cls.queryset_ordering
+        if cls.queryset_pagination == 'offset' or not isinstance(ordering, str):
+            return None
+
+        name = ordering.lstrip('-')
+        if not name or '__' in name or name == '?':
+            return None
+
+        opts = queryset.model._meta
+        try:
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+        if not getattr(field, 'concrete', False) or not field.unique or field.null:
+            return None
+
+        return name, field.attname, ordering.startswith('-')
+
+    @classmethod
+    def fetch_data_partitions(cls, count, **kwargs):
+        queryset = kwargs.get('queryset')
+        if queryset is None:
+            queryset = cls.get_queryset(for_count=True)
+
+        keyset_field = cls.get_keyset_field(queryset)
+        if not keyset_field:
+            return None
+        name = keyset_field[0]
+
+        bounds = queryset.aggregate(lo=Min(name), hi=Max(name))
+        lo, hi = bounds['lo'], bounds['hi']
+        if lo is None:
+            return []
+
+        if isinstance(lo, int) and not isinstance(lo, bool):
+            # integer keys: split the min/max span evenly
+            span = hi - lo + 1
+            count = max(1, min(count, span))
+            boundaries = [lo - 1 + (span * n) // count for n in range(1, count)]
+        else:
+            # anything else (strings, UUIDs, ...): step from one quantile to
+            # the next through the key index (`WHERE key > previous ORDER BY
+            # key OFFSET step - 1 LIMIT 1`), leaving the database to skip the
+            # keys in between rather than fetching them
+            total = queryset.count()
+            count = max(1, min(count, total))
+            step = total // count
+            keys = queryset.order_by(name).values_list(name, flat=True)
+            boundaries = []
+            for n in range(1, count):
+                after = keys.filter(**{'{}__gt'.format(name): boundaries[-1]}) if boundaries else keys
+                key = after[step - 1:step].first()
+                if key is None:
+                    # rows deleted since counting
+                    break
+                boundaries.append(key)
+
+        # the outermost ranges are left open so rows added mid-rebuild are
+        # kept. Boundaries stay in the database's order; Python's may differ
+        # (collations), which would make ranges overlap or leave gaps
+        edges = [None] + list(dict.fromkeys(boundaries)) + [None]
+        return list(zip(edges[:-1], edges[1:]))
+
     @classmethod
     def fetch_data(cls, **kwargs):
         queryset = kwargs.get('queryset')
@@ -34,14 +365,143 @@ class DjangoSerializer(Serializer):
         if cls.queryset_ordering:
             queryset = queryset.order_by(cls.queryset_ordering)
 
+        keyset_field = cls.get_keyset_field(queryset)
+
         start = 0
         end = None
-        if 'parallel_chunk_num' in kwargs:
+        if 'parallel_range' in kwargs:
+            # a `(lo, hi]` key range from `fetch_data_partitions`
+            name = keyset_field[0]
+            lo, hi = kwargs['parallel_range']
+            if lo is not None:
+                queryset = queryset.filter(**{'{}__gt'.format(name): lo})
+            if hi is not None:
+                queryset = queryset.filter(**{'{}__lte'.format(name): hi})
+        elif 'parallel_chunk_num' in kwargs:
             parallel_chunk_num = kwargs.get('parallel_chunk_num')
             parallel_chunk_size = kwargs.get('parallel_chunk_size')
             start = parallel_chunk_num * parallel_chunk_size
             end = (parallel_chunk_num + 1) * parallel_chunk_size
 
+        build_row = None
+        values_plan = cls.get_values_plan()
+        if values_plan is not None:
+            columns, build_row = values_plan
+            if keyset_field and keyset_field[0] not in columns:
+                columns = columns + [keyset_field[0]]
+            queryset = queryset.prefetch_related(None).values(*columns)
+
+        if cls.queryset_pagination == 'cursor':
+            rows = cls._fetch_data_cursor(queryset, start, end)
+        elif keyset_field:
+            rows = cls._fetch_data_keyset(queryset, keyset_field, start, end)
+        elif cls.queryset_pagination == 'keyset':
+            raise ImproperlyConfigured(
+                "Keyset pagination requires 'queryset_ordering' to be a single unique, "
+                "non-null field; '{}' is not.".format(cls.queryset_ordering))
+        else:
+            rows = cls._fetch_data_offset(queryset, start, end)
+
+        if build_row is not None:
+            rows = map(build_row, rows)
+        yield from rows
+
+    @classmethod
+    def fetch_changed_data(cls, since, **kwargs):
+        if not cls.queryset_updated_field:
+            raise NotImplementedError("The 'queryset_updated_field' attribute is missing.")
+
+        queryset = kwargs.pop('queryset', None)
+        if queryset is None:
+            queryset = cls.get_queryset(for_count=False, coerce=kwargs.get('coerce', False))
+        if not settings.USE_TZ and timezone.is_aware(since):
+            # watermarks are in UTC; naive columns hold times in the current
+            # time zone
+            since = timezone.make_naive(since)
+        elif settings.USE_TZ and timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        queryset = queryset.filter(**{'{}__gt'.format(cls.queryset_updated_field): since})
+
+        return cls.fetch_data(queryset=queryset, **kwargs)
+
+    @classmethod
+    def fetch_data_by_ids(cls, ids, **kwargs):
+        # looks `_id`s up through `map_id` (the primary key if unset); override
+        # if ids come from a `get_meta_id_value` method instead
+        lookup = (getattr(cls, 'map_id', None) or 'pk').replace('.', '__')
+        queryset = kwargs.pop('queryset', None)
+        if queryset is None:
+            queryset = cls.get_queryset(for_count=False, coerce=kwargs.get('coerce', False))
+        queryset = queryset.filter(**{'{}__in'.format(lookup): ids})
+
+        return cls.fetch_data(queryset=queryset, **kwargs)
+
+    @classmethod
+    def _fetch_data_keyset(cls, queryset, keyset_field, start, end):
+        # iterates `WHERE <key> > last_key ORDER BY <key> LIMIT n`; only the first
+        # page uses an offset (`start`, non-zero for parallel chunks), so the
+        # cost per page stays constant however far into the table we are
+        name, attname, descending = keyset_field
+        lookup = '{}__{}'.format(name, 'lt' if descending else 'gt')
+
+        last = None
+        fetched = 0
+        while True:
+            size = cls.queryset_chunk_size
+            if end:
+                size = min(size, end - start - fetched)
+                if size <= 0:
+                    break
+
+            if last is None:
+                page = queryset[start: start + size]
+            else:
+                page = queryset.filter(**{lookup: last})[:size]
+
+            n = 0
+            for n, row in enumerate(page, start=1):
+                yield row
+
+            if n < size:
+                break
+            # `values()` rows are keyed by the ordering name
+            last = row[name] if type(row) is dict else getattr(row, attname)
+            fetched += n
+
+    @classmethod
+    def _fetch_data_cursor(cls, queryset, start, end):
+        # rows are fetched `queryset_chunk_size` at a time from one open
+        # cursor (server-side on PostgreSQL, client-side chunks elsewhere) and
+        # aren't cached by the queryset, so memory use stays flat. Prefetches
+        # are done per chunk of rows
+        if start or end:
+            queryset = queryset[start:end or None]
+
+        chunk_size = cls.queryset_chunk_size
+        if django.VERSION >= (4, 1):
+            # `iterator()` does the per chunk prefetching itself
+            yield from queryset.iterator(chunk_size=chunk_size)
+            return
+
+        # before Django 4.1, `iterator()` ignores `prefetch_related()`; the
+        # lookups are only reachable through the (private) queryset attribute
+        lookups = queryset._prefetch_related_lookups
+        if lookups:
+            queryset = queryset.prefetch_related(None)
+        rows = queryset.iterator(chunk_size=chunk_size)
+        if not lookups:
+            yield from rows
+            return
+
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            prefetch_related_objects(chunk, *lookups)
+            yield from chunk
+
+    @classmethod
+    def _fetch_data_offset(cls, queryset, start, end):
         chunk = 0
         while True:
             queryset_start = start + (chunk * cls.queryset_chunk_size)
@@ -62,8 +522,14 @@ class DjangoSerializer(Serializer):
 
     @classmethod
     def save_handler(cls, sender, instance, **kwargs):
-        cls.index_add_or_delete(instance)
+        if cls.signal_batching:
+            indexing_queue.add(cls, instance, 'index', using=kwargs.get('using'))
+        else:
+            cls.index_add_or_delete(instance)
 
     @classmethod
     def delete_handler(cls, sender, instance, **kwargs):
-        cls.index_delete(instance)
+        if cls.signal_batching:
+            indexing_queue.add(cls, instance, 'delete', using=kwargs.get('using'))
+        else:
+            cls.index_delete(instance)
@@ -1,12 +1,18 @@
 import datetime
 import logging
+import os
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import elasticsearch
 from elasticsearch_dsl import connections
 
-from .policies import StreamingPolicy, ParallelStreamingPolicy
+from . import state
+from .dumps import DumpWriter, read_actions, read_manifest, write_manifest
+from .encoding import get_encoder
+from .progress import ProgressReporter
 from .serializer import Serializer
+from .stats import stats
 
 logger = logging.getLogger(__name__)
 
@@ -15,18 +21,32 @@ class Controller:
     _indexes = None
     _new_indexes = None
     _serializers = defaultdict(list)
-    client = None
+    _client = None
+    # indexes of the serializer modules the `esdocs` command didn't import
+    # (see `register_serializers`); only listed
+    unloaded_indexes = ()
 
     def __init__(self, **options):
         self.no_input = options.pop('no_input', False)
+        self.state = state.StateFile(options.get('state_file'))
         self.using = options.get('using', '') or None
-        self.client = connections.get_connection(alias=self.using or 'default')
 
         _indexes = options.pop('indexes', '') or None
         if _indexes:
             _indexes = _indexes.split(',')
         self.index_names = _indexes
 
+    @property
+    def client(self):
+        # connected on first use; `list` doesn't need to
+        if self._client is None:
+            self._client = connections.get_connection(alias=self.using or 'default')
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
     def parallel_prep(self):
         # this is kind of a hack for elasticsearch connections to be
         # 'reset' with their existing settings kept intact
@@ -36,6 +56,26 @@ class Controller:
             # recreate the connection using the retained _kwargs (view the source)
             connections.get_connection(label)
 
+    @classmethod
+    def worker_setup(cls):
+        # called first in each process pool worker (a fresh interpreter, see
+        # ProcessPoolStreamingPolicy), before the serializer modules are imported
+        pass
+
+    def get_policy(self, **options):
+        # policies (and what they depend on) are only imported when needed
+        from . import gevent_enabled, policies
+
+        if options.get('multi') is not None:
+            if options.get('process_pool') or not gevent_enabled:
+                return policies.ProcessPoolStreamingPolicy(
+                    self.parallel_prep, self.worker_setup, start_method=options.get('process_pool'))
+            return policies.ParallelStreamingPolicy(self.parallel_prep)
+        if options.get('use_async'):
+            from .aio import AsyncStreamingPolicy
+            return AsyncStreamingPolicy()
+        return policies.StreamingPolicy()
+
     @property
     def indexes(self):
         if self._indexes is None:
@@ -90,6 +130,9 @@ class Controller:
             " (limited results due to --indexes option)" if self.index_names else ""))
         for name, index in self.indexes.items():
             logger.info(" - {}".format(name))
+        for name in self.unloaded_indexes:
+            if name not in self.indexes and (self.index_names is None or name in self.index_names):
+                logger.info(" - {}".format(name))
 
     def index_init(self, **options):
         for name, index in self.new_indexes.items():
@@ -109,55 +152,358 @@ class Controller:
                 except elasticsearch.exceptions.RequestError as e:
                     logger.info(str(e))
 
-    def index_rebuild(self, **options):
-        if options.get('multi') is not None:
-            policy = ParallelStreamingPolicy(self.parallel_prep)
-        else:
-            policy = StreamingPolicy()
+    def enable_stats(self, **options):
+        if options.get('stats') and not stats.enabled:
+            stats.enable()
+            # recompile serialize plans so that hooks are timed too
+            Serializer.reset_serialize_plans()
 
-        for name, index in self.new_indexes.items():
-            self._index_create(index, name, set_alias=False)
+    def report_stats(self, **options):
+        if not stats.enabled:
+            return
 
-            logger.info("Updating index settings to be bulk-indexing friendly...")
-            original_settings = index.get_settings(using=self.using).get(index._name, {}).get('settings', {})
-            index.put_settings(body={
-                "index.number_of_replicas": 0,
-                "index.refresh_interval": '10s'
-            })
+        logger.info("Indexing stage breakdown ('hooks' time is included in 'serialize'):")
+        for line in stats.report().splitlines():
+            logger.info(line)
+        # (`options['stats']` is just the --stats flag)
+        options.pop('stats', None)
+        self.export_stats(stats, **options)
+
+    def export_stats(self, stats, **options):
+        # override to ship the stats elsewhere; by default they are written to
+        # `--stats-file`, as Prometheus text if it ends in '.prom', else JSON
+        path = options.get('stats_file')
+        if not path:
+            return
 
-            logger.info("Indexing data for '{}'...".format(index._name))
+        with open(path, 'w') as f:
+            f.write(stats.to_prometheus() if path.endswith('.prom') else stats.to_json())
+        logger.info("Wrote indexing stats to '{}'.".format(path))
 
-            for serializer in self._serializers[name]:
-                logger.info(" - processing '{}' documents".format(serializer.document.__name__))
-                policy.bulk_operation(serializer, index=index._name, client=self.client, **options)
+    def report_failures(self, offset=0, **options):
+        # summarizes the failed documents recorded since `offset` (the size of
+        # the dead-letter file before the run)
+        dead_letter = Serializer.get_dead_letter(**options)
+        summary = dead_letter.summary(offset)
+        if not summary:
+            return
 
-            logger.info("Data indexed data for '{}'.".format(index._name))
+        logger.warning("{} documents failed and were recorded in '{}' (re-send them with `esdocs retry`):".format(
+            sum(summary.values()), dead_letter.path))
+        for (serializer, error), count in sorted(summary.items(), key=lambda item: (item[0][0], -item[1])):
+            logger.warning(" - {}: {} x {}".format(serializer, count, error))
+
+    def index_retry(self, **options):
+        # re-sends the documents recorded in the dead-letter file to the
+        # (aliased) indexes; those that fail again are recorded afresh
+        dead_letter = Serializer.get_dead_letter(**options)
+        records = dead_letter.take()
+        if not records:
+            logger.info("No failed documents recorded in '{}'.".format(dead_letter.path))
+            dead_letter.release()
+            return
 
-            logger.info("Force merging index data...")
-            index.forcemerge()
+        serializers = {serializer.qualified_name(): serializer for serializer in Serializer.registry.values()}
+        by_serializer = defaultdict(list)
+        kept = []
+        for record in records:
+            serializer = serializers.get(record['serializer'])
+            if serializer is None:
+                logger.warning("Unknown serializer '{}'; keeping its failed documents.".format(record['serializer']))
+                kept.append(record)
+            elif serializer.document._index._name not in self.indexes:
+                kept.append(record)
+            else:
+                by_serializer[serializer].append(record)
+        dead_letter.extend(kept)
+
+        offset = dead_letter.size()
+        for serializer, serializer_records in by_serializer.items():
+            name = serializer.document._index._name
+            logger.info("Retrying {} failed '{}' documents in '{}'...".format(
+                len(serializer_records), serializer.document.__name__, name))
+            try:
+                ok_count, failed_count = serializer.bulk_retry(
+                    serializer_records, index=name, client=self.client, **options)
+            except NotImplementedError:
+                logger.error(" - '{}' can't fetch documents by id (see `fetch_data_by_ids`); keeping them.".format(
+                    serializer.__name__))
+                dead_letter.extend(serializer_records)
+                continue
+            logger.info(" - {} sent, {} failed again".format(ok_count, failed_count))
+
+        dead_letter.release()
+        self.report_failures(offset, **options)
 
-            logger.info("Restoring original/default index settings...")
-            index.put_settings(body={
-                "index.number_of_replicas": original_settings.get('index', {}).get('number_of_replicas', 1),
-                "index.refresh_interval": original_settings.get('index', {}).get('refresh_interval', '1s')
-            })
+    def index_rebuild(self, **options):
+        self.enable_stats(**options)
+        failures_offset = Serializer.get_dead_letter(**options).size()
+        policy = self.get_policy(**options)
+
+        # with `concurrent`, each index is merged, restored and swapped in the
+        # background while the (shared) policy loads data for the next index;
+        # at most `concurrent` indexes are being rebuilt at any one time
+        concurrent = options.get('concurrent') or 0
+        executor = ThreadPoolExecutor(max_workers=concurrent) if concurrent > 0 else None
+        finalizing = []
+
+        # every rebuild is checkpointed (unless told not to), so that one
+        # interrupted part way through can be continued with `resume`
+        resume = options.pop('resume', False)
+        checkpointing = not options.pop('no_checkpoint', False)
+        digests = Serializer.get_digest_store(**options)
 
-            # remove alias from any pre-existing indexes and
-            # add it to the one new index
-            self.client.indices.update_aliases({
-                'actions': [
-                    {'remove': {'index': '*', 'alias': name}},
-                    {'add': {'index': index._name, 'alias': name}}
-                ]
-            })
-            logger.info("Created alias '{}' for '{}'.".format(name, index._name))
+        try:
+            for name, index in self.new_indexes.items():
+                if executor:
+                    while len(finalizing) >= concurrent:
+                        done, _ = wait(finalizing, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            finalizing.remove(future)
+                            future.result()
+
+                checkpoint = state.RebuildCheckpoint(self.state, name)
+                resumed = checkpoint.load() if resume else None
+                if resumed is not None and not self.client.indices.exists(resumed['index']):
+                    logger.warning("Index '{}' of the interrupted rebuild of '{}' no longer exists; "
+                                   "starting afresh.".format(resumed['index'], name))
+                    resumed = None
+
+                if resumed is None:
+                    stale = checkpoint.load()
+                    if stale is not None:
+                        # (never to be resumed into once this rebuild is done)
+                        logger.info("Discarding the checkpoint of an earlier, unfinished rebuild of '{}'.".format(name))
+                        checkpoint.finish()
+                        if digests is not None:
+                            digests.clear(stale['index'])
+                    original_settings = self._index_rebuild_prepare(name, index)
+                    if checkpointing:
+                        checkpoint.start(index._name, original_settings)
+                    else:
+                        checkpoint = None
+                else:
+                    index = self.indexes[name].clone(name=resumed['index'])
+                    original_settings = resumed['original_settings']
+                    logger.info("Resuming the rebuild of '{}' into '{}' (started {}).".format(
+                        name, index._name, resumed['started']))
+
+                if checkpoint is None:
+                    try:
+                        self._index_rebuild_load(policy, name, index, **options)
+                    except BaseException:
+                        # never to be swapped in
+                        if digests is not None:
+                            digests.clear(index._name)
+                        raise
+                elif not checkpoint.loaded:
+                    try:
+                        self._index_rebuild_load(
+                            policy, name, index, checkpoint=checkpoint, resumed=resumed is not None, **options)
+                    finally:
+                        # keep what was done, if interrupted
+                        checkpoint.save()
+                    checkpoint.mark_loaded()
+
+                if executor:
+                    finalizing.append(executor.submit(
+                        self._index_rebuild_finalize, name, index, original_settings, checkpoint, **options))
+                else:
+                    self._index_rebuild_finalize(name, index, original_settings, checkpoint, **options)
+        finally:
+            policy.close()
+            if executor:
+                executor.shutdown(wait=True)
+
+        for future in finalizing:
+            future.result()
+
+        self.report_stats(**options)
+        self.report_failures(failures_offset, **options)
+        self._indexes_delete(**options)
 
-            self.on_index_rebuilt(index._name, name, index, True)
+    def _index_rebuild_prepare(self, name, index):
+        self._index_create(index, name, set_alias=False)
+
+        logger.info("Updating index settings to be bulk-indexing friendly...")
+        original_settings = index.get_settings(using=self.using).get(index._name, {}).get('settings', {})
+        index.put_settings(body={
+            "index.number_of_replicas": 0,
+            "index.refresh_interval": '10s'
+        })
+        return original_settings
+
+    def _index_rebuild_load(self, policy, name, index, resumed=False, **options):
+        logger.info("Indexing data for '{}'...".format(index._name))
+
+        digests = Serializer.get_digest_store(**options)
+        if digests is not None:
+            # record digests of everything sent to the new index; they are
+            # moved onto the alias once it is swapped in (see
+            # `_index_rebuild_finalize`), so that later syncs can skip
+            # unchanged documents
+            if not resumed:
+                digests.clear(index._name)
+            options.update(digest_index=index._name, digest_refresh=True)
+
+        for serializer in self._serializers[name]:
+            logger.info(" - processing '{}' documents".format(serializer.document.__name__))
+            policy.bulk_operation(serializer, index=index._name, client=self.client, **options)
+
+        logger.info("Data indexed data for '{}'.".format(index._name))
+
+    def _index_rebuild_finalize(self, name, index, original_settings, checkpoint=None, **options):
+        logger.info("Force merging index data for '{}'...".format(index._name))
+        index.forcemerge()
+
+        logger.info("Restoring original/default index settings for '{}'...".format(index._name))
+        index.put_settings(body={
+            "index.number_of_replicas": original_settings.get('index', {}).get('number_of_replicas', 1),
+            "index.refresh_interval": original_settings.get('index', {}).get('refresh_interval', '1s')
+        })
+
+        # remove alias from any pre-existing indexes and
+        # add it to the one new index
+        self.client.indices.update_aliases({
+            'actions': [
+                {'remove': {'index': '*', 'alias': name}},
+                {'add': {'index': index._name, 'alias': name}}
+            ]
+        })
+        logger.info("Created alias '{}' for '{}'.".format(name, index._name))
+
+        # the alias' digests now describe the new index
+        digests = Serializer.get_digest_store(**options)
+        if digests is not None:
+            digests.move(index._name, name)
+
+        if checkpoint is not None:
+            checkpoint.finish()
+
+        self.on_index_rebuilt(index._name, name, index, True)
+
+    def index_sync(self, **options):
+        # streams only the data changed since a watermark into the live
+        # (aliased) indexes; the watermark is either `--since` or the one
+        # stored by the previous successful sync of each index
+        self.enable_stats(**options)
+        failures_offset = Serializer.get_dead_letter(**options).size()
+        policy = self.get_policy(**options)
+
+        since = options.pop('since', None)
+        if since:
+            since = state.parse_timestamp(since)
 
-        policy.close()
+        try:
+            for name, index in self.indexes.items():
+                index_since = since
+                if index_since is None:
+                    watermark = self.state.get('sync', name)
+                    if watermark is None:
+                        logger.warning("No sync watermark stored for '{}'; use --since. Skipping.".format(name))
+                        continue
+                    index_since = state.parse_timestamp(watermark)
+
+                # taken before fetching so that changes made during the sync
+                # are picked up again by the next one
+                started = state.now()
+
+                logger.info("Syncing data changed since {} for '{}'...".format(
+                    state.format_timestamp(index_since), name))
+                for serializer in self._serializers[name]:
+                    logger.info(" - processing '{}' documents".format(serializer.document.__name__))
+                    policy.bulk_operation(
+                        serializer, index=name, client=self.client, since=index_since, digest_index=name, **options)
+
+                self.state.set('sync', name, state.format_timestamp(started))
+                logger.info("Synced '{}'.".format(name))
+        finally:
+            policy.close()
+
+        self.report_stats(**options)
+        self.report_failures(failures_offset, **options)
+
+    def index_dump(self, **options):
+        # writes the bulk actions of every serializer to gzipped NDJSON bulk
+        # files (plus a manifest) that `index_load` can index elsewhere/later
+        path = options.pop('path')
+        split_size = int((options.pop('split_size', None) or 100) * 1024 * 1024)
+        os.makedirs(path, exist_ok=True)
+
+        manifest = {}
+        for name, index in self.indexes.items():
+            logger.info("Dumping data for '{}'...".format(name))
+            files = []
+            for serializer in self._serializers[name]:
+                logger.info(" - processing '{}' documents".format(serializer.document.__name__))
+                encoder = serializer.get_bulk_encoder() or get_encoder()
+                writer = DumpWriter(path, name, serializer, split_size=split_size)
+                try:
+                    for action in serializer._bulk_stream(encoder=encoder, **options):
+                        # a dump is loaded into a new, empty index
+                        if action.op_type != 'delete':
+                            writer.write(action)
+                finally:
+                    files.extend(writer.close())
+            manifest[name] = {'files': files, 'docs': sum(f['docs'] for f in files)}
+            logger.info("Dumped {} documents for '{}' into {} files.".format(manifest[name]['docs'], name, len(files)))
+
+        write_manifest(path, manifest)
+
+    def index_load(self, **options):
+        # indexes a dump (see `index_dump`) into new indexes, as `rebuild`
+        # would: bulk-friendly settings, force merge, restored settings and
+        # the alias swapped over
+        self.enable_stats(**options)
+        failures_offset = Serializer.get_dead_letter(**options).size()
+        path = options.pop('path')
+        manifest = read_manifest(path)
+        logger.info("Loading the dump taken at {}.".format(manifest['created']))
 
+        for name, index in self.new_indexes.items():
+            entry = manifest['indexes'].get(name)
+            if entry is None:
+                logger.info("No data for '{}' in the dump; skipping.".format(name))
+                continue
+
+            original_settings = self._index_rebuild_prepare(name, index)
+            self._index_load_files(name, index, path, entry, **options)
+            self._index_rebuild_finalize(name, index, original_settings, **options)
+
+        self.report_stats(**options)
+        self.report_failures(failures_offset, **options)
         self._indexes_delete(**options)
 
+    def _index_load_files(self, name, index, path, entry, **options):
+        logger.info("Indexing data for '{}'...".format(index._name))
+        serializers = {serializer.qualified_name(): serializer for serializer in self._serializers[name]}
+
+        for dump_file in entry['files']:
+            serializer = serializers.get(dump_file['serializer'])
+            if serializer is None:
+                logger.warning(" - unknown serializer '{}'; skipping '{}'".format(
+                    dump_file['serializer'], dump_file['path']))
+                continue
+
+            logger.info(" - loading {} '{}' documents from '{}'".format(
+                dump_file['docs'], serializer.document.__name__, dump_file['path']))
+            reporter = None
+            if options.get('progress_interval') is not None:
+                reporter = ProgressReporter(
+                    "{}/{}".format(index._name, dump_file['path']), total=dump_file['docs'],
+                    interval=options['progress_interval'], tty=options.get('progress_tty', False))
+            serializer.bulk_send(
+                read_actions(os.path.join(path, dump_file['path'])),
+                index=index._name,
+                client=self.client,
+                progress=reporter.update if reporter is not None else None,
+                dead_letter=serializer.get_dead_letter(**options)
+            )
+            if reporter is not None:
+                reporter.finish()
+
+        logger.info("Data indexed data for '{}'.".format(index._name))
+
     def index_cleanup(self, **options):
         options['delete_old_indexes'] = True
         self._indexes_delete(**options)
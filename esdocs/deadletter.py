@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+from collections import Counter, OrderedDict
+
+from .state import format_timestamp, now
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEAD_LETTER_FILE = '.esdocs-dead-letter.ndjson'
+
+
+class DeadLetterFile:
+    """
+    NDJSON file of the bulk actions Elasticsearch failed, one record per
+    failed item with the serializer, target index, operation, `_id` and
+    error, for `esdocs retry` to re-send. Records are appended with a single
+    write each, so parallel workers can share the file.
+    """
+    def __init__(self, path=None):
+        self.path = path or os.getenv('ESDOCS_DEAD_LETTER_FILE') or DEFAULT_DEAD_LETTER_FILE
+
+    def add(self, serializer, index, op_type, doc_id, result):
+        error = result.get('error')
+        record = OrderedDict([
+            ('serializer', serializer.qualified_name()),
+            ('index', index),
+            ('op_type', op_type),
+            ('_id', doc_id),
+            ('status', result.get('status')),
+            ('error', error.get('type') if isinstance(error, dict) else error),
+            ('reason', error.get('reason') if isinstance(error, dict) else None),
+            ('time', format_timestamp(now())),
+        ])
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def records(self, offset=0):
+        # the records written from byte `offset` on (eg. `size()` before a run)
+        try:
+            with open(self.path) as f:
+                f.seek(offset)
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        except FileNotFoundError:
+            return
+
+    def summary(self, offset=0):
+        # failure counts by (serializer, error type)
+        return Counter((record['serializer'], record['error']) for record in self.records(offset))
+
+    @property
+    def taken_path(self):
+        return '{}.retrying'.format(self.path)
+
+    def take(self):
+        # moves the current records aside (for `retry`, whose own failures
+        # are written to a fresh file) and returns them; `release()` removes
+        # them once handled. Records left aside by an interrupted retry are
+        # taken again
+        if self.size():
+            taken = list(self.records())
+            if os.path.exists(self.taken_path):
+                DeadLetterFile(self.taken_path).extend(taken)
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.taken_path)
+        return list(DeadLetterFile(self.taken_path).records())
+
+    def release(self):
+        try:
+            os.remove(self.taken_path)
+        except FileNotFoundError:
+            pass
+
+    def extend(self, records):
+        if records:
+            with open(self.path, 'a') as f:
+                f.write(''.join(json.dumps(record, default=str) + '\n' for record in records))
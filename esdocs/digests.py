@@ -0,0 +1,142 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from .encoding import EncodedAction
+
+logger = logging.getLogger(__name__)
+
+_stores = {}
+
+
+def action_digest(action):
+    if isinstance(action, EncodedAction):
+        return hashlib.sha1(action.data).hexdigest()
+
+    # `default=str` only has to be stable, not reversible; it covers dates,
+    # Decimals and anything else the client's serializer would handle
+    encoded = json.dumps(action, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+class DigestStore:
+    """
+    Local SQLite store of a digest per (index, _id) of the last document
+    successfully sent to Elasticsearch, used to drop bulk actions whose
+    document hasn't changed since.
+
+    Digests are only recorded once Elasticsearch has acknowledged the action
+    (see `confirm`), so failed or interrupted bulk requests are re-sent next
+    time. Confirmed digests are buffered and written `commit_every` at a time
+    in one short transaction, so parallel workers sharing the file never wait
+    on one held open across bulk requests (or their backoff).
+    """
+    commit_every = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        # readers don't block the writer (nor it them)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            " idx TEXT NOT NULL, doc_id TEXT NOT NULL, digest TEXT NOT NULL,"
+            " PRIMARY KEY (idx, doc_id))"
+        )
+        self.connection.commit()
+        self.pending = {}
+        self.confirmed = []
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def open(cls, path):
+        # one store per path per process and thread (SQLite connections stay
+        # in the thread that made them); parallel workers open their own
+        # connection after forking
+        key = (os.getpid(), threading.get_ident(), path)
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = cls(path)
+        return store
+
+    def get(self, index, doc_id):
+        row = self.connection.execute(
+            "SELECT digest FROM digests WHERE idx = ? AND doc_id = ?", (index, str(doc_id))).fetchone()
+        return row[0] if row else None
+
+    def filter(self, index, actions, skip=True):
+        """
+        Yields the actions from `actions` whose digest differs from the stored
+        one (all of them if `skip` is False), remembering each digest until
+        `confirm` is called for it.
+        """
+        for action in actions:
+            if isinstance(action, EncodedAction):
+                doc_id, op_type = action.id, action.op_type
+            else:
+                doc_id, op_type = action.get('_id'), action.get('_op_type')
+
+            if doc_id is None:
+                yield action
+                continue
+
+            key = (index, str(doc_id))
+            if op_type == 'delete':
+                self.pending[key] = None
+                yield action
+                continue
+
+            digest = action_digest(action)
+            if skip and self.get(*key) == digest:
+                self.hits += 1
+                continue
+
+            self.misses += 1
+            self.pending[key] = digest
+            yield action
+
+    def confirm(self, index, doc_id):
+        key = (index, str(doc_id))
+        if key not in self.pending:
+            return
+
+        self.confirmed.append(key + (self.pending.pop(key), ))
+        if len(self.confirmed) >= self.commit_every:
+            self.commit()
+
+    def discard(self, index, doc_id):
+        self.pending.pop((index, str(doc_id)), None)
+
+    def commit(self):
+        confirmed, self.confirmed = self.confirmed, []
+        if not confirmed:
+            return
+        # in order; a document may have been indexed, then deleted
+        with self.connection:
+            for idx, doc_id, digest in confirmed:
+                if digest is None:
+                    self.connection.execute("DELETE FROM digests WHERE idx = ? AND doc_id = ?", (idx, doc_id))
+                else:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO digests (idx, doc_id, digest) VALUES (?, ?, ?)", (idx, doc_id, digest))
+
+    def clear(self, index):
+        self.connection.execute("DELETE FROM digests WHERE idx = ?", (index, ))
+        self.connection.commit()
+
+    def move(self, index, to_index):
+        # replaces the digests of `to_index` with those of `index` (eg. once a
+        # rebuilt index has been swapped in behind an alias)
+        self.commit()
+        with self.connection:
+            self.connection.execute("DELETE FROM digests WHERE idx = ?", (to_index, ))
+            self.connection.execute("UPDATE digests SET idx = ? WHERE idx = ?", (to_index, index))
+
+    def reset_counts(self):
+        hits, misses = self.hits, self.misses
+        self.hits = self.misses = 0
+        return hits, misses
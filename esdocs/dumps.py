@@ -0,0 +1,81 @@
+import gzip
+import json
+import logging
+import os
+
+from .encoding import EncodedAction
+from .state import format_timestamp, now
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+DEFAULT_SPLIT_SIZE = 100 * 1024 * 1024
+
+
+class DumpWriter:
+    """
+    Writes encoded bulk actions for one serializer to gzipped NDJSON bulk
+    files named `<index>.<serializer>.<part>.ndjson.gz` in `path`, starting a
+    new file once `split_size` (uncompressed) bytes have been written to the
+    current one; gzip only writes compressed data out in blocks, so the
+    compressed size isn't known until a file is closed.
+    """
+    def __init__(self, path, index, serializer, split_size=DEFAULT_SPLIT_SIZE):
+        self.path = path
+        self.index = index
+        self.serializer = serializer
+        self.split_size = split_size
+        self.files = []
+        self.raw = self.file = None
+        self.written = 0
+
+    def _open(self):
+        name = '{}.{}.{:04d}.ndjson.gz'.format(self.index, self.serializer.__name__, len(self.files))
+        self.raw = open(os.path.join(self.path, name), 'wb')
+        self.file = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        self.files.append({'path': name, 'serializer': self.serializer.qualified_name(), 'docs': 0})
+        self.written = 0
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.raw.close()
+            self.raw = self.file = None
+
+    def write(self, action):
+        if self.file is None or self.written >= self.split_size:
+            self._close()
+            self._open()
+        self.file.write(action.data)
+        self.written += len(action.data)
+        self.files[-1]['docs'] += 1
+
+    def close(self):
+        self._close()
+        return self.files
+
+
+def write_manifest(path, indexes):
+    with open(os.path.join(path, MANIFEST_NAME), 'w') as f:
+        json.dump({'created': format_timestamp(now()), 'indexes': indexes}, f, indent=2, sort_keys=True)
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def read_actions(path):
+    """
+    Streams the bulk actions of a dump file back as `EncodedAction`s, a line
+    (or pair of lines) at a time.
+    """
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            op_type, meta = json.loads(line).popitem()
+            data = line
+            if op_type != 'delete':
+                data += next(f)
+            yield EncodedAction(op_type, meta.get('_id'), data)
@@ -0,0 +1,82 @@
+import collections
+import datetime
+import decimal
+import json
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# a bulk action already encoded as its NDJSON action (and source) line(s)
+EncodedAction = collections.namedtuple('EncodedAction', 'op_type id data')
+
+
+def default(data):
+    # mirrors what elasticsearch-py's/elasticsearch-dsl's JSON serializers
+    # accept, so documents encode the same whichever encoder is used
+    if isinstance(data, (datetime.date, datetime.time)):
+        return data.isoformat()
+    if isinstance(data, decimal.Decimal):
+        return float(data)
+    if isinstance(data, uuid.UUID):
+        return str(data)
+    if isinstance(data, (set, frozenset, tuple)):
+        return list(data)
+    if hasattr(data, '_l_'):
+        # elasticsearch_dsl AttrList
+        return data._l_
+    if hasattr(data, 'to_dict'):
+        # elasticsearch_dsl AttrDict, InnerDoc, ...
+        return data.to_dict()
+    raise TypeError("Unable to serialize %r (type: %s)" % (data, type(data)))
+
+
+class JSONEncoder:
+    name = 'json'
+
+    def dumps(self, data):
+        return json.dumps(data, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class OrjsonEncoder:
+    name = 'orjson'
+    # for what orjson itself refuses, eg. integers beyond 64 bits
+    fallback = JSONEncoder()
+
+    def dumps(self, data):
+        try:
+            return orjson.dumps(data, default=default, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            return self.fallback.dumps(data)
+
+
+class ClientEncoder:
+    """ Uses an Elasticsearch client's own (str-returning) serializer. """
+    name = 'client'
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+
+    def dumps(self, data):
+        if isinstance(data, bytes):
+            return data
+        return self.serializer.dumps(data).encode('utf-8')
+
+
+def get_encoder(name=None):
+    """
+    Returns a bytes-producing JSON encoder: 'orjson', 'json' or, by default,
+    orjson when it is installed and the standard library otherwise.
+    """
+    if name in (None, 'auto'):
+        name = 'orjson' if orjson is not None else 'json'
+
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError("The 'orjson' package is required for the orjson encoder.")
+        return OrjsonEncoder()
+    if name == 'json':
+        return JSONEncoder()
+    raise ValueError("Unknown encoder '{}'".format(name))
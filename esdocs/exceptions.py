@@ -8,3 +8,7 @@ class InvalidFieldLookup(ESDocsException):
 
 class MissingSerializer(ESDocsException):
     pass
+
+
+class ChunkFailed(ESDocsException):
+    pass
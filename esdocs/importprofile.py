@@ -0,0 +1,73 @@
+import builtins
+import importlib.util
+import sys
+import time
+from contextlib import contextmanager
+
+
+class ImportProfiler:
+    """
+    Times the start-up of the `esdocs` command for `--import-profile`: the
+    time and number of modules loaded by each phase (eg. importing the
+    serializer modules), and the modules that took longest to import.
+
+    Imports are timed by wrapping `builtins.__import__`, so modules loaded
+    with `importlib.import_module` only count towards their phase. Module
+    times are cumulative; they include the modules they import in turn.
+    """
+    def __init__(self):
+        self.phases = []
+        self.modules = {}
+        self._import = None
+
+    def start(self):
+        if self._import is not None:
+            return
+        original = self._import = builtins.__import__
+        modules = self.modules
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if level:
+                try:
+                    resolved = importlib.util.resolve_name('.' * level + name, (globals or {}).get('__package__'))
+                except (ImportError, ValueError):
+                    return original(name, globals, locals, fromlist, level)
+            else:
+                resolved = name
+            if resolved in sys.modules:
+                return original(name, globals, locals, fromlist, level)
+
+            started = time.perf_counter()
+            try:
+                return original(name, globals, locals, fromlist, level)
+            finally:
+                modules[resolved] = time.perf_counter() - started
+
+        builtins.__import__ = timed_import
+
+    def stop(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    @contextmanager
+    def phase(self, label):
+        loaded = len(sys.modules)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((label, time.perf_counter() - started, len(sys.modules) - loaded))
+
+    def report(self, top=15):
+        lines = ["{:<40} {:>10} {:>10}".format('phase', 'seconds', 'modules')]
+        for label, seconds, loaded in self.phases:
+            lines.append("{:<40} {:>10.3f} {:>10}".format(label, seconds, loaded))
+        lines.append("{:<40} {:>10.3f} {:>10}".format(
+            'total', sum(seconds for _, seconds, _ in self.phases), sum(loaded for _, _, loaded in self.phases)))
+
+        lines.append('')
+        lines.append("{:<51} {:>10}".format('slowest imports (cumulative)', 'seconds'))
+        for name, seconds in sorted(self.modules.items(), key=lambda item: -item[1])[:top]:
+            lines.append("{:<51} {:>10.3f}".format(name, seconds))
+        return '\n'.join(lines)
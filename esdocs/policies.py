@@ -1,14 +1,21 @@
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from multiprocessing import current_process
+import functools
+import logging
+import multiprocessing
+import math
 import os
+import time
 
 from elasticsearch_dsl import connections
-import gevent
-from gevent.pool import Pool
-from gevent.queue import Queue
-from gevent.select import select
-import gipc
 
+from .exceptions import ChunkFailed
+from .progress import ProgressReporter
 from .serializer import Serializer
+from .stats import stats
+
+logger = logging.getLogger(__name__)
 
 
 class BaseIndexingPolicy:
@@ -18,49 +25,221 @@ class BaseIndexingPolicy:
     def close(self):
         pass
 
+    def chunk_plan(self, serializer, ranges, offsets, options, checkpoint=None):
+        # how a serializer's data is split into chunks: up to `ranges` key
+        # ranges if it can be partitioned, else `offsets` offset-based chunks
+        # (`None` if `offsets` is 0). A rebuild `checkpoint` keeps the plan so
+        # that chunk numbers mean the same thing when resuming
+        if checkpoint is not None:
+            plan = checkpoint.get_plan(serializer)
+            if plan is not None:
+                return plan
+
+        partitions = serializer.fetch_data_partitions(ranges, **options)
+        if partitions is not None:
+            plan = {'ranges': [list(parallel_range) for parallel_range in partitions]}
+        elif offsets:
+            data_size = serializer.fetch_data_length()
+            chunk_size = max(1, math.ceil(data_size / offsets))
+            plan = {'chunk_size': chunk_size, 'count': math.ceil(data_size / chunk_size)}
+        else:
+            return None
+
+        if checkpoint is not None:
+            checkpoint.set_plan(serializer, plan)
+        return plan
+
+    def chunk_params(self, serializer, index, plan, options, skip=()):
+        if 'ranges' in plan:
+            # key ranges; each chunk queries its range directly
+            for chunk_num, parallel_range in enumerate(plan['ranges']):
+                if chunk_num in skip:
+                    continue
+                _options = options.copy()
+                _options['parallel_chunk_num'] = chunk_num
+                _options['parallel_range'] = tuple(parallel_range)
+                yield hash(serializer), index, _options
+            return
+
+        for chunk_num in range(plan['count']):
+            if chunk_num in skip:
+                continue
+            _options = options.copy()
+            _options['parallel_chunk_num'] = chunk_num
+            _options['parallel_chunk_size'] = plan['chunk_size']
+            yield hash(serializer), index, _options
+
 
 class StreamingPolicy(BaseIndexingPolicy):
+    # with a rebuild checkpoint, data is streamed one key range at a time
+    # (if the serializer can be partitioned) so an interrupted rebuild can
+    # resume from the last completed range; up to `checkpoint_chunks` ranges
+    # of at least `checkpoint_chunk_docs` documents each, so that small
+    # tables aren't split into many small bulk requests
+    checkpoint_chunks = 64
+    checkpoint_chunk_docs = 10000
+
+    def checkpoint_ranges(self, serializer, options):
+        try:
+            length = serializer.fetch_data_length(**options)
+        except NotImplementedError:
+            return self.checkpoint_chunks
+        return max(1, min(self.checkpoint_chunks, length // self.checkpoint_chunk_docs))
+
     def bulk_operation(self, serializer, index, client, **options):
-        serializer.bulk_operation(index=index, client=client, **options)
+        checkpoint = options.pop('checkpoint', None)
+        if checkpoint is not None and checkpoint.is_done(serializer):
+            logger.info("   '{}' already indexed; skipping.".format(serializer.document.__name__))
+            return 0, 0
 
+        reporter = ProgressReporter.from_options(serializer, index, options)
+        progress = reporter.update if reporter is not None else None
 
-def process_func(h2):
-    proc = current_process()
+        plan = None
+        if checkpoint is not None:
+            plan = checkpoint.get_plan(serializer)
+            if plan is None:
+                plan = self.chunk_plan(serializer, self.checkpoint_ranges(serializer, options), 0, options, checkpoint)
 
-    def parallel_bulk_index(serializer_hash, index, options):
-        serializer = Serializer.hash_registry[serializer_hash]
+        if plan is None:
+            result = serializer.bulk_operation(index=index, client=client, progress=progress, **options)
+        else:
+            ok_count = failed_count = 0
+            completed = checkpoint.completed_chunks(serializer)
+            for _, _, chunk_options in self.chunk_params(serializer, index, plan, options, skip=completed):
+                ok, failed = serializer.bulk_operation(index=index, client=client, progress=progress, **chunk_options)
+                ok_count += ok
+                failed_count += failed
+                checkpoint.complete_chunks(serializer, [chunk_options['parallel_chunk_num']])
+            result = ok_count, failed_count
 
-        using = options.get('using', '') or None
-        client = connections.get_connection(using or 'default')
+        if checkpoint is not None:
+            checkpoint.mark_done(serializer)
+        if reporter is not None:
+            reporter.finish()
+        return result
 
-        serializer.bulk_operation(index=index, client=client, **options)
 
-    h2.put(['GOOD-MORNING-DAVE', (proc.name, )])
+class GuidedChunkScheduler:
+    """
+    Hands out chunk parameters on demand (guided self-scheduling). Key range
+    chunks are handed out as runs of adjacent ranges merged into one, each run
+    covering `1 / (2 * slots)` of the remaining ranges, so early requests get
+    large chunks and the tail of the job is split finely across workers.
+    Offset-based chunks can't be merged and are handed out one at a time.
+    `dispatched` maps the first chunk number of each run to all of its chunk
+    numbers.
+    """
+    def __init__(self, chunks, slots, ranged=False):
+        self.chunks = list(chunks)
+        self.slots = max(1, slots)
+        self.ranged = ranged
+        self.position = 0
+        self.dispatched = {}
+
+    def __len__(self):
+        return len(self.chunks) - self.position
 
-    queue = Queue()
+    def next_chunk(self):
+        remaining = len(self)
+        if not remaining:
+            return None
 
-    def chunk_params_receiver():
-        while True:
-            args = h2.get()
-            queue.put_nowait(args)
-            if args == 'STOP':
+        size = 1
+        if self.ranged:
+            size = max(1, math.ceil(remaining / (2 * self.slots)))
+
+        run = self.chunks[self.position:self.position + 1]
+        for chunk in self.chunks[self.position + 1:self.position + size]:
+            # only merge adjacent ranges (completed ones are missing on resume)
+            if chunk[2]['parallel_chunk_num'] != run[-1][2]['parallel_chunk_num'] + 1:
                 break
+            run.append(chunk)
+        self.position += len(run)
+
+        serializer_hash, index, options = run[0]
+        self.dispatched[options['parallel_chunk_num']] = [chunk[2]['parallel_chunk_num'] for chunk in run]
+        if len(run) > 1:
+            options = options.copy()
+            options['parallel_range'] = (run[0][2]['parallel_range'][0], run[-1][2]['parallel_range'][1])
+        return serializer_hash, index, options
+
+
+def parallel_bulk_index(serializer_hash, index, options, progress=None):
+    # indexes one chunk in a worker process
+    serializer = Serializer.hash_registry[serializer_hash]
 
-    gevent.spawn(chunk_params_receiver)
+    if options.get('stats') and not stats.enabled:
+        stats.enable()
+        # recompile serialize plans so that hooks are timed too
+        Serializer.reset_serialize_plans()
+
+    using = options.get('using', '') or None
+    client = connections.get_connection(using or 'default')
+
+    if progress is not None and options.get('progress_interval') is not None:
+        options = dict(options, progress=progress)
+    return serializer.bulk_operation(index=index, client=client, **options)
+
+
+def process_func(h2, pool_size=2):
+    from gevent.pool import Pool
+
+    proc = current_process()
+    # (ok, failed) counts not yet reported to the parent, which are sent at
+    # most once per reporter interval (`--progress`) and at the end of each
+    # chunk
+    pending = [0, 0]
+    last_progress = [time.time()]
+
+    def send_progress():
+        if pending[0] or pending[1]:
+            h2.put(['PROGRESS', (proc.name, pending[0], pending[1])])
+            pending[0] = pending[1] = 0
+        last_progress[0] = time.time()
+
+    def progress(interval, ok_count, failed_count):
+        pending[0] += ok_count
+        pending[1] += failed_count
+        if time.time() - last_progress[0] >= interval:
+            send_progress()
+
+    def run_chunk(thread_name, args):
+        chunk_num = args[2]['parallel_chunk_num']
+        interval = args[2].get('progress_interval')
+        started = time.time()
+        try:
+            ok_count, failed_count = parallel_bulk_index(
+                *args, progress=functools.partial(progress, interval) if interval is not None else None)
+        except Exception as e:
+            # let the parent stop (rather than wait forever on this chunk)
+            logger.exception("{}/{} failed on chunk {}".format(proc.name, thread_name, chunk_num))
+            h2.put(['FAILED-CHUNK', (proc.name, thread_name, chunk_num, repr(e))])
+            return
+        if interval is not None:
+            send_progress()
+        h2.put(['DONE-CHUNK', (
+            proc.name, thread_name, chunk_num, ok_count, failed_count, time.time() - started,
+            stats.collect() if stats.enabled else None
+        )])
+
+    h2.put(['GOOD-MORNING-DAVE', (proc.name, )])
 
     # Use a gevent pool to maximize processor usage; while a DB query is
     # running, the other green thread can be CPU bound. Then that CPU-heavy
     # task is done, the DB query will likely be completed and ready to
     # become CPU bound (serializing the data)
-    pool = Pool(2)
+    pool = Pool(pool_size)
     n = 0
     while True:
-        args = queue.get()
+        # only ask the parent for work once a green thread is free to take it,
+        # so a worker stuck on a slow chunk doesn't hoard queued chunks
+        pool.wait_available()
+        h2.put(['NEXT-CHUNK', (proc.name, )])
+        args = h2.get()
         if args == 'STOP':
             break
-        chunk_num = args[2]['parallel_chunk_num']
-        thread_name = "gthread-{}".format(n)
-        pool.apply_async(parallel_bulk_index, args=args, callback=lambda x: h2.put(['DONE-CHUNK', (proc.name, thread_name, chunk_num)]))
+        pool.spawn(run_chunk, "gthread-{}".format(n), args)
         n += 1
 
     pool.join()
@@ -68,25 +247,27 @@ def process_func(h2):
 
 class ParallelStreamingPolicy(BaseIndexingPolicy):
     pipe_fd_mapping = {}
+    pool_size = 2
 
     def __init__(self, parallel_prep):
         self.parallel_prep = parallel_prep
+        # workers that asked for a chunk when none were left; they are
+        # served by the next `bulk_operation` (or told to stop on `close`)
+        self.waiting = []
 
     def bulk_operation(self, serializer, index, client, **options):
+        from gevent.select import select
+        import gipc
+
         procs = options.get('multi')
         if not procs:
             procs = os.cpu_count()
             procs = procs if procs > 1 else 2
 
-        data_size = serializer.fetch_data_length()
-        chunk_size = int(data_size / (procs * 4))
-
-        def parallel_params():
-            for chunk_num in range(procs * 4 + 1):
-                _options = options.copy()
-                _options['parallel_chunk_num'] = chunk_num
-                _options['parallel_chunk_size'] = chunk_size
-                yield hash(serializer), index, _options
+        checkpoint = options.pop('checkpoint', None)
+        if checkpoint is not None and checkpoint.is_done(serializer):
+            logger.info("   '{}' already indexed; skipping.".format(serializer.document.__name__))
+            return 0, 0
 
         if not self.pipe_fd_mapping:
             # reset multiprocessing.Process-sensitive elements just before forking
@@ -94,7 +275,7 @@ class ParallelStreamingPolicy(BaseIndexingPolicy):
             for n in range(procs):
                 h1, h2 = gipc.pipe(duplex=True)
                 self.pipe_fd_mapping[h1._reader._fd] = (
-                    h1, gipc.start_process(process_func, args=(h2,), name="esdocs-proc-{}".format(n))
+                    h1, gipc.start_process(process_func, args=(h2, self.pool_size), name="esdocs-proc-{}".format(n))
                 )
 
             # wait until sub-process workers check in
@@ -106,31 +287,227 @@ class ParallelStreamingPolicy(BaseIndexingPolicy):
                     msg, data = h1.get()
                     if msg == 'GOOD-MORNING-DAVE':
                         ready += 1
+                    elif msg == 'NEXT-CHUNK':
+                        self.waiting.append(h1)
 
-        parallel_chunk_params = parallel_params()
+        plan = self.chunk_plan(serializer, procs * 16, procs * 4, options, checkpoint)
+        completed = checkpoint.completed_chunks(serializer) if checkpoint is not None else ()
+        chunks = list(self.chunk_params(serializer, index, plan, options, skip=completed))
+        scheduler = GuidedChunkScheduler(
+            chunks, procs * self.pool_size, ranged=bool(chunks) and 'parallel_range' in chunks[0][2])
 
-        # populate all the processes with an even number of chunks to process
-        chunks_remaining = True
-        chunks_to_process = 0
-        while chunks_remaining:
-            for h1, proc in self.pipe_fd_mapping.values():
-                try:
-                    h1.put(next(parallel_chunk_params))
-                    chunks_to_process += 1
-                except StopIteration:
-                    chunks_remaining = False
-                    break
+        chunks_in_progress = 0
+        counts = [0, 0]
+        throughput = defaultdict(lambda: [0, 0, 0.0])
+        reporter = ProgressReporter.from_options(serializer, index, options)
+
+        def dispatch(h1):
+            params = scheduler.next_chunk()
+            if params is None:
+                self.waiting.append(h1)
+                return False
+            h1.put(params)
+            return True
+
+        waiting, self.waiting = self.waiting, []
+        for h1 in waiting:
+            if dispatch(h1):
+                chunks_in_progress += 1
 
-        while chunks_to_process > 0:
+        while len(scheduler) or chunks_in_progress > 0:
             readable, _, _ = select(self.pipe_fd_mapping.keys(), [], [])
             for fd in readable:
                 h1, proc = self.pipe_fd_mapping[fd]
                 msg, data = h1.get()
-                if msg == 'DONE-CHUNK':
-                    chunks_to_process -= 1
+                if msg == 'NEXT-CHUNK':
+                    if dispatch(h1):
+                        chunks_in_progress += 1
+                elif msg == 'PROGRESS':
+                    if reporter is not None:
+                        reporter.update(data[1], data[2])
+                elif msg == 'FAILED-CHUNK':
+                    proc_name, thread_name, chunk_num, error = data
+                    raise ChunkFailed("{}/{} failed on chunk {}: {}".format(proc_name, thread_name, chunk_num, error))
+                elif msg == 'DONE-CHUNK':
+                    chunks_in_progress -= 1
+                    proc_name, thread_name, chunk_num, ok_count, failed_count, elapsed, chunk_stats = data
+                    stats.merge(chunk_stats)
+                    counts[0] += ok_count
+                    counts[1] += failed_count
+                    docs = ok_count + failed_count
+                    chunk_nums = scheduler.dispatched.pop(chunk_num)
+                    if checkpoint is not None:
+                        checkpoint.complete_chunks(serializer, chunk_nums)
+                    logger.debug("{}/{} finished chunk {}: {} documents in {:.1f}s ({:.1f} docs/sec)".format(
+                        proc_name, thread_name, chunk_num, docs, elapsed, docs / elapsed if elapsed else 0))
+                    totals = throughput[proc_name]
+                    totals[0] += 1
+                    totals[1] += docs
+                    totals[2] += elapsed
+
+        if checkpoint is not None:
+            checkpoint.mark_done(serializer)
+        if reporter is not None:
+            reporter.finish()
+        for proc_name, (chunk_count, docs, elapsed) in sorted(throughput.items()):
+            logger.info("   {}: {} documents in {} chunks ({:.1f} docs/sec)".format(
+                proc_name, docs, chunk_count, docs / elapsed if elapsed else 0))
+        return counts[0], counts[1]
 
     def close(self):
+        # every worker is blocked waiting on the answer to a chunk request
         for h1, proc in self.pipe_fd_mapping.values():
             h1.put('STOP')
         for h1, proc in self.pipe_fd_mapping.values():
             proc.join()
+        self.pipe_fd_mapping.clear()
+        self.waiting = []
+
+
+def process_pool_init(worker_setup, modules, hooks, connection_kwargs, log_level):
+    # runs first in each (freshly started) process pool worker: sets up
+    # logging, Elasticsearch connections and the serializers as the parent
+    # process has them
+    parent_logger = logging.getLogger(__package__)
+    if not parent_logger.handlers or all(isinstance(h, logging.NullHandler) for h in parent_logger.handlers):
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(processName)s: %(message)s'))
+        parent_logger.addHandler(handler)
+    parent_logger.setLevel(log_level)
+
+    connections.configure(**connection_kwargs)
+    if worker_setup is not None:
+        worker_setup()
+    for mod in modules:
+        # a simple import triggers metaclass Serializer class 'self-registration'
+        __import__(mod)
+    Serializer.register_hooks(hooks)
+
+
+def process_pool_chunk(serializer_hash, index, options, bulk_concurrency=2):
+    serializer = Serializer.hash_registry[serializer_hash]
+    if not serializer.data_bulk_concurrency:
+        # send bulk requests from threads while this process serializes
+        serializer.data_bulk_concurrency = bulk_concurrency
+
+    started = time.time()
+    ok_count, failed_count = parallel_bulk_index(serializer_hash, index, options)
+    return (
+        current_process().name, ok_count, failed_count, time.time() - started,
+        stats.collect() if stats.enabled else None
+    )
+
+
+class ProcessPoolStreamingPolicy(BaseIndexingPolicy):
+    """
+    Multi-process indexing without gevent/gipc: chunks are handed out (see
+    `GuidedChunkScheduler`) to a `concurrent.futures` process pool whose
+    workers are started with `start_method` ('spawn' or 'forkserver'), so
+    nothing has to be monkey-patched. Workers import the modules of the
+    registered serializers (after `worker_setup`, eg. `django.setup()`) and
+    each sends its bulk requests from `bulk_concurrency` threads.
+    """
+    start_method = 'spawn'
+    bulk_concurrency = 2
+
+    def __init__(self, parallel_prep, worker_setup=None, start_method=None):
+        self.parallel_prep = parallel_prep
+        self.worker_setup = worker_setup
+        self.start_method = start_method or self.start_method
+        self.executor = None
+
+    def start(self, procs):
+        # reset connections (eg. Django's) before starting the workers
+        self.parallel_prep()
+
+        modules = sorted(set(
+            serializer.__module__ for serializer in Serializer.hash_registry.values()
+            if serializer.__module__ != '__main__'))
+        hooks = ['{}.{}'.format(hook.__module__, hook.__qualname__) for hook in Serializer.compatibility_hooks]
+        self.executor = ProcessPoolExecutor(
+            max_workers=procs,
+            mp_context=multiprocessing.get_context(self.start_method),
+            initializer=process_pool_init,
+            initargs=(
+                self.worker_setup, modules, hooks, dict(connections.connections._kwargs),
+                logging.getLogger(__package__).getEffectiveLevel()
+            )
+        )
+
+    def bulk_operation(self, serializer, index, client, **options):
+        procs = options.get('multi')
+        if not procs:
+            procs = os.cpu_count()
+            procs = procs if procs > 1 else 2
+
+        checkpoint = options.pop('checkpoint', None)
+        if checkpoint is not None and checkpoint.is_done(serializer):
+            logger.info("   '{}' already indexed; skipping.".format(serializer.document.__name__))
+            return 0, 0
+
+        if self.executor is None:
+            self.start(procs)
+
+        plan = self.chunk_plan(serializer, procs * 16, procs * 4, options, checkpoint)
+        completed = checkpoint.completed_chunks(serializer) if checkpoint is not None else ()
+        chunks = list(self.chunk_params(serializer, index, plan, options, skip=completed))
+        scheduler = GuidedChunkScheduler(chunks, procs, ranged=bool(chunks) and 'parallel_range' in chunks[0][2])
+
+        counts = [0, 0]
+        throughput = defaultdict(lambda: [0, 0, 0.0])
+        reporter = ProgressReporter.from_options(serializer, index, options)
+        in_flight = {}
+
+        def dispatch():
+            params = scheduler.next_chunk()
+            if params is not None:
+                future = self.executor.submit(process_pool_chunk, *params, bulk_concurrency=self.bulk_concurrency)
+                in_flight[future] = params[2]['parallel_chunk_num']
+
+        # one chunk per worker at a time, so chunks are handed out as
+        # workers free up
+        for _ in range(procs):
+            dispatch()
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk_num = in_flight.pop(future)
+                try:
+                    proc_name, ok_count, failed_count, elapsed, chunk_stats = future.result()
+                except Exception as e:
+                    for pending in in_flight:
+                        pending.cancel()
+                    raise ChunkFailed("Chunk {} failed: {!r}".format(chunk_num, e))
+
+                stats.merge(chunk_stats)
+                counts[0] += ok_count
+                counts[1] += failed_count
+                chunk_nums = scheduler.dispatched.pop(chunk_num)
+                if checkpoint is not None:
+                    checkpoint.complete_chunks(serializer, chunk_nums)
+                if reporter is not None:
+                    reporter.update(ok_count, failed_count)
+
+                docs = ok_count + failed_count
+                logger.debug("{} finished chunk {}: {} documents in {:.1f}s ({:.1f} docs/sec)".format(
+                    proc_name, chunk_num, docs, elapsed, docs / elapsed if elapsed else 0))
+                totals = throughput[proc_name]
+                totals[0] += 1
+                totals[1] += docs
+                totals[2] += elapsed
+                dispatch()
+
+        if checkpoint is not None:
+            checkpoint.mark_done(serializer)
+        if reporter is not None:
+            reporter.finish()
+        for proc_name, (chunk_count, docs, elapsed) in sorted(throughput.items()):
+            logger.info("   {}: {} documents in {} chunks ({:.1f} docs/sec)".format(
+                proc_name, docs, chunk_count, docs / elapsed if elapsed else 0))
+        return counts[0], counts[1]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
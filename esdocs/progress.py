@@ -0,0 +1,101 @@
+import logging
+import sys
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return '{}h{:02d}m'.format(hours, minutes)
+    if minutes:
+        return '{}m{:02d}s'.format(minutes, seconds)
+    return '{}s'.format(seconds)
+
+
+class ProgressReporter:
+    """
+    Tracks documents done/failed for one serializer's bulk operation and
+    reports progress, throughput (over a sliding `window` of seconds) and ETA
+    every `interval` seconds, either to the log or as a single, continually
+    rewritten line on a TTY.
+    """
+    window = 60
+
+    def __init__(self, label, total=None, interval=10, tty=False, stream=None):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.tty = tty and self.stream.isatty()
+        self.done = 0
+        self.failed = 0
+        self.started = time.time()
+        self.last_report = self.started
+        self.samples = deque([(self.started, 0)])
+
+    @classmethod
+    def from_options(cls, serializer, index, options):
+        # `None` unless progress reporting was asked for (`--progress`)
+        interval = options.get('progress_interval')
+        if interval is None:
+            return None
+
+        try:
+            total = serializer.fetch_data_length(**options) if options.get('since') is None else None
+        except NotImplementedError:
+            total = None
+
+        label = "{}/{}".format(index, serializer.document.__name__)
+        return cls(label, total=total, interval=interval, tty=options.get('progress_tty', False))
+
+    def update(self, done, failed=0):
+        self.done += done
+        self.failed += failed
+
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.samples.append((now, self.done))
+            while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+                self.samples.popleft()
+            self.report()
+
+    def rate(self):
+        (first_time, first_done), (last_time, last_done) = self.samples[0], self.samples[-1]
+        if last_time > first_time:
+            return (last_done - first_done) / (last_time - first_time)
+        elapsed = time.time() - self.started
+        return self.done / elapsed if elapsed else 0
+
+    def status(self):
+        rate = self.rate()
+        parts = ["{}: {}".format(self.label, self.done)]
+        if self.total:
+            parts[0] += "/{} ({:.1%})".format(self.total, min(1, self.done / self.total))
+        parts.append("{:.1f} docs/sec".format(rate))
+        if self.failed:
+            parts.append("{} failed".format(self.failed))
+        if self.total and rate > 0 and self.done < self.total:
+            parts.append("ETA {}".format(format_duration((self.total - self.done) / rate)))
+        return ", ".join(parts)
+
+    def report(self):
+        if self.tty:
+            self.stream.write("\r\033[K" + self.status())
+            self.stream.flush()
+        else:
+            logger.info("   {}".format(self.status()))
+
+    def finish(self):
+        elapsed = time.time() - self.started
+        if self.tty:
+            self.stream.write("\r\033[K")
+            self.stream.flush()
+        logger.info("   {}: {} documents in {} ({:.1f} docs/sec){}".format(
+            self.label, self.done, format_duration(elapsed), self.done / elapsed if elapsed else 0,
+            ", {} failed".format(self.failed) if self.failed else ""))
@@ -1,12 +1,32 @@
 import collections
+import collections.abc
+import inspect
+import itertools
 import logging
-
-from elasticsearch.helpers import streaming_bulk
-
+import operator
+import os
+import time
+import zlib
+
+from .bulk import AdaptiveBulkSizer, adaptive_streaming_bulk, pipelined_streaming_bulk
+from .deadletter import DeadLetterFile
+from .digests import DigestStore
+from .encoding import EncodedAction, get_encoder
 from .exceptions import *
+from .stats import stats
 
 logger = logging.getLogger(__name__)
 
+# how a field's value is obtained in a compiled serialize plan
+_FIELD_SERIALIZE = 'serialize'  # `serialize_<name>()`, used as-is
+_FIELD_GETTER = 'getter'  # `get_<name>_value()`, then hooks/normalize/adjust
+_FIELD_LOOKUP = 'lookup'  # `get_value()`, then hooks/normalize/adjust
+
+# `fallback` is the plan field of the next getter to try if this one raises
+# an AttributeError (eg. `get_value()` after a `get_<name>_value()`)
+_PlanField = collections.namedtuple('_PlanField', 'name kind getter empty subdoc inner takes_context fallback')
+_SerializePlan = collections.namedtuple('_SerializePlan', 'fields hooks normalize adjust takes_context')
+
 
 def dotted_import(path):
     module, klass = path.rsplit('.', 1)
@@ -14,6 +34,113 @@ def dotted_import(path):
     return getattr(mod, klass)
 
 
+def _walk_path(obj, parts):
+    v = obj
+    last = len(parts)
+    for n, part in enumerate(parts, start=1):
+        try:
+            v = getattr(v, part)
+        except AttributeError:
+            if not isinstance(v, collections.abc.Mapping):
+                raise
+            v = v.get(part)
+
+        if v is None and n != last:
+            # if we have None and we haven't finished processing the
+            # dot-separated field lookup, then it will blow up on the
+            # next iteration; handle it before it does
+            # eg. if a related Django ForeignKey field is set to `None`
+            raise InvalidFieldLookup
+
+    return v
+
+
+def _walk_dict(obj, parts):
+    v = obj
+    last = len(parts)
+    for n, part in enumerate(parts, start=1):
+        if type(v) is not dict:
+            return _walk_path(v, parts[n - 1:])
+        v = v.get(part)
+        if v is None and n != last:
+            raise InvalidFieldLookup
+    return v
+
+
+def takes_context(func):
+    # whether `func` accepts a `context` keyword argument
+    try:
+        params = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+    return 'context' in params or any(p.kind is inspect.Parameter.VAR_KEYWORD for p in params.values())
+
+
+def _fallback_value(field, obj, source, context):
+    # the value of `field` from the first getter along its fallback chain not
+    # raising an AttributeError, as (kind, value, empty)
+    while True:
+        try:
+            if field.kind is _FIELD_LOOKUP:
+                try:
+                    if field.takes_context:
+                        return field.kind, field.getter(obj, field.name, source, context=context), False
+                    return field.kind, field.getter(obj, field.name, source), False
+                except InvalidFieldLookup:
+                    return field.kind, field.empty(), True
+            if field.takes_context:
+                return field.kind, field.getter(obj, source, context=context), False
+            return field.kind, field.getter(obj, source), False
+        except AttributeError:
+            if field.fallback is None:
+                raise
+            field = field.fallback
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class BatchContext:
+    """
+    Handed to field getters (`get_<field>_value`, `serialize_<field>`,
+    `get_value`) that accept a `context` keyword argument. It is created by
+    `prepare_batch()` once per batch of objects serialized together, so
+    lookups that would otherwise cost a query per object can be computed
+    once per batch and stored on it. Inner doc serializers get the context
+    of the top-level serializer.
+    """
+    def __init__(self, objs):
+        self.objs = objs
+
+
+def compile_accessor(path):
+    """
+    Returns a callable `accessor(obj)` resolving the dot-separated `path`
+    against `obj`. Plain attribute chains are resolved by `operator.attrgetter`
+    and plain dicts (eg. rows from a Django `values()` query) by key; anything
+    else (other Mappings, `None` part way along the path) falls back to a
+    part-by-part walk, raising `InvalidFieldLookup` as `get_value` always has.
+    """
+    parts = tuple(path.split('.'))
+    fast = operator.attrgetter(path)
+
+    def accessor(obj):
+        if type(obj) is dict:
+            return _walk_dict(obj, parts)
+        try:
+            return fast(obj)
+        except AttributeError:
+            return _walk_path(obj, parts)
+
+    return accessor
+
+
 class _SerializerMetaclass(type):
     def __init__(cls, name, bases, attrs):
         super().__init__(name, bases, attrs)
@@ -36,15 +163,36 @@ class _SerializerMetaclass(type):
             cls.registry[cls.document] = cls
             cls.hash_registry[hash(cls)] = cls
 
+    def __hash__(cls):
+        # the same in every process (the default hash is id-based), so that
+        # `hash_registry` identifies serializers in spawned workers too
+        return zlib.crc32(cls.qualified_name().encode('utf-8'))
+
 
 class Serializer(metaclass=_SerializerMetaclass):
     compatibility_hooks = set()
     document = None
     index = None
     map_fields = {}
-    data_bulk_limit = 500
+    data_bulk_limit = 500  # documents in the first bulk request
+    data_bulk_adaptive = True  # resize bulk requests based on their latency/rejections
+    data_bulk_max_bytes = 10 * 1024 * 1024
+    data_bulk_target_latency = 2.0  # seconds
+    data_bulk_max_retries = 5  # for items rejected with 429s
+    # > 0 sends this many bulk requests concurrently while serializing up to
+    # `data_bulk_pipeline_depth` chunks ahead (defaults to twice the concurrency)
+    data_bulk_concurrency = 0
+    data_bulk_pipeline_depth = None
+    # 'auto' (orjson when installed, else the stdlib), 'orjson', 'json', or
+    # 'client'/None to leave encoding to the Elasticsearch client
+    data_bulk_encoder = 'auto'
+    # how many bulk results between progress callbacks
+    progress_every = 100
+    # objects per `prepare_batch()` call when bulk indexing
+    serialize_batch_size = 500
     parallel_count = None
     client = None
+    async_client = None  # see esdocs.aio
 
     @classmethod
     def register_hooks(cls, modules):
@@ -57,6 +205,8 @@ class Serializer(metaclass=_SerializerMetaclass):
                 for mod in modules:
                     logger.debug('Added {}'.format(mod))
                     Serializer.compatibility_hooks.add(dotted_import(mod))
+                # compiled plans hold a snapshot of the hook chain
+                Serializer.reset_serialize_plans()
             else:
                 logger.debug('No serializer compatibility hooks specified.')
 
@@ -80,101 +230,202 @@ class Serializer(metaclass=_SerializerMetaclass):
         """
         return value
 
+    @classmethod
+    def get_accessor(cls, name):
+        # compiled accessors are cached per serializer class, keyed by field name
+        accessors = cls.__dict__.get('_accessors')
+        if accessors is None:
+            accessors = cls._accessors = {}
+        try:
+            return accessors[name]
+        except KeyError:
+            accessor = accessors[name] = compile_accessor(cls.map_fields.get(name) or name)
+            return accessor
+
     @classmethod
     def get_value(cls, obj, name, source=None):
-        parts = (cls.map_fields.get(name) or name).split('.')
-        v = obj
-        for n, part in enumerate(parts, start=1):
-            try:
-                v = getattr(v, part)
-            except AttributeError:
-                if not isinstance(v, collections.Mapping):
-                    raise
-                v = v.get(part)
+        return cls.get_accessor(name)(obj)
 
-            if v is None and n != len(parts):
-                # if we have None and we haven't finished processing the
-                # dot-separated field lookup, then it will blow up on the
-                # next iteration; handle it before it does
-                # eg. if a related Django ForeignKey field is set to `None`
-                raise InvalidFieldLookup
+    @classmethod
+    def compile_serialize_plan(cls):
+        # resolve, once per serializer class, everything `serialize` would
+        # otherwise look up for every field of every object: which method
+        # supplies the value, the compatibility hook chain and the inner doc
+        # serializer (if any)
+        cls.doc_fields = cls.document._doc_type.mapping.properties.properties.to_dict()
+
+        fields = []
+        for name, field in cls.doc_fields.items():
+            # first attempt user-defined method of manual serialization, then
+            # a user-defined value getter, then the generic `get_value` lookup
+            getters = [(_FIELD_LOOKUP, cls.get_value)]
+            for kind, method in ((_FIELD_GETTER, 'get_{}_value'), (_FIELD_SERIALIZE, 'serialize_{}')):
+                getter = getattr(cls, method.format(name), None)
+                if getter is not None:
+                    getters.append((kind, getter))
+
+            # if the field is an Object or Nested inner doc, the user will have
+            # defined an InnerDoc Mapper; the related Serializer is resolved lazily
+            # in case it is registered after this plan is compiled
+            subdoc = getattr(field, '_doc_class', None)
+            inner = cls.registry.get(subdoc) if subdoc is not None else None
+
+            plan_field = None
+            for kind, getter in getters:
+                plan_field = _PlanField(
+                    name, kind, getter, field.empty, subdoc, inner, takes_context(getter), plan_field)
+            fields.append(plan_field)
+
+        hooks = tuple(cls.compatibility_hooks)
+        if stats.enabled:
+            hooks = tuple(stats.timed(cls.__name__, 'hooks', f) for f in hooks)
+
+        plan = _SerializePlan(
+            fields=fields,
+            hooks=hooks,
+            normalize=cls.normalize_value,
+            adjust=cls.adjust_value,
+            takes_context=any(cls._field_takes_context(field) for field in fields)
+        )
+        # stored on the class itself (not inherited) so that subclasses
+        # compile their own plan against their own overrides
+        cls._serialize_plan = plan
+        return plan
+
+    @staticmethod
+    def _field_takes_context(field):
+        while field is not None:
+            if field.takes_context:
+                return True
+            field = field.fallback
+        return False
 
-        return v
+    @classmethod
+    def qualified_name(cls):
+        # identifies the serializer in state and dead-letter files
+        return '{}.{}'.format(cls.__module__, cls.__qualname__)
 
     @classmethod
-    def serialize(cls, obj, source=None):
-        if not hasattr(cls, 'doc_fields'):
-            cls.doc_fields = cls.document._doc_type.mapping.properties.properties.to_dict()
+    def reset_serialize_plans(cls):
+        # drops compiled plans and accessors; call this after changing hooks,
+        # `map_fields` or `map_<meta>` attributes at runtime
+        for serializer in list(cls.registry.values()) + [cls]:
+            for attr in ('_serialize_plan', '_accessors', '_meta_getters'):
+                if attr in serializer.__dict__:
+                    delattr(serializer, attr)
+
+    @classmethod
+    def prepare_batch(cls, objs):
+        # override to compute per-batch lookup tables (eg. aggregates from
+        # another table) once for `objs`, stored on the returned context for
+        # field getters that take a `context` argument
+        """ # example:
+        context = super().prepare_batch(objs)
+        context.comment_counts = dict(
+            Comment.objects.filter(post__in=objs).values_list('post').annotate(Count('id')))
+        return context
+        """
+        return BatchContext(objs)
+
+    @classmethod
+    def serialize_many(cls, objs):
+        objs = list(objs)
+        context = cls.prepare_batch(objs)
+        return [cls.serialize(obj, context=context) for obj in objs]
+
+    @classmethod
+    def serialize(cls, obj, source=None, context=None):
+        plan = cls.__dict__.get('_serialize_plan')
+        if plan is None:
+            plan = cls.compile_serialize_plan()
 
         if source is None:
             source = obj
 
+        if context is None and plan.takes_context:
+            # a lone object (eg. from a signal); a batch of one
+            context = cls.prepare_batch([obj])
+
+        hooks = plan.hooks
+        normalize = plan.normalize
+        adjust = plan.adjust
+
         data = {}
-        for name, field in cls.doc_fields.items():
+        for name, kind, getter, empty_value, subdoc, inner, with_context, fallback in plan.fields:
             empty = False
             try:
-                # first attempt user-defined method of manual serialization
-                v = getattr(cls, 'serialize_{}'.format(name))(obj, source)
-            except AttributeError:
-                try:
-                    # first attempt user-defined method
-                    v = getattr(cls, 'get_{}_value'.format(name))(obj, source)
-                except AttributeError:
+                if kind is _FIELD_LOOKUP:
                     try:
-                        v = cls.get_value(obj, name, source)
+                        v = getter(obj, name, source, context=context) if with_context else getter(obj, name, source)
                     except InvalidFieldLookup:
-                        v = field.empty()
+                        v = empty_value()
                         empty = True
+                else:
+                    v = getter(obj, source, context=context) if with_context else getter(obj, source)
+            except AttributeError:
+                # an AttributeError raised by a user-defined method falls
+                # through to the next getter, as it always has
+                if fallback is None:
+                    raise
+                kind, v, empty = _fallback_value(fallback, obj, source, context)
 
-                    if callable(v):
-                        v = v()
+            if kind is _FIELD_SERIALIZE:
+                data[name] = v
+                continue
 
-                for f in cls.compatibility_hooks: v = f(v)
-                v = cls.normalize_value(v)
-                v = cls.adjust_value(name, v)
+            if kind is _FIELD_LOOKUP and callable(v):
+                v = v()
 
-                if not empty and v is not None:
-                    # if the field is an Object or Nested inner doc, the user will have
-                    # defined an InnerDoc Mapper; if a related Serializer exists, it will
-                    # be used to populate data
+            for f in hooks: v = f(v)
+            v = normalize(v)
+            v = adjust(name, v)
+
+            if subdoc is not None and not empty and v is not None:
+                if inner is None:
                     try:
-                        subdoc = getattr(field, '_doc_class')
-                    except AttributeError:
-                        pass
-                    else:
-                        try:
-                            serializer = cls.registry[subdoc]
-                        except KeyError:
-                            raise MissingSerializer("Every Document and inner Document must have a registered Serializer.")
-                        else:
-                            if hasattr(v, '__iter__'):
-                                v = [serializer.serialize(_v, source) for _v in v]
-                            else:
-                                v = serializer.serialize(v, source)
+                        inner = cls.registry[subdoc]
+                    except KeyError:
+                        raise MissingSerializer("Every Document and inner Document must have a registered Serializer.")
+                if hasattr(v, '__iter__') and not isinstance(v, collections.abc.Mapping):
+                    v = [inner.serialize(_v, source, context) for _v in v]
+                else:
+                    v = inner.serialize(v, source, context)
 
             data[name] = v
 
         return data
 
     @classmethod
-    def get_meta_value(cls, obj, name):
-        try:
-            # first attempt user-defined method
-            func = getattr(cls, 'get_meta_{}_value'.format(name))
-        except AttributeError:
-            meta_lookup_value = getattr(cls, 'map_{}'.format(name), None)
-            if meta_lookup_value:
-                try:
-                    v = cls.get_value(obj, meta_lookup_value)
-                except InvalidFieldLookup:
-                    raise
+    def compile_meta_getter(cls, name):
+        # first attempt user-defined method
+        func = getattr(cls, 'get_meta_{}_value'.format(name), None)
+        if func is not None:
+            return func
 
-                if callable(v):
-                    v = v()
+        meta_lookup_value = getattr(cls, 'map_{}'.format(name), None)
+        if not meta_lookup_value:
+            return lambda obj: None
 
-                return v
-        else:
-            return func(obj)
+        get_value = cls.get_value
+
+        def getter(obj):
+            v = get_value(obj, meta_lookup_value)
+            if callable(v):
+                v = v()
+            return v
+
+        return getter
+
+    @classmethod
+    def get_meta_value(cls, obj, name):
+        getters = cls.__dict__.get('_meta_getters')
+        if getters is None:
+            getters = cls._meta_getters = {}
+        try:
+            getter = getters[name]
+        except KeyError:
+            getter = getters[name] = cls.compile_meta_getter(name)
+        return getter(obj)
 
     @classmethod
     def should_index(cls, obj, client=None):
@@ -189,21 +440,18 @@ class Serializer(metaclass=_SerializerMetaclass):
     def index_add(cls, obj, client=None):
         if cls.should_index(obj, client):
             data = cls.serialize(obj)
-            params = {}
-            # `id` can be None, causing ES to generate an id for
-            # the doc (not desired in the parent of a parent/child
-            # join field; it needs to be known to join properly)
-            _id = cls.get_meta_value(obj, 'id')
-            routing = cls.get_meta_value(obj, 'routing')
-            if routing is not None:
-                params['routing'] = routing
-
+            _id, params = cls._index_params(obj)
             (client or cls.client).index(cls.document._default_index(), data, id=_id, params=params)
             return True
         return False
 
     @classmethod
     def index_delete(cls, obj, client=None):
+        _id, params = cls._index_params(obj)
+        (client or cls.client).delete(cls.document._default_index(), id=_id, params=params, ignore=[404])
+
+    @classmethod
+    def _index_params(cls, obj):
         params = {}
         # `id` can be None, causing ES to generate an id for
         # the doc (not desired in the parent of a parent/child
@@ -212,52 +460,271 @@ class Serializer(metaclass=_SerializerMetaclass):
         routing = cls.get_meta_value(obj, 'routing')
         if routing is not None:
             params['routing'] = routing
-
-        (client or cls.client).delete(cls.document._default_index(), id=_id, params=params, ignore=[404])
+        return _id, params
 
     @classmethod
     def fetch_data(cls, **kwargs):
         raise NotImplementedError
 
+    @classmethod
+    def close_fetch_thread(cls):
+        # called from a thread that fetched data on behalf of an event loop
+        # (see esdocs.aio) once it is done with it; override to close what
+        # fetching opened in that thread (eg. database connections)
+        pass
+
+    @classmethod
+    def fetch_changed_data(cls, since, **kwargs):
+        # override to yield only the objects added or changed after the
+        # `since` datetime; used by delta indexing (`esdocs sync`)
+        raise NotImplementedError
+
     @classmethod
     def fetch_data_length(cls, **kwargs):
         raise NotImplementedError
 
     @classmethod
-    def _bulk_stream(cls, op_type=None, **options):
+    def fetch_data_partitions(cls, count, **kwargs):
+        # override to split the data into (up to) `count` `(lo, hi]` key ranges
+        # for parallel indexing; `fetch_data` then receives one of them as the
+        # `parallel_range` option. `None` falls back to offset-based chunks
+        return None
+
+    @classmethod
+    def fetch_data_by_ids(cls, ids, **kwargs):
+        # override to yield the objects with the given document `_id`s; used
+        # to re-send failed documents (`esdocs retry`)
+        raise NotImplementedError
+
+    @classmethod
+    def _action_parts(cls, obj, op_type, context=None):
+        # the op type, action metadata and (for non-delete ops) document
+        # source of the bulk action for `obj`
+        source = None
+        op = op_type
+        if op != 'delete':
+            if not cls.should_index(obj):
+                op = 'delete'
+            elif stats.enabled:
+                started = time.perf_counter()
+                source = cls.serialize(obj, context=context)
+                stats.add(cls.__name__, 'serialize', time.perf_counter() - started)
+            else:
+                source = cls.serialize(obj, context=context)
+
+        meta = {}
+
+        _id = cls.get_meta_value(obj, 'id')
+        if _id is not None:
+            meta['_id'] = _id
+
+        routing = cls.get_meta_value(obj, 'routing')
+        if routing is not None:
+            meta['routing'] = routing
+
+        return op, meta, source
+
+    @classmethod
+    def bulk_action(cls, obj, op_type='index', context=None):
+        op, meta, source = cls._action_parts(obj, op_type, context)
+        data = source if source is not None else {}
+        data['_op_type'] = op
+        data.update(meta)
+        return data
+
+    @classmethod
+    def bulk_encoded_action(cls, obj, encoder, op_type='index', context=None):
+        # the NDJSON bulk lines for `obj`, encoded directly rather than via
+        # an action dict that the client would have to re-serialize
+        op, meta, source = cls._action_parts(obj, op_type, context)
+        started = time.perf_counter() if stats.enabled else None
+        data = encoder.dumps({op: meta}) + b'\n'
+        if source is not None:
+            data += encoder.dumps(source) + b'\n'
+        if started is not None:
+            stats.add(cls.__name__, 'encode', time.perf_counter() - started)
+        return EncodedAction(op, meta.get('_id'), data)
+
+    @classmethod
+    def _bulk_stream(cls, op_type=None, encoder=None, **options):
         op_type = op_type if op_type else 'index'
-        for o in cls.fetch_data(**options):
-            data = {}
-            op = op_type
-            if op != 'delete':
-                if not cls.should_index(o):
-                    op = 'delete'
-                else:
-                    data = cls.serialize(o)
+        if options.get('since') is not None:
+            data_source = cls.fetch_changed_data(**options)
+        else:
+            data_source = cls.fetch_data(**options)
 
-            data['_op_type'] = op
+        if stats.enabled:
+            data_source = stats.timed_iter(cls.__name__, 'fetch', data_source)
 
-            _id = cls.get_meta_value(o, 'id')
-            if _id is not None:
-                data['_id'] = _id
+        for batch in batches(data_source, cls.serialize_batch_size):
+            for action in cls._batch_actions(batch, op_type, encoder):
+                yield action
 
-            routing = cls.get_meta_value(o, 'routing')
-            if routing is not None:
-                data['routing'] = routing
+    @classmethod
+    def _batch_actions(cls, batch, op_type, encoder=None):
+        if stats.enabled:
+            started = time.perf_counter()
+            context = cls.prepare_batch(batch)
+            stats.add(cls.__name__, 'prepare_batch', time.perf_counter() - started, len(batch))
+        else:
+            context = cls.prepare_batch(batch)
 
-            yield data
+        if encoder is not None:
+            return [cls.bulk_encoded_action(o, encoder, op_type, context) for o in batch]
+        return [cls.bulk_action(o, op_type, context) for o in batch]
+
+    @classmethod
+    def get_digest_store(cls, **options):
+        # the optional content-hash cache used to skip unchanged documents
+        path = options.get('digest_cache') or os.getenv('ESDOCS_DIGEST_CACHE')
+        if not path:
+            return None
+        return DigestStore.open(path)
 
     @classmethod
-    def bulk_operation(cls, index=None, client=None, **options):
-        for ok, result in streaming_bulk(
+    def get_bulk_encoder(cls):
+        # `None` leaves encoding to the Elasticsearch client's serializer
+        if cls.data_bulk_encoder in (None, 'client'):
+            return None
+        return get_encoder(cls.data_bulk_encoder)
+
+    @classmethod
+    def get_dead_letter(cls, **options):
+        # where failed bulk items are recorded for `esdocs retry`
+        return DeadLetterFile(options.get('dead_letter'))
+
+    @classmethod
+    def bulk_operation(cls, index=None, client=None, progress=None, **options):
+        index = index or cls.document._default_index()
+        encoder = cls.get_bulk_encoder()
+        actions = cls._bulk_stream(encoder=encoder, **options)
+        dead_letter = cls.get_dead_letter(**options)
+
+        digests = cls.get_digest_store(**options)
+        if digests is None:
+            return cls.bulk_send(
+                actions, index=index, client=client, encoder=encoder, progress=progress, dead_letter=dead_letter)
+
+        # digests are kept per target index; a rebuild refreshes them without
+        # skipping anything
+        digest_index = options.get('digest_index') or index
+        actions = digests.filter(digest_index, actions, skip=not options.get('digest_refresh'))
+        try:
+            result = cls.bulk_send(
+                actions, index=index, client=client, encoder=encoder, digests=digests, digest_index=digest_index,
+                progress=progress, dead_letter=dead_letter)
+        finally:
+            digests.commit()
+
+        hits, misses = digests.reset_counts()
+        logger.info("   '{}': {} unchanged documents skipped, {} sent".format(cls.document.__name__, hits, misses))
+        return result
+
+    @classmethod
+    def get_bulk_sizer(cls):
+        # one per serializer per process, so what it learns carries over
+        # from one chunk/bulk operation to the next
+        sizer = cls.__dict__.get('_bulk_sizer')
+        if sizer is None:
+            sizer = cls._bulk_sizer = AdaptiveBulkSizer(
+                initial=cls.data_bulk_limit,
+                max_bytes=cls.data_bulk_max_bytes,
+                target_latency=cls.data_bulk_target_latency,
+                adaptive=cls.data_bulk_adaptive
+            )
+        return sizer
+
+    @classmethod
+    def bulk_send(cls, actions, index=None, client=None, encoder=None, digests=None, digest_index=None,
+                  progress=None, dead_letter=None):
+        # returns the number of successful and failed actions; `progress`, if
+        # given, is called with the (ok, failed) counts since its last call.
+        # Failed actions are recorded in `dead_letter`, if given
+        index = index or cls.document._default_index()
+        encoder = encoder or cls.get_bulk_encoder()
+        if cls.data_bulk_concurrency > 0:
+            results = pipelined_streaming_bulk(
                 client or cls.client,
-                cls._bulk_stream(**options),
-                index=index or cls.document._default_index(),
-                raise_on_error=False,
-                yield_ok=False,
-                chunk_size=cls.data_bulk_limit
-        ):
-            if not ok:
-                action, result = result.popitem()
-                doc_id = '/%s/_doc/%s' % (index, result['_id'])
-                logger.warning('Failed to {} document {}: {}'.format(action, doc_id, result))
+                actions,
+                index=index,
+                sizer=cls.get_bulk_sizer(),
+                encoder=encoder,
+                label=cls.__name__,
+                concurrency=cls.data_bulk_concurrency,
+                depth=cls.data_bulk_pipeline_depth,
+                max_retries=cls.data_bulk_max_retries
+            )
+        else:
+            results = adaptive_streaming_bulk(
+                client or cls.client,
+                actions,
+                index=index,
+                sizer=cls.get_bulk_sizer(),
+                encoder=encoder,
+                label=cls.__name__,
+                max_retries=cls.data_bulk_max_retries
+            )
+
+        ok_count = failed_count = 0
+        reported_ok = reported_failed = 0
+        for ok, result in results:
+            if progress is not None and ok_count + failed_count - reported_ok - reported_failed >= cls.progress_every:
+                progress(ok_count - reported_ok, failed_count - reported_failed)
+                reported_ok, reported_failed = ok_count, failed_count
+
+            if cls._bulk_result(ok, result, index, digests, digest_index, dead_letter):
+                ok_count += 1
+            else:
+                failed_count += 1
+
+        if progress is not None:
+            progress(ok_count - reported_ok, failed_count - reported_failed)
+        return ok_count, failed_count
+
+    @classmethod
+    def _bulk_result(cls, ok, result, index, digests=None, digest_index=None, dead_letter=None):
+        # handles the result of one bulk action; returns whether it succeeded
+        action, result = result.popitem()
+        if ok or (action == 'delete' and result.get('status') == 404):
+            # (deletes of documents already gone are ignored, as `index_delete` does)
+            if digests is not None:
+                digests.confirm(digest_index or index, result.get('_id'))
+            return True
+
+        if digests is not None:
+            digests.discard(digest_index or index, result.get('_id'))
+        doc_id = '/%s/_doc/%s' % (index, result['_id'])
+        logger.warning('Failed to {} document {}: {}'.format(action, doc_id, result))
+        if dead_letter is not None:
+            dead_letter.add(cls, index, action, result.get('_id'), result)
+        return False
+
+    @classmethod
+    def bulk_retry(cls, records, index=None, client=None, **options):
+        # re-sends this serializer's dead-letter `records`: objects are
+        # re-fetched by `_id` and indexed again (or deleted, if they are
+        # gone), failed deletes are repeated. Returns the number of
+        # successful and failed actions
+        latest = collections.OrderedDict()
+        for record in records:
+            if record['_id'] is None:
+                logger.warning("Cannot retry a '{}' {} without an '_id'; skipping.".format(
+                    cls.document.__name__, record['op_type']))
+                continue
+            latest[str(record['_id'])] = record
+
+        actions = [
+            {'_op_type': 'delete', '_id': doc_id} for doc_id, record in latest.items() if record['op_type'] == 'delete'
+        ]
+        ids = [doc_id for doc_id, record in latest.items() if record['op_type'] != 'delete']
+        if ids:
+            missing = set(ids)
+            for obj in cls.fetch_data_by_ids(ids, **options):
+                action = cls.bulk_action(obj)
+                missing.discard(str(action.get('_id')))
+                actions.append(action)
+            actions.extend({'_op_type': 'delete', '_id': doc_id} for doc_id in ids if doc_id in missing)
+
+        if not actions:
+            return 0, 0
+        return cls.bulk_send(actions, index=index, client=client, dead_letter=cls.get_dead_letter(**options))
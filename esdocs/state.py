@@ -0,0 +1,256 @@
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_FILE = '.esdocs-state.json'
+
+_relative_re = re.compile(r'^(\d+)([smhdw])$')
+_relative_units = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+_timestamp_formats = [
+    '%Y-%m-%dT%H:%M:%S.%f%z',
+    '%Y-%m-%dT%H:%M:%S%z',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d',
+]
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def parse_timestamp(value):
+    """
+    Parses an ISO 8601-ish timestamp or a relative age such as '90m', '6h'
+    or '2d' into a timezone-aware datetime. Naive timestamps are taken as UTC.
+    """
+    value = value.strip()
+    match = _relative_re.match(value)
+    if match:
+        amount, unit = match.groups()
+        return now() - datetime.timedelta(**{_relative_units[unit]: int(amount)})
+
+    # `%z` doesn't accept 'Z' or a colon in the offset before Python 3.7
+    normalized = value[:-1] + '+0000' if value.endswith('Z') else value
+    normalized = re.sub(r'([+-]\d\d):(\d\d)$', r'\1\2', normalized)
+    for fmt in _timestamp_formats:
+        try:
+            parsed = datetime.datetime.strptime(normalized, fmt)
+        except ValueError:
+            continue
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+        return parsed
+
+    raise ValueError("Unrecognized timestamp '{}'".format(value))
+
+
+def format_timestamp(value):
+    return value.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f+0000')
+
+
+class StateFile:
+    """
+    A small JSON document on local disk holding esdocs bookkeeping (sync
+    watermarks, rebuild checkpoints, ...) grouped into named sections.
+    """
+    def __init__(self, path=None):
+        self.path = path or os.getenv('ESDOCS_STATE_FILE') or DEFAULT_STATE_FILE
+        # indexes may be finalized in background threads (`rebuild --concurrent`)
+        self.lock = threading.RLock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save(self, data):
+        # write to a temporary file and rename it over the original so an
+        # interrupted write never leaves a truncated state file behind
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            # eg. dates in key range checkpoints are kept as strings
+            json.dump(data, f, indent=2, sort_keys=True, default=str)
+        os.replace(tmp_path, self.path)
+
+    def get(self, section, key, default=None):
+        return self.load().get(section, {}).get(key, default)
+
+    def set(self, section, key, value):
+        with self.lock:
+            data = self.load()
+            data.setdefault(section, {})[key] = value
+            self.save(data)
+
+    def update(self, section, key, func, default=None):
+        # read-modify-write of a single value; `func` gets the current value
+        # (or `default`) and returns the new one
+        with self.lock:
+            data = self.load()
+            value = func(data.setdefault(section, {}).get(key, default))
+            data[section][key] = value
+            self.save(data)
+            return value
+
+    def delete(self, section, key):
+        with self.lock:
+            data = self.load()
+            if data.get(section, {}).pop(key, None) is not None:
+                self.save(data)
+
+
+class RebuildCheckpoint:
+    """
+    Progress of one index rebuild, kept in the state file under the index
+    (alias) name so that `rebuild --resume` can pick it up after a failure:
+    the dated index being loaded, its original settings, and per serializer
+    the chunk plan, the chunks completed so far and whether it is done.
+
+    Completed chunks are written at most every `save_interval` seconds (and
+    when a serializer is done); those completed since the last write are
+    indexed again when resuming.
+    """
+    section = 'rebuild'
+    save_interval = 5
+
+    def __init__(self, state_file, name):
+        self.state = state_file
+        self.name = name
+        # qualified serializer name -> completed chunk numbers not yet written
+        self.pending = {}
+        self.saved_at = time.monotonic()
+
+    def load(self):
+        return self.state.get(self.section, self.name)
+
+    def start(self, index_name, original_settings):
+        self.state.set(self.section, self.name, {
+            'index': index_name,
+            'original_settings': original_settings,
+            'serializers': {},
+            'loaded': False,
+            'started': format_timestamp(now()),
+        })
+
+    def finish(self):
+        self.pending = {}
+        self.state.delete(self.section, self.name)
+
+    def _serializer(self, serializer):
+        entry = self.load() or {}
+        return entry.get('serializers', {}).get(serializer.qualified_name(), {})
+
+    def _update_serializer(self, serializer, func):
+        def update(entry):
+            entry = entry or {}
+            serializers = entry.setdefault('serializers', {})
+            func(serializers.setdefault(serializer.qualified_name(), {}))
+            return entry
+        self.state.update(self.section, self.name, update)
+
+    def get_plan(self, serializer):
+        return self._serializer(serializer).get('plan')
+
+    def set_plan(self, serializer, plan):
+        self.pending.pop(serializer.qualified_name(), None)
+        self._update_serializer(serializer, lambda entry: entry.update(plan=plan, chunks=[]))
+
+    def completed_chunks(self, serializer):
+        chunks = set(self._serializer(serializer).get('chunks', []))
+        return chunks | self.pending.get(serializer.qualified_name(), set())
+
+    def complete_chunks(self, serializer, chunk_nums):
+        with self.state.lock:
+            self.pending.setdefault(serializer.qualified_name(), set()).update(chunk_nums)
+            if time.monotonic() - self.saved_at >= self.save_interval:
+                self.save()
+
+    def save(self):
+        # writes the pending completed chunks
+        with self.state.lock:
+            pending, self.pending = self.pending, {}
+            self.saved_at = time.monotonic()
+            if not pending:
+                return
+
+            def update(entry):
+                entry = entry or {}
+                serializers = entry.setdefault('serializers', {})
+                for name, chunk_nums in pending.items():
+                    serializer = serializers.setdefault(name, {})
+                    serializer['chunks'] = sorted(set(serializer.get('chunks', [])) | chunk_nums)
+                return entry
+            self.state.update(self.section, self.name, update)
+
+    def is_done(self, serializer):
+        return self._serializer(serializer).get('done', False)
+
+    def mark_done(self, serializer):
+        with self.state.lock:
+            self.pending.pop(serializer.qualified_name(), None)
+            self._update_serializer(serializer, lambda entry: entry.update(done=True))
+
+    @property
+    def loaded(self):
+        return (self.load() or {}).get('loaded', False)
+
+    def mark_loaded(self):
+        def update(entry):
+            entry = entry or {}
+            entry['loaded'] = True
+            return entry
+        self.state.update(self.section, self.name, update)
+
+
+class SerializerManifest:
+    """
+    The indexes documented by the serializers of each serializer module,
+    kept in the state file so that the `esdocs` command can leave out the
+    modules of indexes it doesn't target (see `register_serializers`). An
+    entry is only trusted while the module's source file is unchanged.
+    """
+    section = 'serializers'
+
+    def __init__(self, state_file):
+        self.state = state_file
+        self.entries = state_file.load().get(self.section, {})
+
+    @staticmethod
+    def mtime(module):
+        # finding a module imports its parent packages, but not the module
+        try:
+            spec = importlib.util.find_spec(module)
+        except (ImportError, ValueError):
+            return None
+        if spec is None or not spec.origin or not os.path.isfile(spec.origin):
+            return None
+        return os.path.getmtime(spec.origin)
+
+    def get(self, module):
+        # the index names of `module`'s serializers; `None` if not known
+        entry = self.entries.get(module)
+        if entry is None or entry['mtime'] is None or entry['mtime'] != self.mtime(module):
+            return None
+        return entry['indexes']
+
+    def record(self, module, indexes):
+        entry = {'mtime': self.mtime(module), 'indexes': sorted(indexes)}
+        if self.entries.get(module) != entry:
+            self.entries[module] = entry
+            try:
+                self.state.set(self.section, module, entry)
+            except OSError as e:
+                # just a cache; eg. a read-only working directory
+                logger.debug("Could not cache the indexes of '{}': {}".format(module, e))
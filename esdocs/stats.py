@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+from collections import defaultdict
+
+# 'hooks' time is also counted in 'serialize'
+STAGES = ['fetch', 'prepare_batch', 'serialize', 'hooks', 'encode', 'bulk_request']
+
+
+class Stats:
+    """
+    Per-process counters and timers, keyed by (serializer, stage). Disabled
+    by default; the instrumented code paths check `enabled` first so there
+    is no cost unless `--stats` is used. Worker processes send their
+    `collect()`ed deltas back to the parent, which `merge()`s them.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.data = defaultdict(lambda: [0, 0.0])
+        # pipelined bulk requests report from several threads
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def add(self, serializer, stage, seconds, count=1):
+        with self.lock:
+            entry = self.data[(serializer, stage)]
+            entry[0] += count
+            entry[1] += seconds
+
+    def timed_iter(self, serializer, stage, iterable):
+        # times only the iterator's own work, not the consumer's
+        iterator = iter(iterable)
+        clock = time.perf_counter
+        while True:
+            started = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(serializer, stage, clock() - started, 0)
+                return
+            self.add(serializer, stage, clock() - started)
+            yield item
+
+    def timed(self, serializer, stage, func):
+        clock = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            started = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(serializer, stage, clock() - started)
+
+        return wrapper
+
+    def collect(self):
+        # returns the counters gathered so far (as plain, picklable data)
+        # and starts afresh
+        with self.lock:
+            data = [[serializer, stage, count, seconds] for (serializer, stage), (count, seconds) in self.data.items()]
+            self.data.clear()
+        return data
+
+    def merge(self, data):
+        for serializer, stage, count, seconds in data or []:
+            self.add(serializer, stage, seconds, count)
+
+    def rows(self):
+        order = {stage: n for n, stage in enumerate(STAGES)}
+        return sorted(
+            ([serializer, stage, count, seconds] for (serializer, stage), (count, seconds) in self.data.items()),
+            key=lambda row: (row[0], order.get(row[1], len(order)), row[1])
+        )
+
+    def report(self):
+        lines = ['{:<30} {:<14} {:>12} {:>12} {:>12}'.format('serializer', 'stage', 'count', 'seconds', 'avg (ms)')]
+        for serializer, stage, count, seconds in self.rows():
+            lines.append('{:<30} {:<14} {:>12} {:>12.3f} {:>12.3f}'.format(
+                serializer, stage, count, seconds, seconds / count * 1000 if count else 0))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return json.dumps([
+            {'serializer': serializer, 'stage': stage, 'count': count, 'seconds': seconds}
+            for serializer, stage, count, seconds in self.rows()
+        ], indent=2)
+
+    def to_prometheus(self):
+        lines = [
+            '# HELP esdocs_stage_seconds_total Time spent per esdocs indexing stage.',
+            '# TYPE esdocs_stage_seconds_total counter',
+        ]
+        rows = self.rows()
+        for serializer, stage, count, seconds in rows:
+            lines.append('esdocs_stage_seconds_total{{serializer="{}",stage="{}"}} {}'.format(serializer, stage, seconds))
+        lines += [
+            '# HELP esdocs_stage_calls_total Number of items processed per esdocs indexing stage.',
+            '# TYPE esdocs_stage_calls_total counter',
+        ]
+        for serializer, stage, count, seconds in rows:
+            lines.append('esdocs_stage_calls_total{{serializer="{}",stage="{}"}} {}'.format(serializer, stage, count))
+        return '\n'.join(lines) + '\n'
+
+
+stats = Stats()
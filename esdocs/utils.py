@@ -2,26 +2,48 @@ import argparse
 import logging
 import os
 
-from . import gevent_enabled
-from .controller import Controller
-from .serializer import Serializer
-
 logger = logging.getLogger(__name__)
 
 
-def register_serializers(modules, client=None):
+def register_serializers(modules, client=None, manifest=None, index_names=None):
+    # given a `SerializerManifest` (see state.py) and the `index_names`
+    # needed (`None` for all of them), modules known to only hold serializers
+    # of other indexes aren't imported; returns the index names of those
+    from .serializer import Serializer
+
+    skipped = []
     if modules is not None:
         if isinstance(modules, str):
             modules = [s.strip() for s in modules.split(',')]
 
         if modules:
             for mod in modules:
+                indexes = manifest.get(mod) if manifest is not None else None
+                if indexes is not None and index_names is not None:
+                    # modules without indexes may hold inner document serializers
+                    needed = set(indexes) & set(index_names) if indexes else index_names
+                    if not needed:
+                        logger.debug("Skipping '{}' (serializers for {})".format(mod, ', '.join(indexes) or 'no indexes'))
+                        skipped.extend(indexes)
+                        continue
+
                 logger.debug("Looking for serializers in '{}'...".format(mod))
+                registered = set(Serializer.registry)
                 # a simple import triggers metaclass Serializer class 'self-registration'
                 __import__(mod)
+                if manifest is not None:
+                    # serializers defined in `mod`, and any it brings in from
+                    # modules that aren't listed themselves; not those of
+                    # listed modules it happens to import first
+                    manifest.record(mod, set(
+                        doc._index._name for doc, serializer in Serializer.registry.items()
+                        if getattr(doc, '_index', None) and (
+                            serializer.__module__ == mod or
+                            (doc not in registered and serializer.__module__ not in modules))))
             Serializer.client = client
         else:
             logger.warning('No serializer modules specified!')
+    return skipped
 
 
 def add_parser_arguments(parser):
@@ -35,6 +57,40 @@ def add_parser_arguments(parser):
     parent.add_argument('--multi', nargs='?', const=0, type=int,
                         help="Enable multiple processes and optionally set number of "
                              "CPU cores to use (defaults to all cores)")
+    parent.add_argument('--process-pool', nargs='?', const='spawn', choices=['spawn', 'forkserver'],
+                        default=None, dest='process_pool',
+                        help="With --multi, use a standard library process pool started with the given "
+                             "method (default spawn) rather than gevent/gipc; the default without "
+                             "ESDOCS_GEVENT=1")
+    parent.add_argument('--no-manifest', action='store_true', default=False, dest='no_manifest',
+                        help="Import every serializer module rather than only those of the targeted "
+                             "indexes (as cached in the state file)")
+    parent.add_argument('--state-file', action='store', default=None, dest='state_file',
+                        help="File holding sync watermarks and other esdocs state "
+                             "(defaults to $ESDOCS_STATE_FILE or .esdocs-state.json)")
+    parent.add_argument('--digest-cache', action='store', default=None, dest='digest_cache',
+                        help="SQLite file of document digests used to skip re-sending "
+                             "unchanged documents (defaults to $ESDOCS_DIGEST_CACHE)")
+    parent.add_argument('--dead-letter', action='store', default=None, dest='dead_letter',
+                        help="NDJSON file recording documents that failed to index, for `retry` "
+                             "(defaults to $ESDOCS_DEAD_LETTER_FILE or .esdocs-dead-letter.ndjson)")
+
+    # arguments for commands that bulk index data
+    indexing = argparse.ArgumentParser(add_help=False)
+    indexing.add_argument('--stats', action='store_true', default=False,
+                          help="Time each indexing stage and print a breakdown when done")
+    indexing.add_argument('--stats-file', action='store', default=None, dest='stats_file',
+                          help="Also write the --stats breakdown to this file (Prometheus "
+                               "text if it ends in .prom, JSON otherwise)")
+    indexing.add_argument('--progress', action='store', nargs='?', type=float, const=10, default=None,
+                          dest='progress_interval', metavar='SECONDS',
+                          help="Report documents done, docs/sec and ETA per serializer every "
+                               "SECONDS (default 10)")
+    indexing.add_argument('--async', action='store_true', default=False, dest='use_async',
+                          help="Index on an asyncio event loop with several concurrent bulk requests "
+                               "(requires elasticsearch[async])")
+    indexing.add_argument('--progress-tty', action='store_true', default=False, dest='progress_tty',
+                          help="With --progress, show a single updating line when stderr is a terminal")
 
     # hack to get comment args into the main parser;
     # stolen from python argparse source code
@@ -55,15 +111,44 @@ def add_parser_arguments(parser):
     p = sps.add_parser('list', help="List indexes", parents=[parent])
     p = sps.add_parser('init', help="Initialize indexes", parents=[parent])
     p = sps.add_parser('update', help="Update indexes", parents=[parent])
-    p = sps.add_parser('rebuild', help="Rebuild indexes", parents=[parent])
+    p = sps.add_parser('rebuild', help="Rebuild indexes", parents=[parent, indexing])
     p.add_argument('--cleanup', action="store_true", dest='delete_old_indexes',
                    default=False)
+    p.add_argument('--concurrent', type=int, default=None,
+                   help="Number of indexes to rebuild at once; force merging and alias "
+                        "swapping overlap with loading the next index")
+    p.add_argument('--resume', action='store_true', default=False,
+                   help="Continue an interrupted rebuild into the same index, skipping the chunks "
+                        "already indexed (as checkpointed in the state file, see --state-file)")
+    p.add_argument('--no-checkpoint', action='store_true', default=False, dest='no_checkpoint',
+                   help="Don't record the progress of the rebuild in the state file; it can't be "
+                        "resumed if interrupted")
     p = sps.add_parser('cleanup', help="Delete unaliased indexes", parents=[parent])
+    p = sps.add_parser('sync', help="Index data changed since a watermark", parents=[parent, indexing])
+    p.add_argument('--since', action='store', default=None,
+                   help="Timestamp (ISO 8601) or age (eg. 90m, 6h, 2d) to sync changes from; "
+                        "defaults to the end of the previous sync of each index")
+    p = sps.add_parser('dump', help="Write index data to compressed NDJSON bulk files", parents=[parent])
+    p.add_argument('--path', action='store', required=True,
+                   help="Directory to write the bulk files and their manifest to")
+    p.add_argument('--split-size', action='store', type=float, default=100, dest='split_size',
+                   help="Start a new file after this many MB of (uncompressed) bulk data (default 100)")
+    p = sps.add_parser('load', help="Rebuild indexes from `dump` files", parents=[parent, indexing])
+    p.add_argument('--path', action='store', required=True,
+                   help="Directory holding the bulk files and manifest written by `dump`")
+    p.add_argument('--cleanup', action="store_true", dest='delete_old_indexes',
+                   default=False)
+    p = sps.add_parser('retry', help="Re-send documents that previously failed to index", parents=[parent])
 
 
-def run(controller_klass=None):
+def run(controller_klass=None, setup=None):
+    # `controller_klass` may be given as a dotted path, and `setup` is
+    # called before anything else is imported (eg. `django.setup()`),
+    # returning False to stop; both so that gevent can patch the process
+    # first, when needed
     import argparse
     import logging
+    from contextlib import nullcontext
 
     from . import app_version, logger as parent_logger
 
@@ -71,9 +156,18 @@ def run(controller_klass=None):
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="increase output verbosity")
     parser.add_argument("--version", action="version", version=app_version)
+    parser.add_argument("--import-profile", action="store_true", dest='import_profile',
+                        help="report the time spent importing modules at start-up")
     add_parser_arguments(parser)
     args = parser.parse_args()
 
+    profiler = None
+    if args.import_profile:
+        from .importprofile import ImportProfiler
+        profiler = ImportProfiler()
+        profiler.start()
+    phase = profiler.phase if profiler is not None else lambda label: nullcontext()
+
     if args.verbose:
         logf = logging.Formatter('%(message)s (%(name)s:%(lineno)d)')
         parent_logger.setLevel(logging.DEBUG)
@@ -89,20 +183,58 @@ def run(controller_klass=None):
     logger.info('Logging enabled at {} verbosity'.format(
         logging.getLevelName(logger.getEffectiveLevel())))
 
-    if not gevent_enabled and args.multi is not None:
-        logger.error('Multi-process indexing not available unless environment '
-                     'variable ESDOCS_GEVENT=1 is set, stopping...')
+    if getattr(args, 'use_async', False) and args.multi is not None:
+        logger.error('--async and --multi can not be used together, stopping...')
         return
-    else:
-        logger.info('Multi-process indexing: {}'.format(
-            'available' if gevent_enabled else 'unavailable (set environment '
-                                               'variable ESDOCS_GEVENT=1)'))
 
-    register_serializers(os.getenv('ESDOCS_SERIALIZER_MODULES'))
-    Serializer.register_hooks(os.getenv('ESDOCS_SERIALIZER_COMPATIBILITY_HOOKS'))
+    if args.multi is not None:
+        from . import patch_gevent, use_gevent
+        if use_gevent and not args.process_pool:
+            with phase('gevent monkey-patching'):
+                gevent_enabled = patch_gevent()
+        else:
+            gevent_enabled = False
+
+        if gevent_enabled:
+            logger.info('Multi-process indexing: gevent/gipc')
+        elif args.process_pool:
+            logger.info('Multi-process indexing: process pool ({})'.format(args.process_pool))
+        else:
+            logger.info('Multi-process indexing: process pool (set environment '
+                        'variable ESDOCS_GEVENT=1 for gevent/gipc)')
+
+    if setup is not None:
+        with phase('setup'):
+            if setup() is False:
+                return
+
+    with phase('esdocs'):
+        from .serializer import Serializer, dotted_import
+        from .state import SerializerManifest, StateFile
+        if not controller_klass:
+            from .controller import Controller
+            controller_klass = Controller
+        elif isinstance(controller_klass, str):
+            controller_klass = dotted_import(controller_klass)
+
+    # `list` needs no serializers to list the indexes the manifest knows
+    manifest = None if args.no_manifest else SerializerManifest(StateFile(args.state_file))
+    index_names = [s.strip() for s in args.indexes.split(',')] if args.indexes else None
+    if args.action == 'list':
+        index_names = ()
+    with phase('serializer modules'):
+        unloaded_indexes = register_serializers(
+            os.getenv('ESDOCS_SERIALIZER_MODULES'), manifest=manifest, index_names=index_names)
+    with phase('compatibility hooks'):
+        Serializer.register_hooks(os.getenv('ESDOCS_SERIALIZER_COMPATIBILITY_HOOKS'))
+
+    if profiler is not None:
+        profiler.stop()
+        logger.info('Start-up import profile:')
+        for line in profiler.report().splitlines():
+            logger.info(line)
 
     options = vars(args)
-    if not controller_klass:
-        controller_klass = Controller
     controller = controller_klass(**options)
+    controller.unloaded_indexes = unloaded_indexes
     controller.run_operation(cmd_parser=parser, **options)
@@ -34,24 +34,27 @@ setup(
         'Programming Language :: Python',
         'Programming Language :: Python :: 3 :: Only',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Database',
         'Topic :: System :: Networking',
         'Topic :: Internet :: WWW/HTTP :: Indexing/Search',
     ],
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     py_modules=['esdocs'],
 
-    python_requires='>=3.4',
+    python_requires='>=3.7',
     install_requires=[
         'elasticsearch-dsl>=7,<8'
     ],
     extras_require={
-        'gevent': ['gevent', 'gipc']
+        'gevent': ['gevent', 'gipc'],
+        'async': ['elasticsearch[async]>=7.8,<8'],
+        'orjson': ['orjson']
     },
 
     entry_points = {
@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class EsdocsTestsConfig(AppConfig):
+    # installed so that the test models' reverse relations are resolved
+    name = 'tests'
+    label = 'esdocs_tests'
@@ -0,0 +1,45 @@
+from collections import defaultdict
+
+import pytest
+from elasticsearch_dsl import connections
+
+from benchmarks.fake_es import FakeElasticsearch, FakeElasticsearchHandler
+from esdocs.controller import Controller
+
+try:
+    import django
+except ImportError:
+    pass
+else:
+    # for the esdocs.contrib.esdjango tests
+    from django.conf import settings
+
+    if not settings.configured:
+        settings.configure(
+            INSTALLED_APPS=['tests'],
+            DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+        )
+        django.setup()
+
+
+@pytest.fixture
+def fake_es(monkeypatch):
+    # indexes exist once created
+    created = set()
+    do_put = FakeElasticsearchHandler.do_PUT
+
+    def put(handler):
+        created.add(handler.path.split('?', 1)[0].strip('/').split('/')[0])
+        do_put(handler)
+
+    def head(handler):
+        handler._respond(200 if handler.path.split('?', 1)[0].strip('/') in created else 404, {})
+
+    monkeypatch.setattr(FakeElasticsearchHandler, 'do_PUT', put)
+    monkeypatch.setattr(FakeElasticsearchHandler, 'do_HEAD', head)
+    # (serializers are otherwise collected again by every Controller)
+    monkeypatch.setattr(Controller, '_serializers', defaultdict(list))
+
+    with FakeElasticsearch() as es:
+        connections.configure(default={'hosts': [es.url]})
+        yield es
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from elasticsearch_dsl import Document, Keyword
+
+from benchmarks.documents import MemorySerializer, Row
+from esdocs.aio import AsyncStreamingPolicy, bulk_stream
+from esdocs.encoding import EncodedAction, get_encoder
+
+
+class AsyncDoc(Document):
+    name = Keyword()
+
+    class Index:
+        name = 'test-async'
+
+
+class AsyncSerializer(MemorySerializer):
+    document = AsyncDoc
+    size = 1000
+    closed = 0
+
+    @classmethod
+    def make_row(cls, n):
+        return Row(id=n, name='n{}'.format(n))
+
+    @classmethod
+    def close_fetch_thread(cls):
+        cls.closed += 1
+
+
+class AsyncGenDoc(AsyncDoc):
+    pass
+
+
+class AsyncGenSerializer(AsyncSerializer):
+    document = AsyncGenDoc
+
+    @classmethod
+    async def fetch_data(cls, **kwargs):
+        for row in cls.rows():
+            yield row
+
+
+def abulk_operation(fake_es, serializer, **options):
+    policy = AsyncStreamingPolicy(client=AsyncStreamingPolicy.create_client())
+
+    async def run():
+        try:
+            return await policy.abulk_operation(serializer, 'test-async', **options)
+        finally:
+            await policy.client.close()
+
+    return asyncio.run(run())
+
+
+def test_abulk_operation(fake_es, tmp_path):
+    AsyncSerializer.closed = 0
+    result = abulk_operation(fake_es, AsyncSerializer, dead_letter=str(tmp_path / 'dead-letter.ndjson'))
+    assert result == (1000, 0)
+    assert fake_es.stats['bulk_items'] == 1000
+    # batches of `data_bulk_limit` (500) documents
+    assert fake_es.stats['bulk_requests'] == 2
+    # the thread that fetched the data is closed
+    assert AsyncSerializer.closed == 1
+
+
+def test_abulk_operation_of_async_generator(fake_es, tmp_path):
+    result = abulk_operation(fake_es, AsyncGenSerializer, dead_letter=str(tmp_path / 'dead-letter.ndjson'))
+    assert result == (1000, 0)
+    assert fake_es.stats['bulk_items'] == 1000
+
+
+def test_abulk_operation_uses_digest_cache(fake_es, tmp_path):
+    options = {'digest_cache': str(tmp_path / 'digests.sqlite'), 'dead_letter': str(tmp_path / 'dead-letter.ndjson')}
+    assert abulk_operation(fake_es, AsyncSerializer, **options) == (1000, 0)
+    assert abulk_operation(fake_es, AsyncSerializer, **options) == (0, 0)
+    assert fake_es.stats['bulk_items'] == 1000
+
+
+def test_bulk_stream_encodes_actions():
+    async def first(encoder):
+        stream = bulk_stream(AsyncSerializer, encoder=encoder)
+        try:
+            return await stream.__anext__()
+        finally:
+            await stream.aclose()
+
+    action = asyncio.run(first(get_encoder('json')))
+    assert isinstance(action, EncodedAction) and action.id == 1
+    assert asyncio.run(first(None))['_id'] == 1
@@ -0,0 +1,160 @@
+import json
+import threading
+import time
+
+import pytest
+from elasticsearch import TransportError
+
+from esdocs import bulk
+from esdocs.bulk import AdaptiveBulkSizer, adaptive_streaming_bulk, pipelined_streaming_bulk
+from esdocs.encoding import get_encoder
+
+
+def test_sizer_grows_and_shrinks():
+    sizer = AdaptiveBulkSizer(initial=100, min_docs=10, max_docs=150, target_latency=2.0)
+    sizer.record(100, 0.5)
+    assert sizer.docs == 125
+    # a short tail batch doesn't grow it
+    sizer.record(20, 0.5)
+    assert sizer.docs == 125
+    sizer.record(125, 0.5)
+    assert sizer.docs == 150
+    sizer.record(150, 5.0)
+    assert sizer.docs == 112
+    sizer.record(112, 1.0, rejected=3)
+    assert sizer.docs == 56
+    for n in range(5):
+        sizer.record(56, 1.0, rejected=1)
+    assert sizer.docs == 10
+
+
+def test_fixed_sizer():
+    sizer = AdaptiveBulkSizer(initial=100, adaptive=False)
+    sizer.record(100, 0.1)
+    sizer.record(100, 10, rejected=100)
+    assert sizer.docs == 100
+
+
+class FakeClient:
+    """ Answers `bulk()` calls from a list of responses (or exceptions). """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.bodies = []
+
+    def bulk(self, body, index=None):
+        self.bodies.append(body)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def items(*statuses):
+    return {'items': [{'index': {'_id': str(n), 'status': status}} for n, status in enumerate(statuses)]}
+
+
+def actions(count):
+    return [{'_op_type': 'index', '_id': str(n), 'n': n} for n in range(count)]
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    delays = []
+    monkeypatch.setattr(bulk, '_backoff', lambda attempt, initial, maximum: delays.append(attempt))
+    return delays
+
+
+def send(client, count, **kwargs):
+    return list(adaptive_streaming_bulk(client, actions(count), encoder=get_encoder('json'), **kwargs))
+
+
+def test_chunks_are_capped_by_count_and_bytes():
+    client = FakeClient([items(201, 201), items(201, 201), items(201)] + [items(201, 201), items(201, 201), items(201)])
+    send(client, 5, sizer=AdaptiveBulkSizer(initial=2, adaptive=False))
+    assert [body.count(b'\n') for body in client.bodies] == [4, 4, 2]
+
+    # each action is 30 bytes
+    send(client, 5, sizer=AdaptiveBulkSizer(initial=100, max_bytes=70, adaptive=False))
+    assert [body.count(b'\n') for body in client.bodies[3:]] == [4, 4, 2]
+
+
+def test_rejected_items_are_retried(no_backoff):
+    client = FakeClient([items(201, 429, 201), items(201)])
+    sizer = AdaptiveBulkSizer(initial=30)
+    results = send(client, 3, sizer=sizer)
+
+    assert [ok for ok, item in results] == [True, True, True]
+    # only the rejected action is sent again
+    assert client.bodies[1].count(b'\n') == 2 and b'"_id":"1"' in client.bodies[1]
+    assert no_backoff == [0]
+    assert sizer.docs == 15
+
+
+def test_429_responses_are_retried(no_backoff):
+    client = FakeClient([TransportError(429, 'rejected'), TransportError(429, 'rejected'), items(201, 201)])
+    assert [ok for ok, item in send(client, 2)] == [True, True]
+    assert no_backoff == [0, 1]
+
+
+def test_retries_give_up():
+    client = FakeClient([items(429), items(429), items(429)])
+    assert [ok for ok, item in send(client, 1, max_retries=2)] == [False]
+    assert len(client.bodies) == 3
+
+    client = FakeClient([TransportError(429, 'rejected')] * 3)
+    with pytest.raises(TransportError):
+        send(client, 1, max_retries=2)
+
+    with pytest.raises(TransportError):
+        send(FakeClient([TransportError(500, 'broken')]), 1)
+
+
+class EchoClient:
+    """ Acknowledges every action, the first requests most slowly. """
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.lock = threading.Lock()
+        self.active = self.most_active = 0
+
+    def bulk(self, body, index=None):
+        lines = body.splitlines()
+        with self.lock:
+            delay = self.delays.pop(0) if self.delays else 0
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        time.sleep(delay)
+        with self.lock:
+            self.active -= 1
+        ids = [json.loads(line)['index']['_id'] for line in lines[::2]]
+        return {'items': [{'index': {'_id': _id, 'status': 201}} for _id in ids]}
+
+
+def test_pipelined_results_keep_their_order():
+    client = EchoClient([0.2, 0.1, 0.05])
+    sent = []
+
+    def produce():
+        for action in actions(50):
+            sent.append(action['n'])
+            yield action
+
+    results = []
+    for ok, result in pipelined_streaming_bulk(
+            client, produce(), encoder=get_encoder('json'), sizer=AdaptiveBulkSizer(initial=5, adaptive=False),
+            concurrency=3, depth=4):
+        # no more than `depth` chunks are in flight ahead of the results (plus
+        # the one waiting to be sent, and the action that ended it)
+        assert len(sent) <= len(results) + (4 + 1) * 5 + 1
+        results.append((ok, result['index']['_id']))
+
+    assert results == [(True, str(n)) for n in range(50)]
+    assert client.most_active == 3
+
+
+def test_pipelined_failures_are_raised():
+    client = FakeClient([items(201, 201), TransportError(400, 'bad request'), items(201, 201)])
+    results = pipelined_streaming_bulk(
+        client, actions(6), encoder=get_encoder('json'), sizer=AdaptiveBulkSizer(initial=2, adaptive=False),
+        concurrency=1)
+    with pytest.raises(TransportError):
+        list(results)
@@ -0,0 +1,95 @@
+import pytest
+from elasticsearch_dsl import Document, Keyword, connections
+
+from benchmarks.documents import MemorySerializer, Row
+from esdocs.digests import DigestStore
+from esdocs.encoding import EncodedAction
+
+
+class DigestDoc(Document):
+    name = Keyword()
+
+    class Index:
+        name = 'test-digests'
+
+
+class DigestSerializer(MemorySerializer):
+    document = DigestDoc
+    size = 100
+    suffix = ''
+
+    @classmethod
+    def make_row(cls, n):
+        return Row(id=n, name='n{}{}'.format(n, cls.suffix if n <= 10 else ''))
+
+
+@pytest.fixture
+def store(tmp_path):
+    return DigestStore(str(tmp_path / 'digests.sqlite'))
+
+
+def index_action(doc_id, name):
+    return {'_op_type': 'index', '_id': doc_id, 'name': name}
+
+
+def test_only_confirmed_digests_are_kept(store):
+    actions = [index_action(1, 'a'), index_action(2, 'b'), EncodedAction('index', 3, b'{"index":{}}\n{}\n')]
+    assert list(store.filter('idx', actions)) == actions
+    store.confirm('idx', 1)
+    store.confirm('idx', 3)
+    # eg. rejected by Elasticsearch
+    store.discard('idx', 2)
+    store.commit()
+
+    assert list(store.filter('idx', actions)) == [actions[1]]
+    assert list(store.filter('other', actions)) == actions
+    assert list(store.filter('idx', [index_action(1, 'changed')])) == [index_action(1, 'changed')]
+    assert list(store.filter('idx', actions, skip=False)) == actions
+    assert store.reset_counts() == (2, 11)
+
+
+def test_confirmed_digests_are_written_in_batches(store):
+    assert store.connection.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    store.commit_every = 3
+    list(store.filter('idx', [index_action(n, 'a') for n in range(5)]))
+    for n in range(5):
+        store.confirm('idx', n)
+        # no write transaction left open between bulk responses
+        assert not store.connection.in_transaction
+
+    other = DigestStore(store.path)
+    assert [other.get('idx', n) is not None for n in range(5)] == [True] * 3 + [False] * 2
+    store.commit()
+    assert other.get('idx', 4) is not None
+
+
+def test_deletes_drop_digests(store):
+    list(store.filter('idx', [index_action(1, 'a')]))
+    store.confirm('idx', 1)
+    store.commit()
+    assert store.get('idx', 1) is not None
+
+    delete = {'_op_type': 'delete', '_id': 1}
+    assert list(store.filter('idx', [delete])) == [delete]
+    store.confirm('idx', 1)
+    store.commit()
+    assert store.get('idx', 1) is None
+
+
+def test_unchanged_documents_are_not_resent(fake_es, tmp_path):
+    client = connections.get_connection()
+    options = {'digest_cache': str(tmp_path / 'digests.sqlite'), 'dead_letter': str(tmp_path / 'dead-letter.ndjson')}
+
+    DigestSerializer.bulk_operation(index='test-digests', client=client, **options)
+    assert fake_es.stats['bulk_items'] == 100
+
+    DigestSerializer.bulk_operation(index='test-digests', client=client, **options)
+    assert fake_es.stats['bulk_items'] == 100
+
+    # 10 changed documents
+    DigestSerializer.suffix, DigestSerializer._rows = '!', None
+    try:
+        DigestSerializer.bulk_operation(index='test-digests', client=client, **options)
+    finally:
+        DigestSerializer.suffix, DigestSerializer._rows = '', None
+    assert fake_es.stats['bulk_items'] == 110
@@ -0,0 +1,58 @@
+import gzip
+import os
+
+import pytest
+from elasticsearch_dsl import Document, Keyword
+
+from benchmarks.documents import MemorySerializer, Row
+from esdocs.controller import Controller
+from esdocs.dumps import read_actions, read_manifest
+
+
+class DumpDoc(Document):
+    name = Keyword()
+
+    class Index:
+        name = 'test-dump'
+
+
+class DumpSerializer(MemorySerializer):
+    document = DumpDoc
+    size = 1000
+
+    @classmethod
+    def make_row(cls, n):
+        return Row(id=n, name='n{}'.format(n))
+
+
+@pytest.fixture
+def options(tmp_path):
+    return {
+        'indexes': 'test-dump',
+        'path': str(tmp_path / 'dump'),
+        'state_file': str(tmp_path / 'state.json'),
+        'dead_letter': str(tmp_path / 'dead-letter.ndjson'),
+        'no_input': True,
+    }
+
+
+def test_dump_and_load(fake_es, options):
+    # ~10KB of bulk data per file
+    Controller(**options).index_dump(split_size=0.01, **options)
+
+    manifest = read_manifest(options['path'])
+    files = manifest['indexes']['test-dump']['files']
+    assert manifest['indexes']['test-dump']['docs'] == 1000
+    assert len(files) > 3
+    for dump_file in files[:-1]:
+        with gzip.open(os.path.join(options['path'], dump_file['path'])) as f:
+            size = len(f.read())
+        assert 10 * 1024 <= size < 11 * 1024
+
+    actions = []
+    for dump_file in files:
+        actions.extend(read_actions(os.path.join(options['path'], dump_file['path'])))
+    assert [(action.op_type, str(action.id)) for action in actions] == [('index', str(n)) for n in range(1, 1001)]
+
+    Controller(**options).index_load(**options)
+    assert fake_es.stats['bulk_items'] == 1000
@@ -0,0 +1,111 @@
+import datetime
+import decimal
+import json
+import uuid
+
+import pytest
+from elasticsearch.helpers import expand_action
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch_dsl import Date, Document, Float, Integer, IntegerRange, Keyword, Long
+
+from esdocs.encoding import EncodedAction, get_encoder, orjson
+from esdocs.serializer import Serializer
+
+ENCODERS = ['json'] + (['orjson'] if orjson is not None else [])
+
+
+class Span:
+    def __init__(self, lower, upper):
+        self.lower = lower
+        self.upper = upper
+
+
+def span_field(value):
+    # a compatibility hook, like esdocs.contrib.postgresql's range_field
+    if isinstance(value, Span):
+        return {'gte': value.lower, 'lt': value.upper}
+    return value
+
+
+class Thing:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class EncodedDoc(Document):
+    name = Keyword()
+    created = Date()
+    day = Date()
+    price = Float()
+    token = Keyword()
+    tags = Keyword()
+    big = Long()
+    count = Integer()
+    span = IntegerRange()
+
+    class Index:
+        name = 'test-encoded'
+
+
+class EncodedSerializer(Serializer):
+    document = EncodedDoc
+    map_id = 'token'
+
+
+@pytest.fixture
+def hooks(monkeypatch):
+    monkeypatch.setattr(Serializer, 'compatibility_hooks', {span_field})
+    Serializer.reset_serialize_plans()
+    yield
+    Serializer.reset_serialize_plans()
+
+
+def client_lines(action):
+    # what the elasticsearch client would send for an action dict
+    serializer = JSONSerializer()
+    meta, data = expand_action(action)
+    return [json.loads(serializer.dumps(meta))] + ([json.loads(serializer.dumps(data))] if data is not None else [])
+
+
+def encoded_lines(action):
+    return [json.loads(line) for line in action.data.splitlines()]
+
+
+@pytest.mark.parametrize('name', ENCODERS)
+def test_encoded_actions_match_the_client(hooks, name):
+    obj = Thing(
+        name='café',
+        created=datetime.datetime(2020, 1, 2, 3, 4, 5, 6, tzinfo=datetime.timezone.utc),
+        day=datetime.date(2020, 1, 2),
+        price=decimal.Decimal('1.25'),
+        token=uuid.UUID(int=5),
+        tags=('a', 'b'),
+        big=2 ** 40,
+        count=None,
+        span=Span(1, 5),
+    )
+    encoder = get_encoder(name)
+
+    for op_type in ('index', 'delete'):
+        encoded = EncodedSerializer.bulk_encoded_action(obj, encoder, op_type)
+        assert isinstance(encoded, EncodedAction)
+        assert encoded.op_type == op_type
+        assert encoded_lines(encoded) == client_lines(EncodedSerializer.bulk_action(obj, op_type))
+
+    source = encoded_lines(EncodedSerializer.bulk_encoded_action(obj, encoder))[1]
+    assert source['span'] == {'gte': 1, 'lt': 5}
+    assert source['created'] == '2020-01-02T03:04:05.000006+00:00'
+    assert source['price'] == 1.25
+
+
+@pytest.mark.parametrize('name', ENCODERS)
+def test_wide_integers(name):
+    # beyond orjson's 64 bits, the standard library encodes it instead
+    data = {'big': 2 ** 70, 'small': -2 ** 70, 'when': datetime.date(2020, 1, 2)}
+    assert json.loads(get_encoder(name).dumps(data)) == json.loads(JSONSerializer().dumps(data))
+
+
+@pytest.mark.parametrize('name', ENCODERS)
+def test_unencodable_values(name):
+    with pytest.raises(TypeError):
+        get_encoder(name).dumps({'value': object()})
@@ -0,0 +1,120 @@
+import pytest
+
+pytest.importorskip('django')
+
+from django.db import connection, models, transaction
+from elasticsearch_dsl import Document, Keyword
+
+from esdocs.contrib.esdjango.indexing import indexing_queue
+from esdocs.contrib.esdjango.serializer import DjangoSerializer
+
+
+class Note(models.Model):
+    name = models.CharField(max_length=20)
+    hidden = models.BooleanField(default=False)
+
+    class Meta:
+        app_label = 'esdocs_tests'
+
+
+class NoteDoc(Document):
+    name = Keyword()
+
+    class Index:
+        name = 'test-notes'
+
+
+class NoteSerializer(DjangoSerializer):
+    model = Note
+    document = NoteDoc
+    map_id = 'pk'
+    signal_batching = True
+    skip_names = ()
+
+    @classmethod
+    def get_queryset(cls, for_count=False, coerce=False):
+        return super().get_queryset(for_count, coerce).filter(hidden=False)
+
+    @classmethod
+    def should_index(cls, obj, client=None):
+        return obj.name not in cls.skip_names
+
+
+@pytest.fixture(scope='module', autouse=True)
+def note_table():
+    with connection.schema_editor() as editor:
+        editor.create_model(Note)
+    yield
+    with connection.schema_editor() as editor:
+        editor.delete_model(Note)
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    requests = []
+    monkeypatch.setattr(NoteSerializer, 'bulk_send', classmethod(lambda cls, actions: requests.append(actions)))
+    Note.objects.all().delete()
+    return requests
+
+
+def save(obj):
+    obj.save()
+    indexing_queue.add(NoteSerializer, obj, 'index')
+
+
+def delete(obj):
+    indexing_queue.add(NoteSerializer, obj, 'delete')
+    obj.delete()
+
+
+def test_autocommit_flushes_immediately(sent):
+    save(Note(name='a'))
+    assert len(sent) == 1
+    assert [action['name'] for action in sent[0]] == ['a']
+
+
+def test_transaction_collapses_and_flushes_on_commit(sent):
+    with transaction.atomic():
+        first = Note(name='a')
+        save(first)
+        first.name = 'b'
+        save(first)
+        second = Note(name='c')
+        save(second)
+        second_pk = second.pk
+        delete(second)
+        assert not sent
+
+    assert len(sent) == 1
+    assert [(action['_op_type'], action['_id']) for action in sent[0]] == [
+        ('index', first.pk), ('delete', second_pk)]
+    assert sent[0][0]['name'] == 'b'
+
+
+def test_rollback_sends_nothing(sent):
+    with pytest.raises(ValueError):
+        with transaction.atomic():
+            save(Note(name='a'))
+            raise ValueError
+    assert not sent
+
+    with transaction.atomic():
+        save(Note(name='b'))
+    assert [action['name'] for action in sent[0]] == ['b']
+
+
+def test_row_filtered_out_of_queryset(sent):
+    # indexed from the saved instance, or deleted, as `index_add_or_delete` would
+    NoteSerializer.skip_names = ('skipped',)
+    try:
+        with transaction.atomic():
+            shown = Note(name='hidden', hidden=True)
+            save(shown)
+            skipped = Note(name='skipped', hidden=True)
+            save(skipped)
+    finally:
+        NoteSerializer.skip_names = ()
+
+    assert [(action['_op_type'], action['_id']) for action in sent[0]] == [
+        ('index', shown.pk), ('delete', skipped.pk)]
+    assert sent[0][0]['name'] == 'hidden'
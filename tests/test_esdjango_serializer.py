@@ -0,0 +1,319 @@
+import datetime
+
+import pytest
+
+django = pytest.importorskip('django')
+
+from django.conf import settings
+from django.db import connection, models
+from django.test.utils import CaptureQueriesContext
+from django.db.models import Prefetch
+from django.test import override_settings
+from django.utils import timezone
+from elasticsearch_dsl import Date, Document, InnerDoc, Integer, Keyword, Nested
+
+from esdocs.contrib.esdjango.serializer import DjangoSerializer, derive_prefetch_related
+from esdocs.serializer import Serializer
+
+
+class Item(models.Model):
+    name = models.CharField(max_length=20)
+
+    class Meta:
+        app_label = 'esdocs_tests'
+
+
+class Part(models.Model):
+    item = models.ForeignKey(Item, related_name='parts', on_delete=models.CASCADE)
+
+    class Meta:
+        app_label = 'esdocs_tests'
+
+
+class Code(models.Model):
+    code = models.CharField(max_length=20, primary_key=True)
+
+    class Meta:
+        app_label = 'esdocs_tests'
+
+
+class Label(models.Model):
+    # ordered case-insensitively by the database, unlike Python
+    label = models.CharField(max_length=20, primary_key=True, db_collation='NOCASE')
+
+    class Meta:
+        app_label = 'esdocs_tests'
+
+
+class Event(models.Model):
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        app_label = 'esdocs_tests'
+
+
+class ItemDoc(Document):
+    name = Keyword()
+
+    class Index:
+        name = 'test-items'
+
+
+class CodeDoc(Document):
+    code = Keyword()
+
+    class Index:
+        name = 'test-codes'
+
+
+class LabelDoc(Document):
+    label = Keyword()
+
+    class Index:
+        name = 'test-labels'
+
+
+class LabelSerializer(DjangoSerializer):
+    model = Label
+    document = LabelDoc
+
+
+class ItemSerializer(DjangoSerializer):
+    model = Item
+    document = ItemDoc
+    queryset_chunk_size = 7
+
+
+class EventDoc(Document):
+    updated_at = Date()
+
+    class Index:
+        name = 'test-events'
+
+
+class EventSerializer(DjangoSerializer):
+    model = Event
+    document = EventDoc
+    queryset_updated_field = 'updated_at'
+
+
+class CodeSerializer(DjangoSerializer):
+    model = Code
+    document = CodeDoc
+    queryset_chunk_size = 7
+
+
+@pytest.fixture(scope='module', autouse=True)
+def tables():
+    with connection.schema_editor() as editor:
+        editor.create_model(Item)
+        editor.create_model(Part)
+        editor.create_model(Code)
+        editor.create_model(Label)
+        editor.create_model(Event)
+    Item.objects.bulk_create([Item(pk=n, name='item{}'.format(n)) for n in range(1, 31)])
+    Part.objects.bulk_create([Part(item_id=n % 30 + 1) for n in range(60)])
+    Code.objects.bulk_create([Code(code='c{:03}'.format(n * 3)) for n in range(30)])
+    Label.objects.bulk_create([Label(label=c.upper() if n % 2 else c) for n, c in enumerate('abcdefghijklmnopqrst')])
+    yield
+    with connection.schema_editor() as editor:
+        editor.delete_model(Part)
+        editor.delete_model(Item)
+        editor.delete_model(Code)
+        editor.delete_model(Label)
+        editor.delete_model(Event)
+
+
+def fetch_all(serializer, partitions):
+    keys = []
+    for parallel_range in partitions:
+        keys.extend(obj.pk for obj in serializer.fetch_data(parallel_range=parallel_range))
+    return keys
+
+
+def test_keyset_pagination():
+    with CaptureQueriesContext(connection) as queries:
+        items = list(ItemSerializer.fetch_data())
+
+    assert [item.pk for item in items] == list(range(1, 31))
+    # 5 pages of 7, the last one short
+    assert len(queries) == 5
+    assert all('OFFSET' not in query['sql'] for query in queries.captured_queries[1:])
+
+
+def test_keyset_pagination_of_offset_chunks():
+    items = ItemSerializer.fetch_data(parallel_chunk_num=1, parallel_chunk_size=10)
+    assert [item.pk for item in items] == list(range(11, 21))
+
+
+class CursorItemSerializer(ItemSerializer):
+    queryset_pagination = 'cursor'
+    queryset_prefetch_related = ('parts', )
+
+
+@pytest.mark.parametrize('version', [None, (4, 0)])
+def test_cursor_pagination_prefetches_per_chunk(monkeypatch, version):
+    if version is not None:
+        monkeypatch.setattr(django, 'VERSION', version)
+
+    with CaptureQueriesContext(connection) as queries:
+        items = list(CursorItemSerializer.fetch_data())
+        assert [len(item.parts.all()) for item in items] == [2] * 30
+
+    # one query for the rows, one per chunk of 7 for their parts
+    assert len(queries) == 6
+
+
+def test_integer_key_partitions():
+    partitions = ItemSerializer.fetch_data_partitions(4)
+    assert len(partitions) == 4
+    assert partitions[0][0] is None and partitions[-1][1] is None
+    assert fetch_all(ItemSerializer, partitions) == list(range(1, 31))
+
+    # no more ranges than keys
+    assert len(ItemSerializer.fetch_data_partitions(100)) == 30
+
+
+def test_quantile_key_partitions():
+    with CaptureQueriesContext(connection) as queries:
+        partitions = CodeSerializer.fetch_data_partitions(6)
+
+    # min/max, count and a single key per boundary
+    assert len(queries) == 7
+    assert all('LIMIT 1' in query['sql'] for query in queries.captured_queries[2:])
+    assert [hi for lo, hi in partitions] == ['c012', 'c027', 'c042', 'c057', 'c072', None]
+    assert fetch_all(CodeSerializer, partitions) == sorted(code.pk for code in Code.objects.all())
+
+
+def test_quantile_key_partitions_keep_database_order():
+    partitions = LabelSerializer.fetch_data_partitions(4)
+    assert [hi for lo, hi in partitions] == ['e', 'J', 'o', None]
+    labels = fetch_all(LabelSerializer, partitions)
+    assert len(labels) == len(set(labels)) == 20
+
+
+def test_partitions_of_empty_table():
+    Code.objects.all().delete()
+    try:
+        assert CodeSerializer.fetch_data_partitions(4) == []
+    finally:
+        Code.objects.bulk_create([Code(code='c{:03}'.format(n * 3)) for n in range(30)])
+
+
+class ValuesItemSerializer(ItemSerializer):
+    fetch_mode = 'values'
+
+
+class BatchedItemSerializer(ValuesItemSerializer):
+    @classmethod
+    def prepare_batch(cls, objs):
+        context = super().prepare_batch(objs)
+        context.names = {obj.pk: obj.name for obj in objs}
+        return context
+
+
+def test_values_fetch_mode():
+    items = list(ValuesItemSerializer.fetch_data())
+    assert items[0] == {'pk': 1, 'name': 'item1'}
+    assert ValuesItemSerializer.serialize(items[0]) == {'name': 'item1'}
+
+
+def test_values_fetch_mode_with_custom_prepare_batch(caplog):
+    # prepare_batch() is handed the fetched objects; keep them model instances
+    items = list(BatchedItemSerializer.fetch_data())
+    assert all(isinstance(item, Item) for item in items)
+    assert 'custom prepare_batch()' in caplog.text
+    assert BatchedItemSerializer.prepare_batch(items).names[1] == 'item1'
+
+
+class PartInner(InnerDoc):
+    id = Integer()
+    item_name = Keyword()
+
+
+class PartInnerSerializer(Serializer):
+    document = PartInner
+    map_fields = {'item_name': 'item.name'}
+
+
+class ItemPartsDoc(Document):
+    name = Keyword()
+    parts = Nested(PartInner)
+    part_count = Integer()
+
+    class Index:
+        name = 'test-item-parts'
+
+
+class ItemPartsSerializer(ItemSerializer):
+    document = ItemPartsDoc
+    map_fields = {'parts': 'parts.all'}
+
+    @classmethod
+    def get_part_count_value(cls, obj, source):
+        # opaque; nothing is derived from it
+        return len(obj.parts.all())
+
+
+def test_derive_prefetch_related():
+    # followed into the inner doc's serializer
+    assert derive_prefetch_related(ItemPartsSerializer, Item) == ['parts', 'parts__item']
+    assert derive_prefetch_related(PartInnerSerializer, Part) == ['item']
+
+
+class ExplicitPrefetchSerializer(ItemPartsSerializer):
+    queryset_prefetch_related = (Prefetch('parts', queryset=Part.objects.order_by('-pk')), )
+
+
+class ManualPrefetchSerializer(ItemPartsSerializer):
+    queryset_auto_prefetch = False
+
+
+def test_derived_lookups_skip_explicit_ones():
+    lookups = ExplicitPrefetchSerializer.get_prefetch_related()
+    assert lookups[1:] == ['parts__item']
+    assert ManualPrefetchSerializer.get_prefetch_related() == []
+
+
+@pytest.mark.parametrize('serializer,expected', [
+    # per page of 7: the items and their parts (whose item is the one they
+    # were prefetched for)
+    (ItemPartsSerializer, 5 * 2),
+    # per page, then the parts of each item for each of the two fields
+    (ManualPrefetchSerializer, 5 + 30 * 2),
+])
+def test_derived_prefetching_queries_per_page(serializer, expected):
+    with CaptureQueriesContext(connection) as queries:
+        docs = [serializer.serialize(item) for item in serializer.fetch_data()]
+
+    assert docs[0]['parts'] == [{'id': 1, 'item_name': 'item1'}, {'id': 31, 'item_name': 'item1'}]
+    assert docs[0]['part_count'] == 2
+    assert len(queries) == expected
+
+
+@pytest.fixture
+def events():
+    # hourly from 10:00 to 14:00 (in the current time zone)
+    def create():
+        Event.objects.all().delete()
+        for hour in range(10, 15):
+            updated_at = datetime.datetime(2024, 1, 1, hour)
+            if settings.USE_TZ:
+                updated_at = timezone.make_aware(updated_at)
+            Event.objects.create(updated_at=updated_at)
+    return create
+
+
+@pytest.mark.parametrize('use_tz', [False, True])
+def test_changed_data_since_a_utc_watermark(events, use_tz):
+    # watermarks are aware UTC datetimes (see `esdocs.state`); 18:00 UTC is
+    # 12:00 in Chicago
+    since = datetime.datetime(2024, 1, 1, 18, tzinfo=datetime.timezone.utc)
+    with override_settings(USE_TZ=use_tz, TIME_ZONE='America/Chicago'):
+        events()
+        changed = list(EventSerializer.fetch_changed_data(since))
+        hours = [timezone.localtime(event.updated_at).hour if use_tz else event.updated_at.hour for event in changed]
+        assert hours == [13, 14]
+
+        # naive ones are taken as local times
+        assert len(list(EventSerializer.fetch_changed_data(datetime.datetime(2024, 1, 1, 10)))) == 4
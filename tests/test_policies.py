@@ -0,0 +1,192 @@
+import pytest
+
+pytest.importorskip('gevent')
+
+from esdocs import policies
+
+
+class FakePipe:
+    # the worker's end of the gipc pipe
+    def __init__(self, chunks):
+        self.chunks = list(chunks) + ['STOP']
+        self.sent = []
+
+    def put(self, msg):
+        self.sent.append(msg)
+
+    def get(self):
+        return self.chunks.pop(0)
+
+
+class FakeClock:
+    now = 0.0
+
+    def time(self):
+        return self.now
+
+
+def test_worker_progress_follows_the_reporter_interval(monkeypatch):
+    clock = FakeClock()
+
+    def parallel_bulk_index(serializer_hash, index, options, progress=None):
+        # 100 documents a second for 30 seconds
+        for n in range(3000):
+            clock.now += 0.01
+            progress(1, 0)
+        return 3000, 0
+
+    monkeypatch.setattr(policies, 'time', clock)
+    monkeypatch.setattr(policies, 'parallel_bulk_index', parallel_bulk_index)
+    h2 = FakePipe([(0, 'idx', {'parallel_chunk_num': n, 'progress_interval': 10}) for n in range(2)])
+    policies.process_func(h2)
+
+    progress = [data for msg, data in h2.sent if msg == 'PROGRESS']
+    # every 10 seconds and at the end of each chunk
+    assert len(progress) == 6
+    assert sum(ok for name, ok, failed in progress) == 6000
+    assert [msg for msg, data in h2.sent].count('DONE-CHUNK') == 2
+
+
+def ranged_chunks(count, skip=()):
+    return [
+        (0, 'idx', {'parallel_chunk_num': n, 'parallel_range': (n * 10, n * 10 + 10)})
+        for n in range(count) if n not in skip
+    ]
+
+
+def test_scheduler_merges_runs_that_shrink():
+    scheduler = policies.GuidedChunkScheduler(ranged_chunks(32), 4, ranged=True)
+    runs = []
+    while len(scheduler):
+        serializer_hash, index, options = scheduler.next_chunk()
+        runs.append((options['parallel_chunk_num'], options['parallel_range']))
+    assert scheduler.next_chunk() is None
+
+    # each run covers 1 / (2 * slots) of the remaining ranges
+    assert [len(scheduler.dispatched[n]) for n, _ in runs] == [4, 4, 3, 3, 3, 2, 2, 2, 2, 1, 1, 1, 1, 1, 1, 1]
+    assert runs[:3] == [(0, (0, 40)), (4, (40, 80)), (8, (80, 110))]
+    assert scheduler.dispatched[8] == [8, 9, 10]
+    assert sorted(n for nums in scheduler.dispatched.values() for n in nums) == list(range(32))
+
+
+def test_scheduler_only_merges_adjacent_ranges():
+    # chunks 2 and 3 were completed before a resume
+    scheduler = policies.GuidedChunkScheduler(ranged_chunks(8, skip={2, 3}), 1, ranged=True)
+    assert scheduler.next_chunk()[2]['parallel_range'] == (0, 20)
+    assert scheduler.next_chunk()[2]['parallel_range'] == (40, 60)
+    assert scheduler.next_chunk()[2]['parallel_range'] == (60, 70)
+    assert scheduler.dispatched == {0: [0, 1], 4: [4, 5], 6: [6]}
+
+
+def test_scheduler_hands_out_offset_chunks_one_at_a_time():
+    chunks = [(0, 'idx', {'parallel_chunk_num': n, 'parallel_chunk_size': 100}) for n in range(4)]
+    scheduler = policies.GuidedChunkScheduler(chunks, 1)
+    assert [scheduler.next_chunk()[2] for _ in range(4)] == [chunk[2] for chunk in chunks]
+    assert scheduler.dispatched == {n: [n] for n in range(4)}
+
+
+class PartitionedSerializer:
+    class document:
+        pass
+
+    @classmethod
+    def fetch_data_partitions(cls, count, **options):
+        return [(n * 10, n * 10 + 10) for n in range(16)]
+
+
+class FakeWorker:
+    # the parent's end of the gipc pipe to a worker that finishes each
+    # chunk (or fails chunk `fail`) as soon as it gets it
+    def __init__(self, name, fail=None):
+        self.name = name
+        self.fail = fail
+        self.received = []
+        self.outbox = [['NEXT-CHUNK', (name, )]]
+
+    def put(self, params):
+        self.received.append(params)
+        chunk_num = params[2]['parallel_chunk_num']
+        if chunk_num == self.fail:
+            self.outbox.append(['FAILED-CHUNK', (self.name, 'gthread-0', chunk_num, 'ValueError()')])
+            return
+        size = params[2]['parallel_range'][1] - params[2]['parallel_range'][0]
+        self.outbox.append(['DONE-CHUNK', (self.name, 'gthread-0', chunk_num, size - 1, 1, 0.1, None)])
+        self.outbox.append(['NEXT-CHUNK', (self.name, )])
+
+    def get(self):
+        return self.outbox.pop(0)
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    import gevent.select
+
+    workers = {}
+
+    def select(fds, *args):
+        return [fd for fd in fds if workers[fd].outbox], [], []
+
+    monkeypatch.setattr(gevent.select, 'select', select)
+    monkeypatch.setattr(policies.ParallelStreamingPolicy, 'pipe_fd_mapping', {})
+
+    def start(policy, count, fail=None):
+        for fd in range(count):
+            workers[fd] = FakeWorker('esdocs-proc-{}'.format(fd), fail=fail)
+            policy.pipe_fd_mapping[fd] = (workers[fd], None)
+        return workers
+    return start
+
+
+def test_parallel_policy_dispatches_and_counts(workers):
+    policy = policies.ParallelStreamingPolicy(lambda: None)
+    workers = workers(policy, 2)
+    checkpoint = FakeCheckpoint()
+    result = policy.bulk_operation(PartitionedSerializer, 'idx', None, multi=2, checkpoint=checkpoint)
+
+    received = [params[2] for worker in workers.values() for params in worker.received]
+    # one failure per run
+    assert result == (160 - len(received), len(received))
+    # merged runs cover every range once, and are checkpointed as their chunks
+    assert sorted(n for options in received for n in range(*options['parallel_range'])) == list(range(160))
+    assert len(received) < 16
+    assert sorted(checkpoint.completed) == list(range(16))
+    assert checkpoint.done
+    # both workers asked for more once the chunks ran out; they are served by
+    # the next serializer's bulk operation
+    unread = [msg for worker in workers.values() for msg, data in worker.outbox]
+    assert unread == ['NEXT-CHUNK'] * (2 - len(policy.waiting))
+
+
+def test_parallel_policy_stops_on_a_failed_chunk(workers):
+    policy = policies.ParallelStreamingPolicy(lambda: None)
+    workers(policy, 2, fail=4)
+    checkpoint = FakeCheckpoint()
+    with pytest.raises(policies.ChunkFailed, match='chunk 4'):
+        policy.bulk_operation(PartitionedSerializer, 'idx', None, multi=2, checkpoint=checkpoint)
+    assert 4 not in checkpoint.completed
+    assert not checkpoint.done
+
+
+class FakeCheckpoint:
+    def __init__(self):
+        self.plan = None
+        self.completed = []
+        self.done = False
+
+    def is_done(self, serializer):
+        return self.done
+
+    def get_plan(self, serializer):
+        return self.plan
+
+    def set_plan(self, serializer, plan):
+        self.plan = plan
+
+    def completed_chunks(self, serializer):
+        return set(self.completed)
+
+    def complete_chunks(self, serializer, chunk_nums):
+        self.completed.extend(chunk_nums)
+
+    def mark_done(self, serializer):
+        self.done = True
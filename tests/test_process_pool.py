@@ -0,0 +1,58 @@
+import pytest
+
+from benchmarks.documents import FlatSerializer
+from esdocs import policies
+from esdocs.serializer import Serializer
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    # workers import the modules of the registered serializers; only
+    # benchmarks.documents here (the test modules need their own setup)
+    monkeypatch.setattr(Serializer, 'hash_registry', {hash(FlatSerializer): FlatSerializer})
+    monkeypatch.setattr(Serializer, 'compatibility_hooks', set())
+
+
+@pytest.mark.parametrize('start_method', ['spawn', 'forkserver'])
+def test_process_pool(fake_es, registry, start_method):
+    policy = policies.ProcessPoolStreamingPolicy(lambda: None, start_method=start_method)
+    try:
+        assert policy.bulk_operation(FlatSerializer, 'bench-flat', None, multi=2) == (10000, 0)
+        # the workers are kept for the next serializer
+        assert policy.executor is not None
+        assert policy.bulk_operation(FlatSerializer, 'bench-flat', None, multi=2) == (10000, 0)
+    finally:
+        policy.close()
+    assert policy.executor is None
+    assert fake_es.stats['bulk_items'] == 20000
+
+
+class WorkerSetup:
+    # (picklable, for the spawned workers)
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        import os
+        (self.path / str(os.getpid())).touch()
+
+
+def test_process_pool_worker_setup(fake_es, registry, tmp_path):
+    policy = policies.ProcessPoolStreamingPolicy(lambda: None, worker_setup=WorkerSetup(tmp_path))
+    try:
+        policy.bulk_operation(FlatSerializer, 'bench-flat', None, multi=2)
+    finally:
+        policy.close()
+    # once in each worker, before it handles a chunk
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_process_pool_failed_chunk(fake_es, registry, monkeypatch):
+    monkeypatch.setattr(FlatSerializer, 'fetch_data_partitions', classmethod(lambda cls, count, **kwargs: [(0, 'x')]))
+    policy = policies.ProcessPoolStreamingPolicy(lambda: None)
+    try:
+        with pytest.raises(policies.ChunkFailed, match='Chunk 0 failed'):
+            policy.bulk_operation(FlatSerializer, 'bench-flat', None, multi=2)
+    finally:
+        policy.close()
+
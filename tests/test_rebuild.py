@@ -0,0 +1,209 @@
+import threading
+import time
+
+import pytest
+from elasticsearch_dsl import Document, Keyword
+
+from benchmarks.documents import MemorySerializer, Row
+from esdocs.controller import Controller
+from esdocs.digests import DigestStore
+from esdocs.policies import StreamingPolicy
+from esdocs.state import RebuildCheckpoint, StateFile
+
+
+class ResumeDoc(Document):
+    name = Keyword()
+
+    class Index:
+        name = 'test-resume'
+
+
+class ResumeSerializer(MemorySerializer):
+    document = ResumeDoc
+    size = 1000
+    fail_at = None
+
+    @classmethod
+    def make_row(cls, n):
+        return Row(id=n, name='n{}'.format(n))
+
+    @classmethod
+    def fetch_data(cls, **kwargs):
+        lo, hi = kwargs.get('parallel_range', (None, None))
+        if cls.fail_at is not None and (lo or 0) < cls.fail_at <= (hi or cls.size):
+            raise ValueError('interrupted')
+        return super().fetch_data(**kwargs)
+
+
+@pytest.fixture
+def options(tmp_path, monkeypatch):
+    # 10 chunks of 100 documents
+    monkeypatch.setattr(StreamingPolicy, 'checkpoint_chunk_docs', 100)
+    return {
+        'indexes': 'test-resume',
+        'state_file': str(tmp_path / 'state.json'),
+        'dead_letter': str(tmp_path / 'dead-letter.ndjson'),
+        'no_input': True,
+    }
+
+
+def rebuild(**options):
+    Controller(**options).index_rebuild(**options)
+
+
+def test_rebuild_checkpoint_is_finished(fake_es, options):
+    rebuild(**options)
+    assert fake_es.stats['bulk_items'] == 1000
+    assert fake_es.stats['bulk_requests'] == 10
+    assert RebuildCheckpoint(StateFile(options['state_file']), 'test-resume').load() is None
+
+
+def test_rebuild_without_checkpoint(fake_es, options):
+    ResumeSerializer.fail_at = 500
+    try:
+        with pytest.raises(ValueError):
+            rebuild(no_checkpoint=True, **options)
+    finally:
+        ResumeSerializer.fail_at = None
+    assert 'rebuild' not in StateFile(options['state_file']).load()
+
+
+def test_resume_interrupted_rebuild(fake_es, options):
+    # any rebuild can be resumed
+    ResumeSerializer.fail_at = 500
+    try:
+        with pytest.raises(ValueError):
+            rebuild(**options)
+    finally:
+        ResumeSerializer.fail_at = None
+
+    checkpoint = RebuildCheckpoint(StateFile(options['state_file']), 'test-resume')
+    interrupted = checkpoint.load()
+    assert interrupted is not None and not interrupted['loaded']
+    sent = fake_es.stats['bulk_items']
+    assert sent == 400
+
+    rebuild(resume=True, **options)
+    # chunks done before the failure aren't sent again
+    assert fake_es.stats['bulk_items'] == 1000
+    assert checkpoint.load() is None
+
+
+def test_rebuild_without_resume_starts_afresh(fake_es, options):
+    ResumeSerializer.fail_at = 500
+    try:
+        with pytest.raises(ValueError):
+            rebuild(**options)
+    finally:
+        ResumeSerializer.fail_at = None
+    interrupted = RebuildCheckpoint(StateFile(options['state_file']), 'test-resume').load()
+
+    sent = fake_es.stats['bulk_items']
+    rebuild(**options)
+    assert fake_es.stats['bulk_items'] == sent + 1000
+    assert RebuildCheckpoint(StateFile(options['state_file']), 'test-resume').load() is None
+    assert interrupted is not None
+
+
+def digest_indexes(path):
+    store = DigestStore(path)
+    return dict(store.connection.execute("SELECT idx, COUNT(*) FROM digests GROUP BY idx").fetchall())
+
+
+def test_rebuild_digests_follow_the_alias(fake_es, options, tmp_path):
+    options['digest_cache'] = str(tmp_path / 'digests.sqlite')
+    rebuild(**options)
+    assert digest_indexes(options['digest_cache']) == {'test-resume': 1000}
+
+    # a failed rebuild leaves the live index' digests alone; those of the
+    # new index are kept for resuming into it, until a rebuild starts afresh
+    ResumeSerializer.fail_at = 500
+    try:
+        with pytest.raises(ValueError):
+            rebuild(**options)
+    finally:
+        ResumeSerializer.fail_at = None
+    assert digest_indexes(options['digest_cache'])['test-resume'] == 1000
+    assert sum(digest_indexes(options['digest_cache']).values()) == 1400
+
+    rebuild(**options)
+    assert digest_indexes(options['digest_cache']) == {'test-resume': 1000}
+
+    with pytest.raises(ValueError):
+        ResumeSerializer.fail_at = 500
+        try:
+            rebuild(no_checkpoint=True, **options)
+        finally:
+            ResumeSerializer.fail_at = None
+    assert digest_indexes(options['digest_cache']) == {'test-resume': 1000}
+
+
+def concurrent_serializer(name):
+    doc = type(name.title().replace('-', '') + 'Doc', (Document, ), {
+        'name': Keyword(),
+        'Index': type('Index', (), {'name': name}),
+    })
+    return type(doc.__name__.replace('Doc', 'Serializer'), (ResumeSerializer, ), {'document': doc, 'size': 10})
+
+
+CONCURRENT = ['test-concurrent-a', 'test-concurrent-b', 'test-concurrent-c']
+CONCURRENT_SERIALIZERS = [concurrent_serializer(name) for name in CONCURRENT]
+
+
+@pytest.fixture
+def steps(monkeypatch):
+    # records loads and finalizes; the first finalize waits (for a while) for
+    # the next index to start loading
+    steps = []
+    next_load = threading.Event()
+    load, finalize = Controller._index_rebuild_load, Controller._index_rebuild_finalize
+
+    def record_load(self, policy, name, index, **options):
+        steps.append(('load', name))
+        if name == CONCURRENT[1]:
+            next_load.set()
+        return load(self, policy, name, index, **options)
+
+    def record_finalize(self, name, index, original_settings, checkpoint=None, **options):
+        if name == CONCURRENT[0]:
+            next_load.wait(0.5)
+        if name == CONCURRENT[-1]:
+            time.sleep(0.1)
+        finalize(self, name, index, original_settings, checkpoint, **options)
+        steps.append(('finalize', name))
+
+    monkeypatch.setattr(Controller, '_index_rebuild_load', record_load)
+    monkeypatch.setattr(Controller, '_index_rebuild_finalize', record_finalize)
+    return steps
+
+
+@pytest.fixture
+def concurrent_options(options):
+    return dict(options, indexes=','.join(CONCURRENT))
+
+
+def test_concurrent_finalize(fake_es, concurrent_options, steps):
+    rebuild(concurrent=2, **concurrent_options)
+    # the first index is finalized while the second loads; the third waits
+    # until one of them is done
+    assert steps.index(('load', CONCURRENT[1])) < steps.index(('finalize', CONCURRENT[0]))
+    assert steps.index(('load', CONCURRENT[2])) > steps.index(('finalize', CONCURRENT[0]))
+    # and the last is finalized before the rebuild returns
+    assert steps[-1] == ('finalize', CONCURRENT[2])
+    assert fake_es.stats['bulk_items'] == 30
+    for name in CONCURRENT:
+        assert RebuildCheckpoint(StateFile(concurrent_options['state_file']), name).load() is None
+
+
+def test_finalize_in_turn(fake_es, concurrent_options, steps):
+    rebuild(**concurrent_options)
+    assert steps == [(step, name) for name in CONCURRENT for step in ('load', 'finalize')]
+
+
+def test_concurrent_finalize_failure(fake_es, concurrent_options, monkeypatch):
+    def fail(self, name, *args, **kwargs):
+        raise ValueError(name)
+
+    monkeypatch.setattr(Controller, '_index_rebuild_finalize', fail)
+    with pytest.raises(ValueError, match=CONCURRENT[0]):
+        rebuild(concurrent=2, **concurrent_options)
@@ -0,0 +1,274 @@
+from collections import UserDict
+
+from elasticsearch_dsl import Document, InnerDoc, Integer, Keyword, Nested, Object
+
+from esdocs.exceptions import InvalidFieldLookup
+from esdocs.serializer import Serializer, compile_accessor
+
+
+class Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class PlanTag(InnerDoc):
+    label = Keyword()
+
+
+class PlanDoc(Document):
+    name = Keyword()
+    title = Keyword()
+    total = Integer()
+    missing = Keyword()
+    tags = Nested(PlanTag)
+    owner = Object(PlanTag)
+
+    class Index:
+        name = 'test-plan'
+
+
+class PlanTagSerializer(Serializer):
+    document = PlanTag
+
+    @classmethod
+    def get_label_value(cls, obj, source):
+        return obj.label.upper()
+
+
+class PlanSerializer(Serializer):
+    document = PlanDoc
+    map_fields = {'missing': 'related.name'}
+
+    @classmethod
+    def serialize_title(cls, obj, source):
+        # used as-is; no normalizing
+        return '  {}  '.format(obj.name)
+
+    @classmethod
+    def get_total_value(cls, obj, source):
+        return obj.count * 2
+
+
+class FallbackDoc(Document):
+    name = Keyword()
+    title = Keyword()
+
+    class Index:
+        name = 'test-fallback'
+
+
+class FallbackSerializer(Serializer):
+    document = FallbackDoc
+
+    @classmethod
+    def serialize_name(cls, obj, source):
+        return obj.no_such_attribute
+
+    @classmethod
+    def get_name_value(cls, obj, source):
+        return obj.other_attribute
+
+    @classmethod
+    def get_title_value(cls, obj, source):
+        return obj.no_such_attribute
+
+
+def test_plan_getters():
+    obj = Obj(name=' a ', count=2, related=None, tags=[Obj(label='x'), Obj(label='y')], owner=Obj(label='z'))
+    assert PlanSerializer.serialize(obj) == {
+        'name': 'a',
+        'title': '   a   ',
+        'total': 4,
+        'missing': None,
+        'tags': [{'label': 'X'}, {'label': 'Y'}],
+        'owner': {'label': 'Z'},
+    }
+
+
+def test_plan_callable_lookup():
+    obj = Obj(name=lambda: 'called', count=0, related=Obj(name='r'), tags=None, owner=None)
+    data = PlanSerializer.serialize(obj)
+    assert data['name'] == 'called'
+    assert data['missing'] == 'r'
+
+
+def test_plan_recompiled_after_reset():
+    obj = Obj(name='a', count=1, related=None, tags=None, owner=None)
+    PlanSerializer.serialize(obj)
+    original = PlanSerializer.map_fields
+    try:
+        PlanSerializer.map_fields = {'missing': 'name'}
+        PlanSerializer.reset_serialize_plans()
+        assert PlanSerializer.serialize(obj)['missing'] == 'a'
+    finally:
+        PlanSerializer.map_fields = original
+        PlanSerializer.reset_serialize_plans()
+
+
+def test_attribute_error_falls_through_to_next_getter():
+    # `serialize_name` -> `get_name_value` -> `get_value`
+    assert FallbackSerializer.serialize(Obj(name='n', other_attribute='o', title=None)) == {'name': 'o', 'title': None}
+    assert FallbackSerializer.serialize(Obj(name='n', title='t')) == {'name': 'n', 'title': 't'}
+
+
+def test_attribute_error_from_lookup_is_raised():
+    try:
+        FallbackSerializer.serialize(object())
+    except AttributeError:
+        pass
+    else:
+        raise AssertionError('AttributeError not raised')
+
+
+def test_invalid_lookup_is_empty():
+    try:
+        PlanSerializer.get_value(Obj(related=None), 'missing')
+    except InvalidFieldLookup:
+        pass
+    else:
+        raise AssertionError('InvalidFieldLookup not raised')
+
+
+def raises(exception, func, *args):
+    try:
+        func(*args)
+    except exception:
+        return True
+    return False
+
+
+def test_accessor_paths():
+    accessor = compile_accessor('a.b.c')
+    assert accessor(Obj(a=Obj(b=Obj(c=1)))) == 1
+    # dicts (eg. `values()` rows), other mappings and a mix of them
+    assert accessor({'a': {'b': {'c': 2}}}) == 2
+    assert accessor(Obj(a=UserDict(b=Obj(c=3)))) == 3
+    assert accessor({'a': Obj(b={'c': 4})}) == 4
+    # only the last part may be missing or None
+    assert accessor({'a': {'b': {}}}) is None
+    assert accessor(Obj(a=Obj(b=Obj(c=None)))) is None
+    assert raises(InvalidFieldLookup, accessor, Obj(a=None))
+    assert raises(InvalidFieldLookup, accessor, {'a': {'b': None}})
+    assert raises(AttributeError, accessor, Obj(a=Obj()))
+
+
+class MetaDoc(Document):
+    name = Keyword()
+
+    class Index:
+        name = 'test-meta'
+
+
+class MetaSerializer(Serializer):
+    document = MetaDoc
+    map_fields = {'name': 'info.name'}
+    map_id = 'info.key'
+    map_routing = 'shard'
+
+
+def test_meta_values():
+    obj = Obj(info=Obj(name='n', key=lambda: 'k1'), shard=3)
+    assert MetaSerializer.get_value(obj, 'name') == 'n'
+    assert MetaSerializer.get_meta_value(obj, 'id') == 'k1'
+    assert MetaSerializer.get_meta_value(obj, 'routing') == 3
+    assert MetaSerializer.get_meta_value(obj, 'parent') is None
+
+    MetaSerializer.map_id = 'info.name'
+    try:
+        # cached until reset
+        assert MetaSerializer.get_meta_value(obj, 'id') == 'k1'
+        MetaSerializer.reset_serialize_plans()
+        assert MetaSerializer.get_meta_value(obj, 'id') == 'n'
+    finally:
+        MetaSerializer.map_id = 'info.key'
+        MetaSerializer.reset_serialize_plans()
+
+
+class BatchAuthor(InnerDoc):
+    name = Keyword()
+
+
+class BatchDoc(Document):
+    title = Keyword()
+    comments = Integer()
+    author = Object(BatchAuthor)
+
+    class Index:
+        name = 'test-batch'
+
+
+class BatchAuthorSerializer(Serializer):
+    document = BatchAuthor
+
+    @classmethod
+    def get_name_value(cls, obj, source, context):
+        context.seen.append(('author', source.title))
+        return obj.name
+
+
+class BatchSerializer(Serializer):
+    document = BatchDoc
+    batches = []
+
+    @classmethod
+    def prepare_batch(cls, objs):
+        context = super().prepare_batch(objs)
+        cls.batches.append([obj.title for obj in objs])
+        # eg. counts from one aggregate query rather than one per object
+        context.comment_counts = {obj.title: len(obj.title) for obj in objs}
+        context.seen = []
+        return context
+
+    @classmethod
+    def get_comments_value(cls, obj, source, context=None):
+        context.seen.append(('comments', obj.title))
+        return context.comment_counts[obj.title]
+
+
+def test_batch_context():
+    BatchSerializer.batches = []
+    objs = [Obj(title='a', author=Obj(name='x')), Obj(title='bb', author=Obj(name='y'))]
+    assert BatchSerializer.serialize_many(objs) == [
+        {'title': 'a', 'comments': 1, 'author': {'name': 'x'}},
+        {'title': 'bb', 'comments': 2, 'author': {'name': 'y'}},
+    ]
+    assert BatchSerializer.batches == [['a', 'bb']]
+
+
+def test_inner_serializers_share_the_batch_context():
+    objs = [Obj(title='a', author=Obj(name='x')), Obj(title='bb', author=Obj(name='y'))]
+    context = BatchSerializer.prepare_batch(objs)
+    for obj in objs:
+        BatchSerializer.serialize(obj, context=context)
+    assert context.seen == [('comments', 'a'), ('author', 'a'), ('comments', 'bb'), ('author', 'bb')]
+
+
+def test_lone_object_is_a_batch_of_one():
+    BatchSerializer.batches = []
+    assert BatchSerializer.serialize(Obj(title='ccc', author=None))['comments'] == 3
+    assert BatchSerializer.batches == [['ccc']]
+
+    # serializers without context getters don't prepare batches
+    calls = []
+    original = PlanSerializer.prepare_batch
+    PlanSerializer.prepare_batch = classmethod(lambda cls, objs: calls.append(objs))
+    try:
+        PlanSerializer.serialize(Obj(name='a', count=1, related=None, tags=None, owner=None))
+    finally:
+        PlanSerializer.prepare_batch = original
+    assert calls == []
+
+
+def test_bulk_actions_are_prepared_per_batch():
+    BatchSerializer.batches = []
+    objs = [Obj(title='t{}'.format(n), author=None) for n in range(5)]
+    original = BatchSerializer.serialize_batch_size
+    BatchSerializer.serialize_batch_size = 2
+    BatchSerializer.fetch_data = classmethod(lambda cls, **kwargs: iter(objs))
+    try:
+        actions = list(BatchSerializer._bulk_stream())
+    finally:
+        BatchSerializer.serialize_batch_size = original
+        del BatchSerializer.fetch_data
+    assert [action['comments'] for action in actions] == [2] * 5
+    assert BatchSerializer.batches == [['t0', 't1'], ['t2', 't3'], ['t4']]
@@ -0,0 +1,76 @@
+import datetime
+
+import pytest
+
+from esdocs.state import RebuildCheckpoint, StateFile, format_timestamp, parse_timestamp
+
+
+class Named:
+    @classmethod
+    def qualified_name(cls):
+        return 'tests.Named'
+
+
+@pytest.fixture
+def state_file(tmp_path):
+    return StateFile(str(tmp_path / 'state.json'))
+
+
+def test_state_file_sections(state_file):
+    assert state_file.load() == {}
+    state_file.set('sync', 'a', 1)
+    assert state_file.get('sync', 'a') == 1
+    assert state_file.update('sync', 'b', lambda value: value + 1, default=10) == 11
+    state_file.delete('sync', 'a')
+    assert StateFile(state_file.path).load() == {'sync': {'b': 11}}
+
+
+def test_parse_timestamp():
+    utc = datetime.timezone.utc
+    assert parse_timestamp('2020-01-02T03:04:05Z') == datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=utc)
+    assert parse_timestamp('2020-01-02T03:04:05+01:00') == datetime.datetime(2020, 1, 2, 2, 4, 5, tzinfo=utc)
+    assert parse_timestamp('2020-01-02') == datetime.datetime(2020, 1, 2, tzinfo=utc)
+    assert parse_timestamp(format_timestamp(parse_timestamp('2020-01-02 03:04:05'))).hour == 3
+
+    age = datetime.datetime.now(utc) - parse_timestamp('90m')
+    assert datetime.timedelta(minutes=89) < age < datetime.timedelta(minutes=91)
+
+    with pytest.raises(ValueError):
+        parse_timestamp('yesterday')
+
+
+def test_checkpoint(state_file):
+    checkpoint = RebuildCheckpoint(state_file, 'alias')
+    assert checkpoint.load() is None
+    checkpoint.start('alias-1', {'index': {}})
+    checkpoint.set_plan(Named, {'ranges': [[None, 5], [5, None]]})
+    checkpoint.complete_chunks(Named, [0])
+
+    resumed = RebuildCheckpoint(state_file, 'alias')
+    assert resumed.load()['index'] == 'alias-1'
+    assert resumed.get_plan(Named) == {'ranges': [[None, 5], [5, None]]}
+    assert not resumed.is_done(Named) and not resumed.loaded
+
+    resumed.mark_done(Named)
+    resumed.mark_loaded()
+    assert checkpoint.is_done(Named) and checkpoint.loaded
+    checkpoint.finish()
+    assert checkpoint.load() is None
+
+
+def test_checkpoint_writes_are_batched(state_file):
+    checkpoint = RebuildCheckpoint(state_file, 'alias')
+    checkpoint.start('alias-1', {})
+    checkpoint.set_plan(Named, {'chunk_size': 10, 'count': 3})
+
+    checkpoint.complete_chunks(Named, [0])
+    checkpoint.complete_chunks(Named, [1])
+    assert checkpoint.completed_chunks(Named) == {0, 1}
+    assert RebuildCheckpoint(state_file, 'alias').completed_chunks(Named) == set()
+
+    checkpoint.save()
+    assert RebuildCheckpoint(state_file, 'alias').completed_chunks(Named) == {0, 1}
+
+    checkpoint.save_interval = 0
+    checkpoint.complete_chunks(Named, [2])
+    assert RebuildCheckpoint(state_file, 'alias').completed_chunks(Named) == {0, 1, 2}
@@ -0,0 +1,108 @@
+import json
+from collections import defaultdict
+
+import pytest
+
+from benchmarks.documents import FlatSerializer
+from esdocs import policies
+from esdocs.controller import Controller
+from esdocs.serializer import Serializer
+from esdocs.stats import Stats, stats
+
+
+@pytest.fixture
+def enabled_stats(monkeypatch):
+    monkeypatch.setattr(stats, 'enabled', False)
+    monkeypatch.setattr(stats, 'data', defaultdict(lambda: [0, 0.0]))
+    yield stats
+    # (plans compiled with stats enabled time the hooks too)
+    Serializer.reset_serialize_plans()
+
+
+def test_collect_and_merge():
+    worker = Stats()
+    worker.add('S', 'fetch', 0.5, 10)
+    worker.add('S', 'fetch', 0.25, 5)
+    worker.add('S', 'serialize', 1.0, 15)
+    collected = worker.collect()
+    assert sorted(collected) == [['S', 'fetch', 15, 0.75], ['S', 'serialize', 15, 1.0]]
+    # the deltas are only sent once
+    assert worker.collect() == []
+
+    parent = Stats()
+    parent.add('S', 'fetch', 0.25, 5)
+    parent.merge(collected)
+    parent.merge(None)
+    assert parent.rows() == [['S', 'fetch', 20, 1.0], ['S', 'serialize', 15, 1.0]]
+
+
+def test_timed():
+    timed = Stats()
+    assert list(timed.timed_iter('S', 'fetch', range(3))) == [0, 1, 2]
+    assert timed.timed('S', 'encode', lambda value: value * 2)(21) == 42
+    assert [row[:3] for row in timed.rows()] == [['S', 'fetch', 3], ['S', 'encode', 1]]
+
+
+def test_exports():
+    exported = Stats()
+    exported.add('B', 'bulk_request', 2.0, 100)
+    exported.add('A', 'custom', 0.5, 1)
+    exported.add('A', 'fetch', 1.5, 100)
+
+    # rows are ordered by serializer, then stage as indexing goes
+    assert json.loads(exported.to_json()) == [
+        {'serializer': 'A', 'stage': 'fetch', 'count': 100, 'seconds': 1.5},
+        {'serializer': 'A', 'stage': 'custom', 'count': 1, 'seconds': 0.5},
+        {'serializer': 'B', 'stage': 'bulk_request', 'count': 100, 'seconds': 2.0},
+    ]
+    assert exported.to_prometheus().splitlines() == [
+        '# HELP esdocs_stage_seconds_total Time spent per esdocs indexing stage.',
+        '# TYPE esdocs_stage_seconds_total counter',
+        'esdocs_stage_seconds_total{serializer="A",stage="fetch"} 1.5',
+        'esdocs_stage_seconds_total{serializer="A",stage="custom"} 0.5',
+        'esdocs_stage_seconds_total{serializer="B",stage="bulk_request"} 2.0',
+        '# HELP esdocs_stage_calls_total Number of items processed per esdocs indexing stage.',
+        '# TYPE esdocs_stage_calls_total counter',
+        'esdocs_stage_calls_total{serializer="A",stage="fetch"} 100',
+        'esdocs_stage_calls_total{serializer="A",stage="custom"} 1',
+        'esdocs_stage_calls_total{serializer="B",stage="bulk_request"} 100',
+    ]
+
+
+def counts(rows):
+    return {stage: count for serializer, stage, count, seconds in rows if serializer == 'FlatSerializer'}
+
+
+@pytest.mark.parametrize('suffix', ['.json', '.prom'])
+def test_rebuild_stats(fake_es, enabled_stats, tmp_path, suffix):
+    options = {
+        'indexes': 'bench-flat',
+        'state_file': str(tmp_path / 'state.json'),
+        'dead_letter': str(tmp_path / 'dead-letter.ndjson'),
+        'no_input': True,
+        'stats': True,
+        'stats_file': str(tmp_path / ('stats' + suffix)),
+    }
+    Controller(**options).index_rebuild(**options)
+
+    assert counts(enabled_stats.rows()) == {
+        'fetch': 10000, 'prepare_batch': 10000, 'serialize': 10000, 'encode': 10000, 'bulk_request': 10000}
+    exported = (tmp_path / ('stats' + suffix)).read_text()
+    if suffix == '.json':
+        assert json.loads(exported) == json.loads(enabled_stats.to_json())
+    else:
+        assert exported == enabled_stats.to_prometheus()
+
+
+def test_worker_stats_are_merged(fake_es, enabled_stats, monkeypatch):
+    monkeypatch.setattr(Serializer, 'hash_registry', {hash(FlatSerializer): FlatSerializer})
+    monkeypatch.setattr(Serializer, 'compatibility_hooks', set())
+    enabled_stats.enable()
+
+    policy = policies.ProcessPoolStreamingPolicy(lambda: None)
+    try:
+        policy.bulk_operation(FlatSerializer, 'bench-flat', None, multi=2, stats=True)
+    finally:
+        policy.close()
+    assert counts(enabled_stats.rows())['serialize'] == 10000
+    assert counts(enabled_stats.rows())['bulk_request'] == 10000
@@ -0,0 +1,49 @@
+import sys
+import textwrap
+
+from esdocs.state import SerializerManifest, StateFile
+from esdocs.utils import register_serializers
+
+MODULE = """
+from elasticsearch_dsl import Document, Keyword
+from esdocs.serializer import Serializer
+{imports}
+
+class {name}Doc(Document):
+    name = Keyword()
+
+    class Index:
+        name = 'test-{index}'
+
+
+class {name}Serializer(Serializer):
+    document = {name}Doc
+"""
+
+
+def write_module(path, module, name, index, imports=''):
+    path.joinpath(module + '.py').write_text(textwrap.dedent(MODULE.format(name=name, index=index, imports=imports)))
+
+
+def test_manifest_records_each_modules_own_indexes(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    write_module(tmp_path, 'esdocs_manifest_a', 'ManifestA', 'a')
+    write_module(tmp_path, 'esdocs_manifest_c', 'ManifestC', 'c')
+    # imports a listed module and one that isn't
+    write_module(tmp_path, 'esdocs_manifest_b', 'ManifestB', 'b',
+                 imports='import esdocs_manifest_a, esdocs_manifest_c  # noqa')
+
+    state = StateFile(str(tmp_path / 'state.json'))
+    try:
+        register_serializers(['esdocs_manifest_b', 'esdocs_manifest_a'], manifest=SerializerManifest(state))
+    finally:
+        for module in ('esdocs_manifest_a', 'esdocs_manifest_b', 'esdocs_manifest_c'):
+            sys.modules.pop(module, None)
+
+    manifest = SerializerManifest(state)
+    assert manifest.get('esdocs_manifest_a') == ['test-a']
+    assert manifest.get('esdocs_manifest_b') == ['test-b', 'test-c']
+
+    # only what's needed gets imported
+    assert register_serializers(
+        ['esdocs_manifest_b', 'esdocs_manifest_a'], manifest=manifest, index_names=['test-a']) == ['test-b', 'test-c']